@@ -0,0 +1,238 @@
+"""
+Story counts cached by day, shared by all users/sessions.
+
+Counts are cached per (provider, query, domains, url_search_strings,
+day), so any date window can be assembled from cached days, and only
+days not in the cache are fetched from the provider (using
+count_over_time for each run of consecutive missing days).
+
+"Denominators" (counts of ALL stories for a set of domains) are
+the same for every user query with the same sources, so they're
+looked up here for total_count, count_over_time normalization
+and count_by_source_over_interval.
+
+User query counts over time are also assembled from daily counts,
+so moving or extending a date range only fetches the new days.
+"""
+
+# Python
+import datetime as dt
+import hashlib
+import logging
+from typing import Any, Iterable
+
+# PyPI
+from django.core.cache import cache
+from mc_providers import ContentProvider
+
+# mcweb
+from settings import CACHE_SECONDS
+
+# mcweb/util
+from util.cache import cached_function_call, set_digest
+import util.stats as stats
+
+# mcweb/backend/search (local dir)
+from .parallel import run_parallel
+from .utils import ParsedQuery
+
+logger = logging.getLogger(__name__)
+
+DAY = dt.timedelta(days=1)
+
+# days (before today) for which new stories may still be indexed,
+# cached for a short time:
+OPEN_DAYS = 7
+OPEN_DAY_SECONDS = 60*60
+
+# today (and any future days) change quickly:
+TODAY_SECONDS = 5*60
+
+# days before that don't change much:
+CLOSED_DAY_SECONDS = 7*CACHE_SECONDS
+
+# provider_props that select stories (others don't change counts)
+SELECTOR_PROPS = ("domains", "url_search_strings")
+
+def _as_date(value: Any) -> dt.date:
+    """
+    count_over_time "date" values may be datetime, date or ISO string
+    """
+    if isinstance(value, dt.datetime):
+        return value.date()
+    if isinstance(value, dt.date):
+        return value
+    return dt.date.fromisoformat(str(value)[:10])
+
+def _as_datetime(day: dt.date) -> dt.datetime:
+    """
+    providers expect (naive) datetimes
+    """
+    return dt.datetime.combine(day, dt.time())
+
+def _days(start: dt.date, end: dt.date) -> list[dt.date]:
+    """
+    list of days from start thru end (inclusive)
+    """
+    return [start + DAY * i for i in range((end - start).days + 1)]
+
+def _runs(days: Iterable[dt.date]) -> list[tuple[dt.date, dt.date]]:
+    """
+    collapse sorted days into (first, last) runs of consecutive days
+    """
+    runs: list[tuple[dt.date, dt.date]] = []
+    for day in days:
+        if runs and runs[-1][1] + DAY == day:
+            runs[-1] = (runs[-1][0], day)
+        else:
+            runs.append((day, day))
+    return runs
+
+def selector_digest(provider_props: dict) -> str:
+    """
+    short, session independent digest of the
+    story selecting provider properties
+    """
+    h = hashlib.md5()
+    for prop in SELECTOR_PROPS:
+        val = provider_props.get(prop)
+        h.update(f"{prop}\x02".encode())
+        if isinstance(val, dict):
+            for domain, uss in sorted(val.items()):
+                h.update(f"{domain}\x03{set_digest(frozenset(uss))}\x04".encode())
+        elif val:
+            h.update(set_digest(frozenset(val)).encode())
+    return h.hexdigest()
+
+def _day_seconds(day: dt.date, today: dt.date) -> int:
+    age = (today - day).days
+    if age > OPEN_DAYS:
+        return CLOSED_DAY_SECONDS
+    if age > 0:
+        return OPEN_DAY_SECONDS
+    return TODAY_SECONDS
+
+def _fetch_counts(provider: ContentProvider, pq: ParsedQuery, query: str,
+                  first: dt.date, last: dt.date) -> dict[dt.date, int]:
+    """
+    fetch counts for days first thru last from provider
+    (days without stories don't appear in results)
+    """
+    results = provider.count_over_time(query, _as_datetime(first), _as_datetime(last),
+                                       **pq.provider_props)
+    return {_as_date(row["date"]): row["count"] for row in results["counts"]}
+
+def daily_counts(provider: ContentProvider, pq: ParsedQuery, query: str) -> dict[dt.date, int]:
+    """
+    return dict of story counts for query, by day, for every day in pq's date range.
+    """
+    start = pq.start_date.date()
+    end = pq.end_date.date()
+    days = _days(start, end)
+
+    if not pq.caching or pq.caching < 0: # caching disabled by request
+        fetched = _fetch_counts(provider, pq, query, start, end)
+        return {day: fetched.get(day, 0) for day in days}
+
+    # include query in key prefix as digest, so keys are short
+    qhash = hashlib.md5(query.encode()).hexdigest()
+    prefix = f"daycount:{pq.provider_name}:{qhash}:{selector_digest(pq.provider_props)}"
+    keys = {day: f"{prefix}:{day:%Y%m%d}" for day in days}
+
+    cached = cache.get_many(keys.values()) # one round trip
+    counts = {day: cached[key] for day, key in keys.items() if key in cached}
+    missing = [day for day in days if day not in counts]
+    if not missing:
+        stats.count(["search", "daycount"], labels=[("status", "hit")])
+    else:
+        fetched: dict[dt.date, int] = {}
+        for first, last in _runs(missing):
+            logger.debug("daily_counts %s fetching %s thru %s", prefix, first, last)
+            fetched.update(_fetch_counts(provider, pq, query, first, last))
+            stats.count(["search", "daycount"], labels=[("status", "fetch")])
+
+        today = dt.date.today()
+        by_ttl: dict[int, dict[str, int]] = {}
+        for day in missing:
+            counts[day] = count = fetched.get(day, 0)
+            by_ttl.setdefault(_day_seconds(day, today), {})[keys[day]] = count
+        for seconds, values in by_ttl.items():
+            cache.set_many(values, seconds)
+    return counts
+
+def total_count(provider: ContentProvider, pq: ParsedQuery) -> int:
+    """
+    count of all stories from pq's sources in pq's date range
+    (may raise QueryingEverythingUnsupportedQuery)
+    """
+    return sum(daily_counts(provider, pq, provider.everything_query()).values())
+
+def normalized_count_over_time(provider: ContentProvider, pq: ParsedQuery) -> dict:
+    """
+    replacement for provider.normalized_count_over_time, using
+    shared daily total counts
+    (may raise QueryingEverythingUnsupportedQuery)
+    """
+    relevant, totals = run_parallel(
+        lambda: daily_counts(provider, pq, pq.query_str),
+        lambda: daily_counts(provider, pq, provider.everything_query()))
+
+    counts = []
+    for day, total in sorted(totals.items()):
+        count = relevant.get(day, 0)
+        if total == 0 and count == 0:
+            continue            # provider results omit empty days
+        counts.append({
+            "date": _as_datetime(day),
+            "total_count": total,
+            "count": count,
+            "ratio": count / total if total else 0
+        })
+    return {
+        "counts": counts,
+        "total": sum(row["count"] for row in counts),
+        "normalized_total": sum(row["total_count"] for row in counts),
+    }
+
+def count_over_time(provider: ContentProvider, pq: ParsedQuery) -> dict:
+    """
+    replacement for provider.count_over_time (for platforms
+    that don't support normalized_count_over_time)
+    """
+    counts = [{"date": _as_datetime(day), "count": count}
+              for day, count in sorted(daily_counts(provider, pq, pq.query_str).items())
+              if count]         # provider results omit empty days
+    return {"counts": counts}
+
+def _two_d_totals(provider_name: str, digest: str, start_date: dt.datetime,
+                  interval: str, num_intervals: int,
+                  *, provider: ContentProvider, domains: Iterable[str]) -> dict:
+    """
+    called via cached_function_call: only positional arguments in cache key!
+    """
+    return provider.two_d_aggregation(
+        query='*',
+        start_date=start_date,
+        outer_field="publish_date",
+        inner_field="media_name",
+        interval=interval,
+        num_intervals=num_intervals,
+        domains=domains
+    )
+
+def two_d_totals(provider: ContentProvider, pq: ParsedQuery, interval: str,
+                 num_intervals: int, domains: Iterable[str]) -> dict:
+    """
+    counts of all stories by interval and domain for count_by_source_over_interval
+    (cache key does not include session id)
+    """
+    def call(*args):
+        return _two_d_totals(*args, provider=provider, domains=domains)
+
+    args = (pq.provider_name, set_digest(frozenset(domains)), pq.start_date,
+            interval, num_intervals)
+    if not pq.caching or pq.caching < 0: # caching disabled by request
+        return call(*args)
+
+    results, cached = cached_function_call(call, "two-d-totals", None, *args)
+    return results
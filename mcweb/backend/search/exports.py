@@ -0,0 +1,255 @@
+"""
+Large content download export jobs.
+
+Instead of emailing a zip attachment (which limits the download
+size), stories are fetched a page at a time with
+provider.paged_items, and written as numbered, gzip'ed CSV chunks to
+an export store (a local directory, or an S3 compatible bucket)
+selected by the EXPORT_STORE setting:
+
+    file:/var/tmp/exports
+    s3://BUCKET/PREFIX (EXPORT_S3_ENDPOINT_URL set for MinIO)
+
+After each chunk is written, the (query_index, pagination_token)
+checkpoint is saved in the ExportJob row, so if the worker dies,
+the retried background task resumes from the last complete chunk
+(a partial chunk is re-fetched and overwritten).
+
+When all queries are done, the user is emailed a link to the
+export view, which streams the chunks in order: concatenated gzip
+members are a valid gzip file, so the chunks are never decompressed
+or copied on the server.
+
+Jobs (done or not) not updated in EXPORT_KEEP_DAYS are deleted,
+along with their chunks, by delete_old_jobs (run daily).
+"""
+
+# Python
+import csv
+import datetime as dt
+import gzip
+import io
+import logging
+import os
+from typing import Iterator
+
+# PyPI
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+# mcweb
+from settings import EXPORT_CHUNK_ROWS, EXPORT_KEEP_DAYS, EXPORT_S3_ENDPOINT_URL, EXPORT_STORE
+
+# mcweb/util
+from util.send_emails import send_export_ready_email
+
+# mcweb/backend/search (local dir)
+from .models import ExportJob
+from .utils import parsed_query_from_dict, pq_provider, story_row_getter
+
+# mcweb/backend
+from ..users.models import QuotaAccumulator
+
+logger = logging.getLogger(__name__)
+
+READ_BYTES = 64*1024            # export download block size
+
+class ExportStore:
+    """
+    base class for places to keep export chunks
+    """
+    def put(self, name: str, data: bytes) -> None:
+        raise NotImplementedError("put not implemented")
+
+    def read(self, name: str) -> Iterator[bytes]:
+        raise NotImplementedError("read not implemented")
+
+    def delete(self, name: str) -> None:
+        raise NotImplementedError("delete not implemented")
+
+class FileExportStore(ExportStore):
+    """
+    chunks kept in a local directory (shared by web and worker processes)
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def put(self, name: str, data: bytes) -> None:
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to temp file, then rename, so a crash never leaves a
+        # partial chunk under the real name
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def read(self, name: str) -> Iterator[bytes]:
+        with open(self._path(name), "rb") as f:
+            while data := f.read(READ_BYTES):
+                yield data
+
+    def delete(self, name: str) -> None:
+        path = self._path(name)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        try:
+            os.rmdir(os.path.dirname(path)) # job directory, once empty
+        except OSError:
+            pass
+
+class S3ExportStore(ExportStore):
+    """
+    chunks kept in an S3 (compatible) bucket;
+    credentials from the usual AWS_... environment variables
+    """
+    def __init__(self, bucket: str, prefix: str, endpoint_url: str = ""):
+        import boto3            # only needed if configured
+
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.s3 = boto3.client("s3", endpoint_url=endpoint_url or None)
+
+    def _key(self, name: str) -> str:
+        if self.prefix:
+            return f"{self.prefix}/{name}"
+        return name
+
+    def put(self, name: str, data: bytes) -> None:
+        self.s3.put_object(Bucket=self.bucket, Key=self._key(name), Body=data)
+
+    def read(self, name: str) -> Iterator[bytes]:
+        obj = self.s3.get_object(Bucket=self.bucket, Key=self._key(name))
+        yield from obj["Body"].iter_chunks(READ_BYTES)
+
+    def delete(self, name: str) -> None:
+        self.s3.delete_object(Bucket=self.bucket, Key=self._key(name))
+
+def get_store(spec: str = EXPORT_STORE) -> ExportStore | None:
+    """
+    return ExportStore for EXPORT_STORE setting (None if not configured)
+    """
+    if not spec:
+        return None
+    if spec.startswith("file:"):
+        return FileExportStore(spec[5:])
+    if spec.startswith("s3://"):
+        bucket, _, prefix = spec[5:].partition("/")
+        return S3ExportStore(bucket, prefix, EXPORT_S3_ENDPOINT_URL)
+    raise ValueError(f"bad EXPORT_STORE {spec}")
+
+def chunk_name(job: ExportJob, chunk: int) -> str:
+    return f"{job.id}/{job.basename}-{chunk:05d}.csv.gz"
+
+class _Chunk:
+    """
+    gzip'ed CSV rows for one chunk, buffered in memory
+    """
+    def __init__(self) -> None:
+        self.rows = 0
+        self.buf = io.BytesIO()
+        self.gz = gzip.GzipFile(fileobj=self.buf, mode="wb")
+        self.text = io.TextIOWrapper(self.gz, encoding="utf-8", newline="")
+        self.writer = csv.writer(self.text)
+
+    def close(self) -> bytes:
+        self.text.close()       # closes gz (but not buf)
+        return self.buf.getvalue()
+
+def run_job(job: ExportJob, store: ExportStore, chunk_rows: int = EXPORT_CHUNK_ROWS) -> None:
+    """
+    fetch (remaining) pages for job, writing chunks to store;
+    exceptions are raised (for background task retry).
+    """
+    if job.state == ExportJob.States.DONE:
+        return
+    user = User.objects.get(id=job.user_id)
+    job.state = ExportJob.States.RUNNING
+    job.save(update_fields=["state", "modified_at"])
+    if job.query_index or job.pagination_token:
+        logger.info("export job %d resuming at query %d chunk %d (%d rows)",
+                    job.id, job.query_index, job.chunks, job.rows)
+
+    chunk = _Chunk()
+    # hits only written at checkpoints: pages fetched after the last
+    # checkpoint are fetched (and charged) again when the job resumes.
+    quota = QuotaAccumulator(user.id, user.is_staff, auto_flush=False)
+
+    def checkpoint(query_index: int, token: str | None) -> None:
+        nonlocal chunk
+        if chunk.rows:
+            store.put(chunk_name(job, job.chunks), chunk.close())
+            job.chunks += 1
+            job.rows += chunk.rows
+            chunk = _Chunk()
+        job.query_index = query_index
+        job.pagination_token = token
+        job.save(update_fields=["query_index", "pagination_token", "chunks", "rows", "modified_at"])
+        quota.flush()
+        logger.debug("export job %d checkpoint: query %d chunk %d rows %d",
+                     job.id, query_index, job.chunks, job.rows)
+
+    queries = job.queries
+    while job.query_index < len(queries):
+        pq = parsed_query_from_dict(queries[job.query_index], session_id=job.email)
+        provider = pq_provider(pq)
+        token = job.pagination_token
+        while True:
+            kwargs = dict(pq.provider_props)
+            if token:
+                kwargs["pagination_token"] = token
+            page, token = provider.paged_items(f"({pq.query_str})", pq.start_date, pq.end_date, **kwargs)
+            quota.add(pq.provider_name)
+            if page:
+                columns = sorted(page[0].keys())
+                if job.rows == 0 and chunk.rows == 0: # column names, which differ by platform
+                    chunk.writer.writerow(columns)
+                chunk.writer.writerows(map(story_row_getter(columns), page))
+                chunk.rows += len(page)
+            if not token:
+                break
+            if chunk.rows >= chunk_rows:
+                checkpoint(job.query_index, token)
+        checkpoint(job.query_index + 1, None) # query done
+
+    job.state = ExportJob.States.DONE
+    job.error = None
+    job.save(update_fields=["state", "error", "modified_at"])
+    logger.info("export job %d done: %d chunks %d rows", job.id, job.chunks, job.rows)
+    send_export_ready_email(job.basename + ".csv.gz", job.url or "", job.rows, job.email)
+
+def delete_job(job: ExportJob, store: ExportStore) -> None:
+    """
+    delete job's chunks (including one written without
+    a checkpoint, if the worker died), then the job
+    """
+    for chunk in range(job.chunks + 1):
+        store.delete(chunk_name(job, chunk))
+    job.delete()
+
+def delete_old_jobs(store: ExportStore, days: int = EXPORT_KEEP_DAYS) -> int:
+    """
+    delete jobs not updated in `days` days (downloaded or not,
+    or abandoned after failing); returns number deleted
+    """
+    cutoff = timezone.now() - dt.timedelta(days=days)
+    deleted = 0
+    for job in ExportJob.objects.filter(modified_at__lt=cutoff).order_by("id"):
+        logger.info("deleting export job %d (%s, %d chunks)", job.id, job.state, job.chunks)
+        delete_job(job, store)
+        deleted += 1
+    return deleted
+
+def read_job(job: ExportJob, store: ExportStore) -> Iterator[bytes]:
+    """
+    return export data for a completed job (as a single gzip file)
+    """
+    if job.chunks == 0:         # no stories
+        yield gzip.compress(b"")
+    for chunk in range(job.chunks):
+        yield from store.read(chunk_name(job, chunk))
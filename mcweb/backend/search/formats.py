@@ -0,0 +1,298 @@
+"""
+Story list download formats.
+
+Encoders take pages of story dicts (from all_content_pages_generator)
+and return encoded bytes for each page, so the same encoder can feed
+a StreamingHttpResponse, a zip file member, or a temporary file.
+
+csv: same output as all_content_csv_generator + csv_stream
+ndjson: one JSON object per line (dates in ISO format)
+parquet: columnar, zstd compressed, with typed date/time columns
+    (numbers are float64; values that don't fit a column are dropped)
+    (one row group per page, written as each page arrives, so
+    output streams like the other formats)
+"""
+
+# Python
+import collections
+import csv
+import datetime as dt
+import io
+import json
+import logging
+from typing import Any, Callable, Iterable, Iterator
+
+# mcweb/backend/search (local dir)
+from .utils import story_row_getter
+
+logger = logging.getLogger(__name__)
+
+class StoryEncoder:
+    name = ""
+    extension = ""
+    content_type = ""
+    compressed = False          # no point in deflating in zip file
+
+    def __init__(self) -> None:
+        self.rows = 0
+
+    def encode(self, page: list[dict]) -> bytes:
+        """
+        return bytes for a page of stories
+        """
+        raise NotImplementedError("encode not implemented")
+
+    def close(self) -> bytes:
+        """
+        return any remaining bytes (after last page)
+        """
+        return b""
+
+FORMATS: dict[str, type[StoryEncoder]] = {}
+
+def story_format(cls: type[StoryEncoder]) -> type[StoryEncoder]:
+    """
+    decorator to register a StoryEncoder
+    """
+    FORMATS[cls.name] = cls
+    return cls
+
+def get_encoder(name: str) -> StoryEncoder:
+    """
+    raises ValueError for unknown format names
+    """
+    try:
+        return FORMATS[name]()
+    except KeyError:
+        raise ValueError(f"unknown format {name}; expected one of {', '.join(FORMATS)}")
+
+def encoded_chunks(encoder: StoryEncoder, pages: Iterable[list[dict]],
+                   chunk_bytes: int = 64*1024) -> Iterator[bytes]:
+    """
+    return encoded pages in chunks of (at least) chunk_bytes
+    (for StreamingHttpResponse)
+    """
+    parts = []
+    size = 0
+    for page in pages:
+        data = encoder.encode(page)
+        parts.append(data)
+        size += len(data)
+        if size >= chunk_bytes:
+            yield b"".join(parts)
+            parts = []
+            size = 0
+    parts.append(encoder.close())
+    if data := b"".join(parts):
+        yield data
+
+@story_format
+class CSVEncoder(StoryEncoder):
+    name = "csv"
+    extension = "csv"
+    content_type = "text/csv"
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.buf = io.BytesIO()
+        self.text = io.TextIOWrapper(self.buf, encoding="utf-8", newline="", write_through=True)
+        self.writer = csv.writer(self.text)
+        self.getter: Callable[[dict], tuple] | None = None
+
+    def encode(self, page: list[dict]) -> bytes:
+        if not page:
+            return b""
+        if self.getter is None: # column names, which differ by platform
+            columns = sorted(page[0].keys())
+            self.getter = story_row_getter(columns)
+            self.writer.writerow(columns)
+        self.writer.writerows(map(self.getter, page))
+        self.rows += len(page)
+        data = self.buf.getvalue()
+        self.buf.seek(0)
+        self.buf.truncate(0)
+        return data
+
+def _json_default(value: Any) -> str:
+    if isinstance(value, (dt.date, dt.datetime)):
+        return value.isoformat()
+    return str(value)
+
+@story_format
+class NDJSONEncoder(StoryEncoder):
+    name = "ndjson"
+    extension = "ndjson"
+    content_type = "application/x-ndjson"
+
+    def encode(self, page: list[dict]) -> bytes:
+        self.rows += len(page)
+        return "".join(json.dumps(story, default=_json_default, ensure_ascii=False) + "\n"
+                       for story in page).encode("utf-8")
+
+# Parquet column type converters: return value of column type,
+# or raise TypeError/ValueError if value can't be represented.
+
+def _as_str(v: Any) -> str:
+    return v if isinstance(v, str) else str(v)
+
+def _as_float(v: Any) -> float:
+    if isinstance(v, bool):
+        raise TypeError("bool in float column")
+    return float(v)             # ValueError for non-numeric strings
+
+def _as_bool(v: Any) -> bool:
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, int) and v in (0, 1):
+        return bool(v)
+    if isinstance(v, str) and v.lower() in ("true", "false"):
+        return v.lower() == "true"
+    raise TypeError(f"{v!r} in bool column")
+
+def _as_datetime(v: Any) -> dt.datetime:
+    if isinstance(v, str):
+        if v.endswith("Z"):     # fromisoformat before 3.11
+            v = v[:-1] + "+00:00"
+        v = dt.datetime.fromisoformat(v)
+    if isinstance(v, dt.datetime):
+        if v.tzinfo:            # column is naive UTC
+            v = v.astimezone(dt.timezone.utc).replace(tzinfo=None)
+        return v
+    if isinstance(v, dt.date):
+        return dt.datetime.combine(v, dt.time())
+    raise TypeError(f"{v!r} in datetime column")
+
+def _as_date(v: Any) -> dt.date:
+    if isinstance(v, dt.datetime):
+        return v.date()
+    if isinstance(v, dt.date):
+        return v
+    if isinstance(v, str):
+        return dt.date.fromisoformat(v[:10])
+    raise TypeError(f"{v!r} in date column")
+
+def _column_type(value: Any) -> tuple[Any, Callable]:
+    """
+    return (pyarrow type, converter) for a column, given a sample value
+    """
+    import pyarrow as pa
+
+    if isinstance(value, dt.datetime):
+        return pa.timestamp("us"), _as_datetime
+    if isinstance(value, dt.date):
+        return pa.date32(), _as_date
+    if isinstance(value, bool):
+        return pa.bool_(), _as_bool
+    if isinstance(value, (int, float)):
+        return pa.float64(), _as_float
+    return pa.string(), _as_str
+
+# columns (and sample values) for a parquet file with no stories
+EMPTY_COLUMNS = [
+    ("id", ""),
+    ("indexed_date", dt.datetime.min),
+    ("language", ""),
+    ("media_name", ""),
+    ("media_url", ""),
+    ("publish_date", dt.date.min),
+    ("title", ""),
+    ("url", ""),
+]
+
+class _Sink:
+    """
+    write-only file for ParquetWriter:
+    bytes written are collected until taken
+    """
+    closed = False
+
+    def __init__(self) -> None:
+        self.parts: list[bytes] = []
+        self.pos = 0
+
+    def write(self, data: bytes) -> int:
+        self.parts.append(bytes(data))
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.pos
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+@story_format
+class ParquetEncoder(StoryEncoder):
+    name = "parquet"
+    extension = "parquet"
+    content_type = "application/vnd.apache.parquet"
+    compressed = True
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.sink = _Sink()
+        self.writer: Any = None # pyarrow.parquet.ParquetWriter
+        self.columns: list[tuple[str, Any, Callable]] = []
+        self.dropped: collections.Counter[str] = collections.Counter()
+
+    def _column_types(self, page: list[dict]) -> None:
+        """
+        pick column types using first non-null value in first page
+        (columns with no values are strings).  The schema can't change
+        once the first row group is written, so numbers are always
+        float64, and converters coerce values from later pages.
+        """
+        for name in sorted(page[0].keys()):
+            value = next((story[name] for story in page if story.get(name) is not None), None)
+            self.columns.append((name, *_column_type(value)))
+        self._open()
+
+    def _open(self) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema([(name, type_) for name, type_, _ in self.columns])
+        self.writer = pq.ParquetWriter(self.sink, schema, compression="zstd")
+
+    def _convert(self, name: str, convert: Callable, value: Any) -> Any:
+        if value is None:
+            return None
+        try:
+            return convert(value)
+        except (TypeError, ValueError, OverflowError):
+            # don't fail the download (and discard everything
+            # already written) for one odd value.
+            self.dropped[name] += 1
+            return None
+
+    def encode(self, page: list[dict]) -> bytes:
+        import pyarrow as pa
+
+        if not page:
+            return b""
+        if self.writer is None:
+            self._column_types(page)
+        arrays = [pa.array([self._convert(name, convert, story.get(name)) for story in page],
+                           type=type_)
+                  for name, type_, convert in self.columns]
+        self.writer.write_table(pa.Table.from_arrays(arrays, names=[c[0] for c in self.columns]))
+        self.rows += len(page)
+        return self.sink.take()
+
+    def close(self) -> bytes:
+        if self.writer is None: # no stories: empty file with usual columns
+            self.columns = [(name, *_column_type(value)) for name, value in EMPTY_COLUMNS]
+            self._open()
+        if self.dropped:
+            logger.warning("parquet: dropped values that did not match column type: %s",
+                           dict(self.dropped))
+        self.writer.close()
+        return self.sink.take()
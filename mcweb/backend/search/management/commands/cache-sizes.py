@@ -0,0 +1,78 @@
+"""
+Command to report sizes of cached values by cache key prefix
+(before and after compression by util.cache_codec)
+"""
+
+import collections
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+
+# mcweb:
+from settings import CACHES
+
+# mcweb/util:
+from util.cache_codec import sizes
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Report cached value sizes by key prefix'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=0,
+                            help="max keys to examine (default: all)")
+        parser.add_argument("--match", default="*",
+                            help="key pattern (default: all)")
+
+    def handle(self, *args, **options):
+        limit = options["limit"]
+
+        # django_redis default key function: PREFIX:VERSION:KEY
+        redis_prefix = f"{CACHES['default']['KEY_PREFIX']}:1:"
+        r = get_redis_connection("default")
+
+        # per cache key prefix:
+        count: collections.Counter[str] = collections.Counter()
+        before: collections.Counter[str] = collections.Counter() # pickled size
+        after: collections.Counter[str] = collections.Counter() # stored size
+        codecs: collections.Counter[str] = collections.Counter()
+
+        t0 = time.monotonic()
+        n = 0
+        for rkey in r.scan_iter(match=redis_prefix + options["match"], count=1000):
+            key = rkey.decode()[len(redis_prefix):]
+            if key.endswith(":lock"): # util.cache single-flight lock
+                continue
+            data = r.get(rkey)
+            if data is None:    # expired
+                continue
+            prefix = key.rsplit(":", 1)[0] if ":" in key else "(none)"
+            try:
+                int(data)
+                # django_redis stores ints without serializing
+                name, size = "int", len(data)
+            except ValueError:
+                name, size = sizes(data)
+            count[prefix] += 1
+            before[prefix] += size
+            after[prefix] += len(data)
+            codecs[name] += 1
+            n += 1
+            if n == limit:
+                break
+        elapsed = time.monotonic() - t0
+
+        fmt = "%-64s %8s %12s %12s %6s"
+        print(fmt % ("prefix", "keys", "before", "after", "ratio"))
+        for prefix, _ in before.most_common():
+            ratio = before[prefix] / after[prefix] if after[prefix] else 0
+            print(fmt % (prefix, count[prefix], before[prefix], after[prefix], f"{ratio:.2f}"))
+        total_before = sum(before.values())
+        total_after = sum(after.values())
+        ratio = total_before / total_after if total_after else 0
+        print(fmt % ("TOTAL", n, total_before, total_after, f"{ratio:.2f}"))
+        print("codecs:", ", ".join(f"{name}: {c}" for name, c in codecs.items()))
+        print(round(elapsed, 3), "sec")
@@ -0,0 +1,113 @@
+"""
+Command to measure story CSV encoding speed (rows/second):
+"before" is the old per-story sorted(story.items()) projection
+and StringIO chunking by row count; "after" is story_row_getter
+and csv_stream.csv_chunks (bytes, chunked by size).
+"""
+
+import csv
+import datetime as dt
+import io
+import time
+from typing import Callable, Iterable, Iterator
+
+from django.core.management.base import BaseCommand
+
+from backend.search.utils import story_row_getter
+from backend.util.csv_stream import csv_chunks
+
+def synthetic_pages(nrows: int, page_size: int) -> list[list[dict]]:
+    """
+    pages of stories like those from onlinenews-mediacloud all_items
+    """
+    pages = []
+    for p in range(0, nrows, page_size):
+        page = []
+        for i in range(p, min(p + page_size, nrows)):
+            domain = f"site{i % 5000}.example.com"
+            page.append({
+                "url": f"https://{domain}/news/{i}/story.html",
+                "title": f"Synthetic story number {i}",
+                "publish_date": dt.date(2024, 1, 1) + dt.timedelta(days=i % 365),
+                "media_name": domain,
+                "media_url": domain,
+                "language": "en",
+                "indexed_date": dt.datetime(2024, 1, 1, 12, 0, i % 60),
+                "id": f"{i:032x}",
+            })
+        pages.append(page)
+    return pages
+
+def before_rows(pages: list[list[dict]]) -> Iterator[list]:
+    first_page = True
+    for page in pages:
+        if first_page:
+            yield sorted(page[0].keys())
+            first_page = False
+        for story in page:
+            yield [v for k, v in sorted(story.items())]
+
+def before_chunks(rows: Iterable, chunk_rows: int = 1000) -> Iterator[bytes]:
+    """
+    old streaming_csv_response _chunk (plus encoding done by StreamingHttpResponse)
+    """
+    buf = io.StringIO(newline='')
+    writer = csv.writer(buf)
+    iterator = iter(rows)
+    done = False
+    while True:
+        chunk_list = []
+        for row in iterator:
+            chunk_list.append(row)
+            if len(chunk_list) >= chunk_rows:
+                break
+        else:
+            done = True
+        writer.writerows(chunk_list)
+        yield buf.getvalue().encode("utf-8")
+        if done:
+            return
+        buf.seek(0)
+        buf.truncate(0)
+
+def after_rows(pages: list[list[dict]]) -> Iterator[tuple]:
+    getter = None
+    for page in pages:
+        if getter is None:
+            columns = sorted(page[0].keys())
+            getter = story_row_getter(columns)
+            yield columns
+        yield from map(getter, page)
+
+def after_chunks(rows: Iterable) -> Iterator[bytes]:
+    return csv_chunks(rows)
+
+METHODS: dict[str, tuple[Callable, Callable]] = {
+    "before": (before_rows, before_chunks),
+    "after": (after_rows, after_chunks),
+}
+
+class Command(BaseCommand):
+    help = 'Benchmark story CSV encoding (rows/second)'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=200000)
+        parser.add_argument("--page-size", type=int, default=1000)
+        parser.add_argument("--repeat", type=int, default=3,
+                            help="times to run each method (best time reported)")
+
+    def handle(self, *args, **options):
+        nrows = options["rows"]
+        pages = synthetic_pages(nrows, options["page_size"])
+
+        results = {}
+        for name, (rows_func, chunks_func) in METHODS.items():
+            times = []
+            for i in range(options["repeat"]):
+                t0 = time.monotonic()
+                data = b"".join(chunks_func(rows_func(pages)))
+                times.append(time.monotonic() - t0)
+            results[name] = data
+            best = min(times)
+            print(f"{name:8s} {nrows} rows {len(data)} bytes {best:.3f} sec {nrows/best:.0f} rows/sec")
+        print("same output:", results["before"] == results["after"])
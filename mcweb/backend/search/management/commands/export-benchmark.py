@@ -0,0 +1,101 @@
+"""
+Command to report peak memory (RSS) used creating a large download
+ZIP file from synthetic stories: the old all-in-memory method
+(StringIO CSV + BytesIO ZIP) vs. streaming into a temporary file
+(tasks.write_csv_zip).
+
+Each method is run in a fresh (forked) process so peak RSS
+(ru_maxrss) reflects only that method.
+"""
+
+import csv
+import datetime as dt
+import io
+import multiprocessing
+import resource
+import tempfile
+import time
+import zipfile
+from typing import Generator
+
+from django.core.management.base import BaseCommand
+
+from backend.search.tasks import write_csv_zip
+
+# columns like those from onlinenews-mediacloud all_items
+COLUMNS = ["id", "indexed_date", "language", "media_name", "media_url",
+           "publish_date", "title", "url"]
+
+def synthetic_rows(nrows: int) -> Generator[list, None, None]:
+    yield COLUMNS
+    day = dt.date(2024, 1, 1)
+    for i in range(nrows):
+        domain = f"site{i % 5000}.example.com"
+        yield [f"{i:032x}", dt.datetime(2024, 1, 1, 12, 0, i % 60),
+               "en", domain, domain, day + dt.timedelta(days=i % 365),
+               f"Synthetic story number {i} about nothing in particular",
+               f"https://{domain}/news/{i}/synthetic-story-number-{i}.html"]
+
+def in_memory(nrows: int) -> tuple[int, int]:
+    """
+    the way _download_all_large_content_csv used to work
+    """
+    csvfile = io.StringIO()
+    csvwriter = csv.writer(csvfile)
+    csvwriter.writerows(synthetic_rows(nrows))
+    zipstream = io.BytesIO()
+    zipfile_obj = zipfile.ZipFile(zipstream, 'w', zipfile.ZIP_DEFLATED)
+    csv_data = csvfile.getvalue()
+    zipfile_obj.writestr("test.csv", csv_data)
+    zipfile_obj.close()
+    zipped_data = zipstream.getvalue()
+    return len(csv_data), len(zipped_data)
+
+def streaming(nrows: int) -> tuple[int, int]:
+    """
+    the way _download_all_large_content_csv works now
+    """
+    with tempfile.TemporaryFile() as zipstream:
+        with zipfile.ZipFile(zipstream, 'w', zipfile.ZIP_DEFLATED) as zipfile_obj:
+            write_csv_zip(zipfile_obj, "test.csv", synthetic_rows(nrows))
+            csv_size = zipfile_obj.getinfo("test.csv").file_size
+        zipstream.seek(0)
+        zipped_data = zipstream.read() # read for email attachment
+    return csv_size, len(zipped_data)
+
+METHODS = {
+    "memory": in_memory,
+    "streaming": streaming,
+}
+
+def _run(method: str, nrows: int, queue: multiprocessing.Queue) -> None:
+    t0 = time.monotonic()
+    csv_size, zip_size = METHODS[method](nrows)
+    elapsed = time.monotonic() - t0
+    # ru_maxrss is in KB on Linux
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((csv_size, zip_size, elapsed, maxrss))
+
+class Command(BaseCommand):
+    help = 'Report peak RSS for large download ZIP creation'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1000000,
+                            help="number of synthetic stories (default: 1M)")
+        parser.add_argument("--method", choices=list(METHODS.keys()), nargs="*",
+                            default=list(METHODS.keys()),
+                            help="method(s) to run (default: all)")
+
+    def handle(self, *args, **options):
+        nrows = options["rows"]
+        ctx = multiprocessing.get_context("fork")
+
+        fmt = "%-10s %12s %12s %8s %12s"
+        print(fmt % ("method", "csv", "zip", "sec", "peak RSS KB"))
+        for method in options["method"]:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=_run, args=(method, nrows, queue))
+            proc.start()
+            csv_size, zip_size, elapsed, maxrss = queue.get()
+            proc.join()
+            print(fmt % (method, csv_size, zip_size, f"{elapsed:.2f}", maxrss))
@@ -0,0 +1,24 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from settings import EXPORT_KEEP_DAYS
+
+from ...exports import delete_old_jobs, get_store
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Delete export jobs (and their chunks) not updated recently'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=EXPORT_KEEP_DAYS,
+                            help=f"Days to keep export jobs (default {EXPORT_KEEP_DAYS}).")
+
+    def handle(self, *args, **options):
+        store = get_store()
+        if store is None:
+            logger.info("EXPORT_STORE not set")
+            return
+        n = delete_old_jobs(store, options["days"])
+        logger.info("deleted %d export jobs", n)
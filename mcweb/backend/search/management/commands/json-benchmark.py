@@ -0,0 +1,83 @@
+"""
+Command to measure JSON encoding of story_list pages:
+stdlib json.dumps(default=str) (the old json_response)
+vs. json_stream.dumps (orjson) vs. json_stream.json_chunks
+(time to first chunk, and to last).
+"""
+
+import datetime as dt
+import json
+import time
+from typing import Callable
+
+from django.core.management.base import BaseCommand
+
+from backend.util import json_stream
+
+def synthetic_page(page_size: int) -> list[dict]:
+    """
+    page of stories like those from onlinenews-mediacloud paged_items
+    """
+    page = []
+    for i in range(page_size):
+        domain = f"site{i % 500}.example.com"
+        page.append({
+            "id": f"{i:064x}",
+            "media_name": domain,
+            "media_url": domain,
+            "title": f"Synthetic story number {i} about nothing in particular",
+            "publish_date": dt.date(2024, 1, 1) + dt.timedelta(days=i % 365),
+            "url": f"https://{domain}/news/{i}/synthetic-story-number-{i}.html",
+            "language": "en",
+            "indexed_date": dt.datetime(2024, 1, 1, 12, 0, i % 60),
+        })
+    return page
+
+class Command(BaseCommand):
+    help = 'Benchmark story_list JSON encoding'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--page-size", type=int, default=1000)
+        parser.add_argument("--repeat", type=int, default=20,
+                            help="times to run each method (best time reported)")
+
+    def handle(self, *args, **options):
+        page = synthetic_page(options["page_size"])
+        value = {"stories": page, "pagination_token": "x" * 40}
+
+        def stdlib() -> tuple[float, bytes]:
+            return 0.0, json.dumps(value, default=str).encode("utf-8")
+
+        def fast() -> tuple[float, bytes]:
+            return 0.0, json_stream.dumps(value)
+
+        def streaming() -> tuple[float, bytes]:
+            t0 = time.monotonic()
+            first = 0.0
+            chunks = []
+            for chunk in json_stream.json_chunks({"pagination_token": value["pagination_token"]},
+                                                 "stories", page):
+                if not chunks:
+                    first = time.monotonic() - t0
+                chunks.append(chunk)
+            return first, b"".join(chunks)
+
+        methods: dict[str, Callable[[], tuple[float, bytes]]] = {
+            "json": stdlib,
+            "orjson": fast,
+            "stream": streaming,
+        }
+        fmt = "%-8s %10s %12s %12s %s"
+        print(fmt % ("method", "bytes", "first ms", "total ms", "same"))
+        expected = json.loads(stdlib()[1])
+        for name, func in methods.items():
+            best_total = best_first = float("inf")
+            for i in range(options["repeat"]):
+                t0 = time.monotonic()
+                first, data = func()
+                total = time.monotonic() - t0
+                best_total = min(best_total, total)
+                best_first = min(best_first, first or total)
+            # orjson formats dates like str() (PASSTHROUGH_DATETIME)
+            same = json.loads(data) == expected
+            print(fmt % (name, len(data), f"{best_first*1000:.2f}", f"{best_total*1000:.2f}", same))
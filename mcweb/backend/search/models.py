@@ -8,3 +8,34 @@ class SavedSearch(models.Model):
     serialized_search = models.TextField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True, null=True)
     modified_at = models.DateTimeField(auto_now=True, null=True)
+
+class ExportJob(models.Model):
+    """
+    A large content download, written to an export store
+    (backend/search/exports.py) in numbered chunks.
+
+    (query_index, pagination_token) is a checkpoint saved after each
+    chunk is written, so a job interrupted by a worker crash resumes
+    from the last complete chunk.
+    """
+    class States(models.TextChoices):
+        PENDING = "pending"
+        RUNNING = "running"
+        DONE = "done"
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    email = models.EmailField()
+    queries = models.JSONField()  # queryState (list of dicts)
+    basename = models.CharField(max_length=255)  # download filename (without extension)
+    url = models.TextField(null=True, blank=True)  # download link
+    state = models.CharField(max_length=16, choices=States.choices, default=States.PENDING)
+
+    # checkpoint:
+    query_index = models.IntegerField(default=0)  # current query
+    pagination_token = models.TextField(null=True, blank=True)  # next page of current query
+    chunks = models.IntegerField(default=0)  # chunks written
+    rows = models.BigIntegerField(default=0)  # stories written
+
+    error = models.TextField(null=True, blank=True)  # last exception
+    created_at = models.DateTimeField(auto_now_add=True)
+    modified_at = models.DateTimeField(auto_now=True)
@@ -0,0 +1,239 @@
+"""
+Run independent provider calls for a single request concurrently
+(ie; relevant and total counts), on a bounded per-process thread pool,
+read ahead pages from provider iterators (prefetch), and iterate
+several provider iterators at once (interleave).
+"""
+
+# Python
+import contextvars
+import logging
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, TypeVar
+
+# PyPI
+from django_redis import get_redis_connection
+
+# mcweb
+from settings import PROVIDERS_TIMEOUT, SEARCH_THREADS
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=SEARCH_THREADS,
+                               thread_name_prefix="search")
+
+def submit(call: Callable[[], Any]) -> Future:
+    """
+    start call running on the search thread pool
+    (in a copy of the caller's context, so sentry sees the call
+    as part of the request)
+    """
+    ctx = contextvars.copy_context()
+    return _executor.submit(ctx.run, call)
+
+def run_parallel(*calls: Callable[[], Any], timeout: float = PROVIDERS_TIMEOUT) -> list[Any]:
+    """
+    Run calls (functions taking no arguments) concurrently,
+    return list of their results (in order).
+
+    If a call raises an exception (or doesn't return within `timeout`
+    seconds, raising concurrent.futures.TimeoutError), the exception
+    is re-raised here (for handle_provider_errors), after cancelling
+    any calls that have not started.
+    """
+    if len(calls) == 1:
+        return [calls[0]()]
+
+    # all calls start (about) now, so each has until deadline
+    deadline = time.monotonic() + timeout
+    futures = [submit(call) for call in calls]
+    try:
+        return [future.result(timeout=max(0, deadline - time.monotonic()))
+                for future in futures]
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+# queue entry for end of an iterable
+END = object()
+
+class _Raised:
+    """
+    wrapper for exception raised by a producer thread
+    """
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+class _Channel:
+    """
+    bounded queue from producer thread(s) to a consumer that may stop early
+    """
+    def __init__(self, depth: int):
+        self.q: queue.Queue = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()
+
+    def put(self, item: Any) -> bool:
+        """
+        returns False if consumer has gone away
+        """
+        while not self.stop.is_set():
+            try:
+                self.q.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self) -> Any:
+        item = self.q.get()
+        if isinstance(item, _Raised):
+            raise item.exc
+        return item
+
+def _start(target: Callable[[], None], name: str) -> None:
+    ctx = contextvars.copy_context()
+    thread = threading.Thread(target=ctx.run, args=(target,), name=name, daemon=True)
+    thread.start()
+
+def prefetch(iterable: Iterable[T], depth: int) -> Iterator[T]:
+    """
+    Iterate `iterable` (ie; provider.all_items pages) in a producer
+    thread, up to `depth` items ahead of the consumer, so fetching
+    item N+1 overlaps processing item N.
+
+    The queue is bounded, so if the consumer is slow (ie; a slow HTTP
+    client reading a StreamingHttpResponse), the producer blocks
+    rather than buffering everything.  If the consumer stops early
+    (generator closed/garbage collected), the producer stops at its
+    next item.  Exceptions in the producer are raised in the consumer.
+    """
+    if depth <= 0:
+        yield from iterable
+        return
+
+    channel = _Channel(depth)
+
+    def producer() -> None:
+        try:
+            for item in iterable:
+                if not channel.put(item):
+                    return
+        except BaseException as e:
+            channel.put(_Raised(e))
+        else:
+            channel.put(END)
+
+    _start(producer, "prefetch")
+    try:
+        while (item := channel.get()) is not END:
+            yield item
+    finally:
+        channel.stop.set()
+
+class UserSlots:
+    """
+    Cross-process limit on concurrent work for a user (ie; queries
+    being fetched for downloads), kept in a Redis sorted set of
+    slot leases (scored by expiration time), so slots held by a
+    crashed process expire.
+    """
+    LEASE_SECONDS = 10*60       # renewed by refresh
+
+    # remove expired leases, add new lease if under limit
+    _ACQUIRE = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[4])
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+    return 1
+end
+return 0
+"""
+
+    def __init__(self, name: str, user_id: int, limit: int):
+        self.key = f"slots:{name}:{user_id}"
+        self.limit = limit
+        self.redis = get_redis_connection("default")
+        self.acquire_script = self.redis.register_script(self._ACQUIRE)
+
+    def acquire(self, stop: threading.Event) -> str | None:
+        """
+        wait for a free slot, returns lease token
+        (or None if stop set while waiting)
+        """
+        token = uuid.uuid4().hex
+        while not stop.is_set():
+            now = time.time()
+            if self.acquire_script(keys=[self.key],
+                                   args=[now, now + self.LEASE_SECONDS, self.limit,
+                                         token, self.LEASE_SECONDS]):
+                return token
+            stop.wait(0.5)
+        return None
+
+    def refresh(self, token: str) -> None:
+        self.redis.zadd(self.key, {token: time.time() + self.LEASE_SECONDS}, xx=True)
+
+    def release(self, token: str) -> None:
+        self.redis.zrem(self.key, token)
+
+def interleave(iterables: list[Iterable[T]], threads: int, depth: int,
+               slots: UserSlots | None = None) -> Iterator[tuple[int, Any]]:
+    """
+    Iterate `iterables` concurrently, on up to `threads` threads
+    (each holding one of `slots` while running), returning
+    (index, item) tuples in the order items arrive, and (index, END)
+    when iterables[index] is exhausted.
+
+    Like prefetch: at most `depth` items are queued, the producers
+    stop if the consumer does, and exceptions are raised in the consumer.
+    """
+    channel = _Channel(depth)
+    indices = iter(range(len(iterables)))
+    lock = threading.Lock()
+
+    def worker() -> None:
+        while True:
+            with lock:
+                index = next(indices, None)
+            if index is None:
+                return
+            token = None
+            try:
+                # inside try: consumer must see any error (ie; Redis down)
+                if slots:
+                    token = slots.acquire(channel.stop)
+                    if token is None:
+                        return  # consumer gone
+                for item in iterables[index]:
+                    if not channel.put((index, item)):
+                        return
+                    if token:
+                        slots.refresh(token)
+                channel.put((index, END))
+            except BaseException as e:
+                channel.put(_Raised(e))
+                return
+            finally:
+                if token:
+                    slots.release(token)
+
+    for n in range(min(threads, len(iterables))):
+        _start(worker, f"interleave-{n}")
+
+    remaining = len(iterables)
+    try:
+        while remaining:
+            index, item = channel.get()
+            if item is END:
+                remaining -= 1
+            yield index, item
+    finally:
+        channel.stop.set()
@@ -5,18 +5,28 @@ Background tasks for 'download_all_content_csv'
 # Python
 import csv
 import datetime as dt
+import io
 import logging
+import shutil
+import tempfile
+import time
 import zipfile
 from io import StringIO, BytesIO
+from typing import IO, Callable, Iterable
 
 # PyPI
 import mc_providers
 
 # mcweb/backend/search (local directory)
+from . import exports
+from .formats import StoryEncoder, get_encoder
+from .models import ExportJob
 from .utils import (
     ParsedQuery,
     all_content_csv_basename,
+    all_content_query_pages,
     all_content_csv_generator,
+    all_content_pages_generator,
     filename_timestamp,
     parsed_query_from_dict,
     pq_provider
@@ -38,68 +48,161 @@ logger = logging.getLogger(__name__)
 
 # called from /api/search/send-email-large-download-csv endpoint
 # by frontend sendTotalAttentionDataEmail
-def download_all_large_content_csv(queryState: list[dict], user_id: int, user_isStaff: bool, email: str):
-    task = _download_all_large_content_csv(queryState, user_id, user_isStaff, email)
+def download_all_large_content_csv(queryState: list[dict], user_id: int, user_isStaff: bool, email: str,
+                                   url_func: Callable[[int], str] | None = None,
+                                   split: bool = False, fmt: str = "csv"):
+    """
+    if an export store is configured (and fmt is csv), creates an
+    ExportJob (url_func called with job id to create download link),
+    else stories are emailed as a zip attachment
+    (with a file per query if split is True).
+    """
+    get_encoder(fmt)            # validate before queuing task
+    if url_func and fmt == "csv" and exports.get_store():
+        parsed_queries = [parsed_query_from_dict(q, session_id=email) for q in queryState]
+        job = ExportJob.objects.create(user_id=user_id, email=email, queries=queryState,
+                                       basename=all_content_csv_basename(parsed_queries))
+        job.url = url_func(job.id)
+        job.save(update_fields=["url"])
+        task = _run_export_job(job.id)
+    else:
+        task = _download_all_large_content_csv(queryState, user_id, user_isStaff, email, split, fmt)
     return {'task': return_task(task)}  # XXX double wraps {task: {task: TASK_DATA}}??
 
 @background(queue=USER_SLOW, remove_existing_tasks=True)
-def _download_all_large_content_csv(queryState: list[dict], user_id: int, user_isStaff: bool, email: str):
+def _run_export_job(job_id: int):
+    """
+    run (or resume) an export job: if the task raises an exception
+    (or the worker dies), background_task retries it, resuming
+    from the job's last checkpoint.
+    """
+    job = ExportJob.objects.get(id=job_id)
+    store = exports.get_store()
+    try:
+        exports.run_job(job, store)
+    except Exception as e:
+        logger.exception("export job %d", job_id)
+        job.error = repr(e)
+        job.save(update_fields=["error", "modified_at"])
+        raise
+
+def write_csv_zip(zipfile_obj: zipfile.ZipFile, csv_filename: str,
+                  rows: Iterable[list]) -> int:
+    """
+    write rows as CSV file csv_filename in open ZipFile, streaming
+    (deflating as it goes), so neither the CSV text nor the compressed
+    data need to fit in memory (if ZipFile is writing to a file).
+    returns number of rows written.
+    """
+    nrows = 0
+    # force_zip64: size unknown in advance, and could exceed 2GB
+    with zipfile_obj.open(csv_filename, "w", force_zip64=True) as member:
+        # newline="": let csv module write CRLF
+        with io.TextIOWrapper(member, encoding="utf-8", newline="") as text:
+            csvwriter = csv.writer(text)
+            for row in rows:
+                csvwriter.writerow(row)
+                nrows += 1
+    return nrows
+
+def _zipinfo(filename: str, encoder: StoryEncoder) -> zipfile.ZipInfo:
+    """
+    ZipInfo for a member written by encoder
+    (don't deflate already compressed formats)
+    """
+    info = zipfile.ZipInfo(filename, date_time=time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_STORED if encoder.compressed else zipfile.ZIP_DEFLATED
+    return info
+
+def write_pages_zip(zipfile_obj: zipfile.ZipFile, filename: str, encoder: StoryEncoder,
+                    pages: Iterable[list[dict]]) -> int:
+    """
+    write pages of stories using encoder as file filename in open ZipFile
+    (streaming, like write_csv_zip).
+    returns number of rows written.
+    """
+    with zipfile_obj.open(_zipinfo(filename, encoder), "w", force_zip64=True) as member:
+        for page in pages:
+            member.write(encoder.encode(page))
+        member.write(encoder.close())
+    return encoder.rows
+
+def write_query_zip(zipfile_obj: zipfile.ZipFile, basename: str, fmt: str,
+                    pqs: list[ParsedQuery], user_id: int, is_staff: bool) -> int:
+    """
+    write a member for each query (fetched concurrently) to open ZipFile.
+    pages are written to per-query temporary files as they arrive,
+    and copied into the ZipFile when all queries are done.
+    returns number of rows written.
+    """
+    encoders = [get_encoder(fmt) for pq in pqs]
+    files: list[IO[bytes]] = []
+    try:
+        for encoder in encoders:
+            files.append(tempfile.TemporaryFile(prefix="large-download-", suffix="." + encoder.extension))
+
+        for i, page in all_content_query_pages(pqs, user_id, is_staff):
+            if page:            # (None when query done)
+                files[i].write(encoders[i].encode(page))
+
+        for i, (encoder, f) in enumerate(zip(encoders, files)):
+            f.write(encoder.close())
+            f.seek(0)
+            info = _zipinfo(f"{basename}-{i+1}.{encoder.extension}", encoder)
+            with zipfile_obj.open(info, "w", force_zip64=True) as member:
+                shutil.copyfileobj(f, member)
+    finally:
+        for f in files:
+            f.close()
+    return sum(encoder.rows for encoder in encoders)
+
+@background(queue=USER_SLOW, remove_existing_tasks=True)
+def _download_all_large_content_csv(queryState: list[dict], user_id: int, user_isStaff: bool, email: str,
+                                    split: bool = False, fmt: str = "csv"):
+    """
+    if split is True, write each query to a separate file in the zip
+    (queries are fetched concurrently either way, see
+    all_content_pages_generator).
+    fmt is a formats.py format name.
+    """
     parsed_queries = [parsed_query_from_dict(q, session_id=email) for q in queryState]
     # code from: https://stackoverflow.com/questions/17584550/attach-generated-csv-file-to-email-and-send-with-django
 
     # Phil: maybe catch exception, and send email?
 
-    logger.info("starting large_content_csv for %s; %d query/ies",
-                email, len(parsed_queries))
-
-    # if the uncompressed data size is ever an issue
-    # (taking too much memory) do:
-    # try:
-    #    with open("/var/tmp/" + csv_filename, "w") as csvfile:
-    #       write to file....
-    # and after:
-    #    zipfile_obj.write(csv_filename, ....)
-    #    send email....
-    # finally:
-    #    os.unlink(csv_filename)
-    # ***OR***
-    # switch to gzip (.gz) for compression, which provides
-    # a writeable file-like object that can be passed to csv.writer
-    # (without storing uncompressed bytes)
-
-    data_generator = all_content_csv_generator(parsed_queries, user_id, user_isStaff)
+    logger.info("starting large_content_csv for %s; %d query/ies (%s)",
+                email, len(parsed_queries), fmt)
+
     basename = all_content_csv_basename(parsed_queries)
 
     # always make matching filenames
-    csv_filename = basename + ".csv"
     zip_filename = basename + ".zip"
 
-    # Create a StringIO object to store the CSV data
-    csvfile = StringIO()
-    csvwriter = csv.writer(csvfile)
-
-    # Generate and write data to the CSV
-    csvwriter.writerows(data_generator())
-
-    # Create an in-memory byte stream, and wrap ZipFile object around it
-    zipstream = BytesIO()
-    zipfile_obj = zipfile.ZipFile(zipstream, 'w', zipfile.ZIP_DEFLATED)
-
-    # Convert the CSV data from StringIO to bytes
-    csv_data = csvfile.getvalue()
-
-    # Add the CSV data to the zip file
-    zipfile_obj.writestr(csv_filename, csv_data)
-
-    # Close the zip file
-    zipfile_obj.close()
-
-    # Get the zip data
-    zipped_data = zipstream.getvalue()
+    # pages of stories are written as they arrive, and deflated into
+    # a (disk) temporary file, so memory use doesn't depend on the
+    # number of stories (only the zip file is read into memory to
+    # attach to email).
+    with tempfile.TemporaryFile(prefix="large-download-", suffix=".zip") as zipstream:
+        with zipfile.ZipFile(zipstream, 'w', zipfile.ZIP_DEFLATED) as zipfile_obj:
+            if split and len(parsed_queries) > 1:
+                nrows = write_query_zip(zipfile_obj, basename, fmt, parsed_queries,
+                                        user_id, user_isStaff)
+            elif fmt == "csv":
+                data_generator = all_content_csv_generator(parsed_queries, user_id, user_isStaff)
+                nrows = write_csv_zip(zipfile_obj, basename + ".csv", data_generator())
+            else:
+                encoder = get_encoder(fmt)
+                pages_generator = all_content_pages_generator(parsed_queries, user_id, user_isStaff)
+                nrows = write_pages_zip(zipfile_obj, f"{basename}.{encoder.extension}",
+                                        encoder, pages_generator())
+            data_size = sum(info.file_size for info in zipfile_obj.infolist())
+
+        zipstream.seek(0)
+        zipped_data = zipstream.read()
 
     send_zipped_large_download_email(zip_filename, zipped_data, email)
-    logger.info("Sent Email to %s (csv: %d, zip: %d)",
-                email, len(csv_data), len(zipped_data))
+    logger.info("Sent Email to %s (rows: %d, data: %d, zip: %d)",
+                email, nrows, data_size, len(zipped_data))
 
 def download_all_queries_csv_task(data, request):
     task = _download_all_queries_csv(data, request.user.id, request.user.is_staff, request.user.email)
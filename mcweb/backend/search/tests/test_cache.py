@@ -0,0 +1,77 @@
+import threading
+import time
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from util import cache as util_cache
+
+PREFIX = "test-cache"
+
+class CachedCallTest(SimpleTestCase):
+
+    def setUp(self):
+        self.key, _ = util_cache._cache_key(PREFIX, (), {})
+        cache.delete(self.key)
+        cache.delete(util_cache._lock_key(self.key))
+        util_cache.local_cache.clear()
+
+    def tearDown(self):
+        cache.delete(self.key)
+        cache.delete(util_cache._lock_key(self.key))
+        util_cache.local_cache.clear()
+
+    def _call(self, fn):
+        return util_cache.cached_function_call(fn, PREFIX, 60)
+
+    def test_cached_zero(self):
+        self.assertEqual(self._call(lambda: 0), (0, False))
+        util_cache.local_cache.clear()
+        fn = mock.Mock(return_value=1)
+        self.assertEqual(self._call(fn), (0, True))
+        fn.assert_not_called()
+
+    def test_waiter_sees_cached_zero(self):
+        lock = util_cache._lock(self.key)
+
+        def fill():
+            time.sleep(0.2)
+            util_cache._set(self.key, 0, 60)
+            util_cache._unlock(lock, PREFIX)
+
+        threading.Thread(target=fill).start()
+        t0 = time.monotonic()
+        entry = util_cache._wait_for(self.key, 10)
+        self.assertIsNotNone(entry)
+        self.assertEqual(entry.value, 0)
+        self.assertLess(time.monotonic() - t0, 5)
+
+    def test_waiter_stops_when_lock_released(self):
+        lock = util_cache._lock(self.key)
+        threading.Timer(0.2, util_cache._unlock, (lock, PREFIX)).start()
+        t0 = time.monotonic()
+        self.assertIsNone(util_cache._wait_for(self.key, 10))
+        self.assertLess(time.monotonic() - t0, 5)
+
+    def test_legacy_bare_value(self):
+        cache.set(self.key, [1, 2, 3], 60) # written before CacheEntry
+        fn = mock.Mock()
+        self.assertEqual(self._call(fn), ([1, 2, 3], True))
+        fn.assert_not_called()
+        # and now in local tier
+        self.assertEqual(util_cache.local_cache.get(self.key), [1, 2, 3])
+
+class LocalCacheTest(SimpleTestCase):
+
+    def test_total_bytes(self):
+        local = util_cache.LocalCache(max_entries=100, max_bytes=1000,
+                                      max_total_bytes=2500, seconds=60)
+        for i in range(5):
+            local.set(str(i), b"x" * 900, 60)
+        stats = local.stats()
+        self.assertLessEqual(stats["bytes"], 2500)
+        self.assertEqual(stats["entries"], 2)
+        # oldest evicted first
+        self.assertIsNone(local.get("0"))
+        self.assertIsNotNone(local.get("4"))
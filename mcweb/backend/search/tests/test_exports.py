@@ -0,0 +1,123 @@
+import csv
+import datetime as dt
+import gzip
+import io
+import os
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from ..exports import FileExportStore, delete_old_jobs, read_job, run_job
+from ..models import ExportJob
+
+PAGES = 5
+PAGE_SIZE = 3
+
+class FakeProvider:
+    """
+    returns PAGES pages of PAGE_SIZE stories;
+    raises exception fetching page `fail_page` (once)
+    """
+    def __init__(self, fail_page: int = -1):
+        self.fail_page = fail_page
+        self.calls = 0
+
+    def paged_items(self, query, start_date, end_date, pagination_token=None, **kwargs):
+        page = int(pagination_token or 0)
+        self.calls += 1
+        if page == self.fail_page:
+            self.fail_page = -1
+            raise RuntimeError("worker crash")
+        stories = [{"id": f"{query}-{page}-{i}", "title": f"story {i}"} for i in range(PAGE_SIZE)]
+        token = str(page + 1) if page + 1 < PAGES else None
+        return stories, token
+
+def fake_pq(payload, session_id):
+    return SimpleNamespace(query_str=payload["query"], provider_props={},
+                           provider_name="fake", start_date=None, end_date=None)
+
+class FakeQuota:
+    """
+    QuotaAccumulator stand-in: counts hits written by flush
+    """
+    def __init__(self) -> None:
+        self.pending = 0
+        self.charged = 0
+
+    def __call__(self, user_id, is_staff, auto_flush=True):
+        self.pending = 0        # new accumulator for each run
+        return self
+
+    def add(self, provider: str, amount: int = 1) -> None:
+        self.pending += amount
+
+    def flush(self) -> None:
+        self.charged += self.pending
+        self.pending = 0
+
+class ExportJobTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = FileExportStore(self.tmpdir.name)
+        user = User.objects.create(username="exporter", email="exporter@example.com")
+        self.job = ExportJob.objects.create(user=user, email=user.email, basename="test",
+                                            queries=[{"query": "q1"}, {"query": "q2"}])
+        self.quota = FakeQuota()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _run(self, provider):
+        with mock.patch("backend.search.exports.pq_provider", return_value=provider), \
+             mock.patch("backend.search.exports.parsed_query_from_dict", fake_pq), \
+             mock.patch("backend.search.exports.QuotaAccumulator", self.quota), \
+             mock.patch("backend.search.exports.send_export_ready_email"):
+            run_job(self.job, self.store, chunk_rows=2*PAGE_SIZE)
+
+    def _rows(self):
+        data = b"".join(read_job(self.job, self.store))
+        return list(csv.reader(io.StringIO(gzip.decompress(data).decode())))
+
+    def test_export(self):
+        self._run(FakeProvider())
+        rows = self._rows()
+        self.assertEqual(rows[0], ["id", "title"])
+        self.assertEqual(len(rows) - 1, 2*PAGES*PAGE_SIZE)
+        self.assertEqual(self.job.rows, 2*PAGES*PAGE_SIZE)
+        self.assertEqual(self.job.state, ExportJob.States.DONE)
+
+    def test_resume(self):
+        provider = FakeProvider(fail_page=3)
+        with self.assertRaises(RuntimeError):
+            self._run(provider)
+        job = ExportJob.objects.get(id=self.job.id)
+        self.assertEqual(job.state, ExportJob.States.RUNNING)
+        self.assertEqual(job.pagination_token, "2") # checkpoint after two pages
+        self.assertEqual(job.rows, 2*PAGE_SIZE)
+
+        # resume from saved checkpoint
+        self.job = job
+        self._run(provider)
+        ids = [row[0] for row in self._rows()[1:]]
+        self.assertEqual(len(ids), 2*PAGES*PAGE_SIZE)
+        self.assertEqual(len(set(ids)), len(ids)) # no duplicates
+        # pages 0 and 1 not refetched (4 calls for first run, 3+5 for second)
+        self.assertEqual(provider.calls, 4 + 3 + PAGES)
+        # pages after the checkpoint only charged once
+        self.assertEqual(self.quota.charged, 2*PAGES)
+
+    def test_delete_old_jobs(self):
+        self._run(FakeProvider())
+        job_dir = os.path.join(self.tmpdir.name, str(self.job.id))
+        self.assertTrue(os.listdir(job_dir))
+        self.assertEqual(delete_old_jobs(self.store, days=1), 0)
+
+        ExportJob.objects.filter(id=self.job.id).update(
+            modified_at=self.job.modified_at - dt.timedelta(days=2))
+        self.assertEqual(delete_old_jobs(self.store, days=1), 1)
+        self.assertFalse(ExportJob.objects.filter(id=self.job.id).exists())
+        self.assertFalse(os.path.exists(job_dir))
@@ -0,0 +1,38 @@
+import datetime as dt
+
+from django.test import SimpleTestCase
+
+from ..formats import get_encoder
+
+def _page(**values) -> list[dict]:
+    return [{"id": str(i), **{k: v[i] for k, v in values.items()}}
+            for i in range(len(next(iter(values.values()))))]
+
+class ParquetEncoderTest(SimpleTestCase):
+
+    def _read(self, data: bytes):
+        import io
+        import pyarrow.parquet as pq
+        return pq.read_table(io.BytesIO(data))
+
+    def test_later_page_types(self):
+        encoder = get_encoder("parquet")
+        data = encoder.encode(_page(n=[1, 2], when=[dt.datetime(2024, 1, 1)] * 2,
+                                    flag=[True, False]))
+        # types differ from first page
+        data += encoder.encode(_page(n=[2.5, "x"], when=["2024-01-02T03:04:05Z", "junk"],
+                                     flag=[1, "yes"]))
+        data += encoder.close()
+        table = self._read(data).to_pydict()
+        self.assertEqual(table["n"], [1.0, 2.0, 2.5, None])
+        self.assertEqual(table["when"][2], dt.datetime(2024, 1, 2, 3, 4, 5))
+        self.assertIsNone(table["when"][3])
+        self.assertEqual(table["flag"], [True, False, True, None])
+        self.assertEqual(encoder.rows, 4)
+
+    def test_no_stories(self):
+        encoder = get_encoder("parquet")
+        data = encoder.close()
+        table = self._read(data)
+        self.assertEqual(table.num_rows, 0)
+        self.assertIn("publish_date", table.column_names)
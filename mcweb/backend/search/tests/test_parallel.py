@@ -0,0 +1,37 @@
+import threading
+
+from django.test import SimpleTestCase
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from ..parallel import interleave
+
+class FailingSlots:
+    """
+    UserSlots stand-in with Redis unavailable
+    """
+    def acquire(self, stop: threading.Event) -> str | None:
+        raise RedisConnectionError("down")
+
+    def refresh(self, token: str) -> None:
+        pass
+
+    def release(self, token: str) -> None:
+        pass
+
+class InterleaveTest(SimpleTestCase):
+
+    def test_acquire_raises(self):
+        result = {}
+
+        def consume():
+            try:
+                list(interleave([range(3), range(3)], threads=2, depth=4,
+                                slots=FailingSlots()))
+            except Exception as e:
+                result["exc"] = e
+
+        consumer = threading.Thread(target=consume, daemon=True)
+        consumer.start()
+        consumer.join(10)
+        self.assertFalse(consumer.is_alive(), "consumer hung")
+        self.assertIsInstance(result.get("exc"), RedisConnectionError)
@@ -22,6 +22,7 @@ urlpatterns = [
     path('download-top-languages-csv', views.download_languages_csv),
     path('download-top-sources-csv', views.download_sources_csv),
     path('send-email-large-download-csv', views.send_email_large_download_csv),
+    path('export/<int:job_id>', views.export_download, name='export-download'),
     path('story-list', views.story_list),
     path('providers', views.providers),
     path('requests', views.recent_requests),
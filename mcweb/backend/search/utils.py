@@ -2,32 +2,46 @@
 import datetime as dt
 import json
 import logging
+import pickle
+import tempfile
 import time
 from collections import defaultdict
-from typing import Any, Callable, Dict, Generator, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+from operator import itemgetter
+from typing import IO, Any, Callable, Dict, Generator, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Tuple
 
 # PyPI
 import constance
 from django.apps import apps
-from django.db.models import F
+from django.db.models import F, QuerySet
 
 # no longer in PyPI:
 from mc_providers import provider_by_name, provider_name, ContentProvider, PLATFORM_SOURCE_MEDIA_CLOUD,\
     PLATFORM_SOURCE_WAYBACK_MACHINE, PLATFORM_ONLINE_NEWS
 
 # mcweb
-from settings import ALL_URLS_CSV_EMAIL_MAX, ALL_URLS_CSV_EMAIL_MIN
+from settings import ALL_URLS_CSV_EMAIL_MAX, ALL_URLS_CSV_EMAIL_MIN, CSV_PREFETCH_PAGES, DOWNLOAD_USER_QUERIES
+
+# mcweb/backend/sources
+from ..sources.models import SEARCH_DOMAINS_GENERATION
 
 # mcweb/backend/users
-from ..users.models import QuotaHistory
+from ..users.models import QuotaAccumulator
 
 # mcweb/backend/utils/provider
 from ..util.provider import get_provider
 
+from util.cache import cached_function_call, get_generation
 from util.exceptions import UserValueError
 
+# mcweb/backend/search (local dir)
+from .parallel import END, UserSlots, interleave, prefetch
+
 logger = logging.getLogger(__name__)
 
+# pages for later queries kept in memory up to this size when merging
+# concurrently fetched queries (then spilled to disk):
+SPOOL_BYTES = 16*1024*1024
+
 class ParsedQuery(NamedTuple):
     start_date: dt.datetime
     end_date: dt.datetime
@@ -307,11 +321,20 @@ def _validate_sources_or_collections(input: list[str],
     raise UserValueError(f"invalid {tname}(s): {missing}")
 
 
-def _for_media_cloud(collections: list[str], sources: list[str], all_params: dict) -> dict:
-    # pull in at runtime, rather than outside class, so we can make sure the models are loaded
+def _media_cloud_union(collections: list[str], sources: list[str],
+                       materialized: bool = True) -> QuerySet:
+    """
+    return UNION query returning (unique) "name" and "uss" (url_search_string)
+    for selected sources (and their alternative domains) and for the sources
+    (and their alternative domains) in selected collections.
+
+    If `materialized` is True, collection domains are read from the
+    CollectionDomain table, else Source/collection/AlternativeDomain
+    tables are joined (used by collection-domains-benchmark command).
+    """
     Source = apps.get_model('sources', 'Source')
-    Collection = apps.get_model('sources', 'Collection')
     AlternativeDomain = apps.get_model('sources', 'AlternativeDomain')
+    CollectionDomain = apps.get_model('sources', 'CollectionDomain')
 
     # 0. set up base queries
 
@@ -330,10 +353,6 @@ def _for_media_cloud(collections: list[str], sources: list[str], all_params: dic
                   .annotate(uss=F('url_search_string'))
                   .values(*union_cols))
 
-    coll_srcs = news_srcs.filter(collections__id__in=collections)
-    srcs_by_coll_id = coll_srcs.annotate(uss=F('url_search_string'))\
-                               .values(*union_cols)
-
     # alternate domain table base query: need to alias the "domain"
     # column to "name" to match Source table for UNIONification, this
     # causes it to appear last in results, so url_search_string is
@@ -342,24 +361,32 @@ def _for_media_cloud(collections: list[str], sources: list[str], all_params: dic
                                               uss=F('url_search_string'))\
                                     .values(*union_cols)
 
-    # 1: Validate inputs (if enabled)
-    if sources:
-        _validate_sources_or_collections(sources, Source,
-                                             Source.SourcePlatforms.ONLINE_NEWS)
-
-    if collections:
-        _validate_sources_or_collections(collections, Collection,
-                                             Collection.CollectionPlatforms.ONLINE_NEWS)
-
-    # 2: UNION the four queries: src by src/coll id, alts by src/coll id
-
     # Using UNION means we pass one query and get all the results at once:
     # * avoiding multiple database round trips (the "1+N problem")
     # * queries can be run in parallel if the SQL optimizer chooses
     # * using OR in WHERE clause can stop use of indicices
     # * filters duplicate results
 
-    union_queryset = srcs_by_id.union(
+    if materialized:
+        # CollectionDomain has collection sources AND their alternative
+        # domains (same aliasing as AlternativeDomain above)
+        coll_domains = CollectionDomain.objects\
+                                       .filter(collection_id__in=collections)\
+                                       .annotate(name=F('domain'),
+                                                 uss=F('url_search_string'))\
+                                       .values(*union_cols)
+        return srcs_by_id.union(
+            coll_domains,
+            # AlternativeDomains by source ids:
+            alts.filter(source_id__in=sources)
+        )
+
+    # UNION the four queries: src by src/coll id, alts by src/coll id
+    coll_srcs = news_srcs.filter(collections__id__in=collections)
+    srcs_by_coll_id = coll_srcs.annotate(uss=F('url_search_string'))\
+                               .values(*union_cols)
+
+    return srcs_by_id.union(
         srcs_by_coll_id,
         # AlternativeDomains by source ids:
         alts.filter(source_id__in=sources),
@@ -367,6 +394,59 @@ def _for_media_cloud(collections: list[str], sources: list[str], all_params: dic
         alts.filter(source_id__in=coll_srcs)
     )
 
+def _for_media_cloud(collections: list[str], sources: list[str], all_params: dict) -> dict:
+    """
+    return provider properties for MediaCloud searches.
+
+    The (database) resolution of collection & source ids to domains
+    and url_search_strings is cached under a generation counter that
+    is bumped by signal handlers in sources/models.py whenever a
+    Source, Collection or AlternativeDomain changes.
+    """
+    # sorted, unique, so the same selection always has the same key
+    coll_ids = ",".join(sorted(set(map(str, collections))))
+    src_ids = ",".join(sorted(set(map(str, sources))))
+
+    # validation setting passed for cache key: changes outcome
+    props, cached = cached_function_call(
+        _media_cloud_domains, "search-domains", None,
+        get_generation(SEARCH_DOMAINS_GENERATION),
+        constance.config.VALIDATE_SEARCH_IDS,
+        coll_ids, src_ids)
+
+    # copy (cached value may be shared) and
+    # add in other supported params
+    props = props.copy()
+    _copy_media_cloud_extra_props(props, all_params)
+    return props
+
+def _media_cloud_domains(generation: int, validate: int,
+                         coll_ids: str, src_ids: str) -> dict:
+    """
+    turn comma separated collection and source ids into
+    (frozen) domains and url_search_strings provider properties.
+    called via cached_function_call: generation and validate
+    are only used in the cache key.
+    """
+    collections = _listify(coll_ids)
+    sources = _listify(src_ids)
+
+    # pull in at runtime, rather than outside class, so we can make sure the models are loaded
+    Source = apps.get_model('sources', 'Source')
+    Collection = apps.get_model('sources', 'Collection')
+
+    # 1: Validate inputs (if enabled)
+    if sources:
+        _validate_sources_or_collections(sources, Source,
+                                             Source.SourcePlatforms.ONLINE_NEWS)
+
+    if collections:
+        _validate_sources_or_collections(collections, Collection,
+                                             Collection.CollectionPlatforms.ONLINE_NEWS)
+
+    # 2: make UNION query
+    union_queryset = _media_cloud_union(collections, sources)
+
     # 3: run the UNION query, collect parent domains, save child sources.
 
     # unique parent domains without url_search_string, domain set is
@@ -407,19 +487,15 @@ def _for_media_cloud(collections: list[str], sources: list[str], all_params: dic
     # 5. assemble dict of provider parameters:
     props = {}
     if domains:
-        # repr used to generate cache key;
-        # consider conversion to list if ordering proves to be an issue
-        props["domains"] = domains
+        # frozen so util.cache.set_digest (for cache keys) is
+        # computed once, and reused for every call in a request
+        props["domains"] = frozenset(domains)
 
     if url_search_strings:
-        # repr used to generate cache key
-        # defaultdict repr is uglier than plain dict:
-        # "defaultdict(<class 'set'>, {....})"
-        # but is ordered, and hashed before use
-        props["url_search_strings"] = url_search_strings
-
-    # 6. add in other supported params
-    _copy_media_cloud_extra_props(props, all_params)
+        # frozen for util.cache.set_digest (see above)
+        props["url_search_strings"] = {
+            domain: frozenset(uss) for domain, uss in url_search_strings.items()
+        }
 
     return props
 
@@ -429,26 +505,122 @@ def filename_timestamp() -> str:
     """
     return time.strftime("%Y%m%d%H%M%S", time.localtime())
 
+def story_row_getter(columns: list[str]) -> Callable[[dict], tuple]:
+    """
+    return function to project a story dict into a CSV row tuple,
+    with values in columns order (column order is computed once per
+    download, rather than sorting each story's items).
+    """
+    getter = itemgetter(*columns)
+    if len(columns) == 1:   # itemgetter with one key returns a value
+        return lambda story: (getter(story),)
+
+    def row(story: dict) -> tuple:
+        try:
+            return getter(story)
+        except KeyError:    # story missing a column
+            return tuple(story.get(col) for col in columns)
+    return row
+
+def _query_pages(pq: ParsedQuery) -> Iterable[list[dict]]:
+    provider = pq_provider(pq)
+    return provider.all_items(f"({pq.query_str})", pq.start_date, pq.end_date, **pq.provider_props)
+
+def all_content_query_pages(pqs: list[ParsedQuery], user_id, is_staff) -> Iterator[tuple[int, list[dict] | None]]:
+    """
+    fetch pages of stories for all queries concurrently (no more than
+    DOWNLOAD_USER_QUERIES queries at a time for a user, across all
+    processes), returning (query index, page) in the order pages
+    arrive, and (query index, None) when a query is done.
+
+    Quota is charged here, in the caller's thread, as each page arrives
+    (written to the database every QuotaAccumulator.FLUSH_SECONDS,
+    and when done).
+    """
+    slots = UserSlots("download", user_id, DOWNLOAD_USER_QUERIES)
+    with QuotaAccumulator(user_id, is_staff) as quota:
+        for i, page in interleave([_query_pages(pq) for pq in pqs], DOWNLOAD_USER_QUERIES,
+                                  max(CSV_PREFETCH_PAGES, 1), slots):
+            if page is END:
+                yield i, None
+            else:
+                quota.add(pqs[i].provider_name)
+                yield i, page
+
+def _unspool(spool: IO[bytes]) -> Iterator[list[dict]]:
+    spool.seek(0)
+    while True:
+        try:
+            yield pickle.load(spool)
+        except EOFError:
+            spool.close()
+            return
+
+def _merged_pages(pqs: list[ParsedQuery], user_id, is_staff) -> Iterator[list[dict]]:
+    """
+    pages from all queries fetched concurrently, returned in query
+    order: pages that arrive for a later query are spooled (pickled)
+    to a temporary file until all earlier queries are done.
+    """
+    spools: dict[int, IO[bytes]] = {}
+    done = set()
+    current = 0                 # query being returned
+    try:
+        for i, page in all_content_query_pages(pqs, user_id, is_staff):
+            if page is None:
+                done.add(i)
+            elif i == current:
+                yield page
+            else:
+                if i not in spools:
+                    spools[i] = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+                pickle.dump(page, spools[i])
+
+            while current in done:
+                current += 1
+                if current in spools:
+                    yield from _unspool(spools.pop(current))
+    finally:
+        for spool in spools.values():
+            spool.close()
+
+def _sequential_pages(pqs: list[ParsedQuery], user_id, is_staff) -> Iterator[list[dict]]:
+    with QuotaAccumulator(user_id, is_staff) as quota:
+        for pq in pqs:
+            # fetch next page(s) while current page is written
+            for page in prefetch(_query_pages(pq), CSV_PREFETCH_PAGES):
+                quota.add(pq.provider_name)
+                yield page
+
+def all_content_pages_generator(pqs: list[ParsedQuery], user_id, is_staff) -> Callable[[], Iterator[list[dict]]]:
+    """
+    returns function returning generator for pages of stories
+    from all queries (in query order).
+    """
+    def pages_generator() -> Iterator[list[dict]]:
+        if len(pqs) > 1 and DOWNLOAD_USER_QUERIES > 1:
+            return _merged_pages(pqs, user_id, is_staff)
+        return _sequential_pages(pqs, user_id, is_staff)
+    return pages_generator
+
 def all_content_csv_generator(pqs: list[ParsedQuery], user_id, is_staff) -> Callable[[],Generator[list, None, None]]:
     """
     returns function returning generator for "total attention" CSV file
-    with rows from all queries.
+    with rows from all queries (in query order).
     used for both immediate CSV download (download_all_content_csv)
     and emailed CSV (download_all_large_content_csv)
     """
+    pages_generator = all_content_pages_generator(pqs, user_id, is_staff)
+
     def data_generator() -> Generator[list, None, None]:
         # phil: moved outside per-query loop (so headers appear once)
-        first_page = True
-        for pq in pqs:
-            provider = pq_provider(pq)
-            result = provider.all_items(f"({pq.query_str})", pq.start_date, pq.end_date, **pq.provider_props)
-            for page in result:
-                QuotaHistory.increment(user_id, is_staff, pq.provider_name)
-                if first_page:  # send back column names, which differ by platform
-                    yield sorted(page[0].keys())
-                    first_page = False
-                for story in page:
-                    yield [v for k, v in sorted(story.items())]
+        getter = None
+        for page in pages_generator():
+            if getter is None:  # send back column names, which differ by platform
+                columns = sorted(page[0].keys())
+                getter = story_row_getter(columns)
+                yield columns
+            yield from map(getter, page)
     return data_generator
 
 def all_content_csv_basename(pqs: list[ParsedQuery]) -> str:
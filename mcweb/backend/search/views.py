@@ -1,6 +1,7 @@
 import csv
 import datetime as dt
 import json
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 import logging
 import time
 import traceback as tb
@@ -10,8 +11,8 @@ from typing import Type
 import mc_providers
 import requests
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseBadRequest, HttpResponseForbidden, HttpResponse
-from django_ratelimit.decorators import ratelimit
+from django.http import HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound, HttpResponse, StreamingHttpResponse
+from django.urls import reverse
 from django_ratelimit.exceptions import Ratelimited
 from django.views.decorators.http import require_http_methods
 from mc_providers.exceptions import (
@@ -30,12 +31,14 @@ from util.cache import cache_by_kwargs, mc_providers_cacher
 from util.csvwriter import CSVWriterHelper
 from util.stats import api_stats
 from util.exceptions import HttpResponseUnprocessableEntity, HttpResponseRatelimited, UserValueError
+from util.ratelimit_callables import query_ratelimit
 
 # mcweb/backend/search (local dir)
 from .utils import (
     ParsedQuery,
     all_content_csv_basename,
     all_content_csv_generator,
+    all_content_pages_generator,
     filename_timestamp,
     parse_query,
     parse_query_params,
@@ -45,6 +48,10 @@ from .utils import (
     request_session_id
 )
 from .tasks import download_all_large_content_csv, download_all_queries_csv_task
+from .formats import encoded_chunks, get_encoder
+from .models import ExportJob
+from .parallel import run_parallel
+from . import counts, exports
 from .read_requests import read_requests, make_table
 
 # mcweb/backend/users
@@ -54,6 +61,7 @@ from backend.users.exceptions import OverQuotaException
 
 # mcweb/backend/util
 import backend.util.csv_stream as csv_stream
+import backend.util.json_stream as json_stream
 
 TRACE_JSON_RESPONSE = False
 
@@ -69,10 +77,10 @@ def json_response(value: dict | str | None, *, _class: Type[HttpResponse] = Http
     It's not intended that _class will be used by individual view
     functions, hence the leading underscore.
     """
-    # NOTE! always passing default=str
-    j = json.dumps(value, default=str)
+    # NOTE! always encodes values orjson/json don't handle with str
+    j = json_stream.dumps(value)
     if TRACE_JSON_RESPONSE:
-        logger.debug("json_response %d %s", _class.status_code, j)
+        logger.debug("json_response %d %s", _class.status_code, j.decode())
     return _class(j, content_type="application/json")
 
 def error_response(msg: str, *, exc: Exception | None = None,
@@ -137,7 +145,8 @@ def handle_provider_errors(func):
         # that maps exception class names to a list of actions/conditions!
         try:
             return func(request)
-        except (requests.exceptions.ConnectionError, TemporaryProviderException) as e:
+        except (requests.exceptions.ConnectionError, TemporaryProviderException,
+                FuturesTimeoutError) as e:
             # Temporary conditions
             return error_response(TEMPORARY_ERROR_MESSAGE, exc=e, temporary=True)
         except (OverQuotaException, ProviderParseException) as e:
@@ -209,16 +218,23 @@ def _qs(pq: ParsedQuery) -> str:
 @authentication_classes([TokenAuthentication, SessionAuthentication])
 @permission_classes([IsAuthenticated])
 @handle_429
-@ratelimit(key="user", rate='util.ratelimit_callables.query_rate')
+@query_ratelimit
 def total_count(request):
     pq = parse_query(request)
     provider = pq_provider(pq)
     QuotaHistory.check_quota(request.user.id, request.user.is_staff, pq.provider_name)
-    relevant_count = provider.count(_qs(pq), pq.start_date, pq.end_date, **pq.provider_props)
-    try:
-        total_content_count = provider.count(provider.everything_query(), pq.start_date, pq.end_date, **pq.provider_props)
-    except QueryingEverythingUnsupportedQuery as e:
-        total_content_count = None
+
+    def relevant():
+        return provider.count(_qs(pq), pq.start_date, pq.end_date, **pq.provider_props)
+
+    def total():
+        try:
+            # shared by all users, assembled from cached daily counts:
+            return counts.total_count(provider, pq)
+        except QueryingEverythingUnsupportedQuery as e:
+            return None
+
+    relevant_count, total_content_count = run_parallel(relevant, total)
     QuotaHistory.increment(request.user.id, request.user.is_staff, pq.provider_name)
     return json_response({"count": {"relevant": relevant_count, "total": total_content_count}})
 
@@ -230,16 +246,16 @@ def total_count(request):
 @authentication_classes([TokenAuthentication, SessionAuthentication])
 @permission_classes([IsAuthenticated])
 @handle_429
-@ratelimit(key="user", rate='util.ratelimit_callables.query_rate')
+@query_ratelimit
 def count_over_time(request):
     pq = parse_query(request)
     provider = pq_provider(pq)
     QuotaHistory.check_quota(request.user.id, request.user.is_staff, pq.provider_name)
     try:
-        results = provider.normalized_count_over_time(_qs(pq), pq.start_date, pq.end_date, **pq.provider_props)
-    except UnsupportedOperationException:
+        results = counts.normalized_count_over_time(provider, pq)
+    except (UnsupportedOperationException, QueryingEverythingUnsupportedQuery):
         # for platforms that don't support querying over time
-        results = provider.count_over_time(_qs(pq), pq.start_date, pq.end_date, **pq.provider_props)
+        results = counts.count_over_time(provider, pq)
     response = results
     QuotaHistory.increment(
         request.user.id, request.user.is_staff, pq.provider_name)
@@ -252,7 +268,7 @@ def count_over_time(request):
 @authentication_classes([TokenAuthentication, SessionAuthentication])
 @permission_classes([IsAuthenticated])
 @handle_429
-@ratelimit(key="user", rate='util.ratelimit_callables.query_rate')
+@query_ratelimit
 def count_by_source_over_interval(request):
     pq, params = parse_query_params(request)
     provider = pq_provider(pq)
@@ -293,24 +309,21 @@ def count_by_source_over_interval(request):
             f"Too many sources*time-buckets selected for this query (max {max_buckets})"
         )
 
-    matching = provider.two_d_aggregation(
-        query=_qs(pq),
-        start_date=pq.start_date,
-        outer_field="publish_date",
-        inner_field="media_name",
-        interval=interval,
-        num_intervals=num_intervals,
-        domains=domains
-    )
-    totals = provider.two_d_aggregation(
-        query='*',
-        start_date=pq.start_date,
-        outer_field="publish_date",
-        inner_field="media_name",
-        interval=interval,
-        num_intervals=num_intervals,
-        domains=domains
-    )
+    def aggregation(query: str):
+        return provider.two_d_aggregation(
+            query=query,
+            start_date=pq.start_date,
+            outer_field="publish_date",
+            inner_field="media_name",
+            interval=interval,
+            num_intervals=num_intervals,
+            domains=domains
+        )
+
+    matching, totals = run_parallel(
+        lambda: aggregation(_qs(pq)),
+        # shared by all users:
+        lambda: counts.two_d_totals(provider, pq, interval, num_intervals, domains))
 
     shaped_data = []
     for media in domains:
@@ -334,7 +347,7 @@ def count_by_source_over_interval(request):
 @authentication_classes([TokenAuthentication, SessionAuthentication])
 @permission_classes([IsAuthenticated])
 @handle_429
-@ratelimit(key="user", rate='util.ratelimit_callables.query_rate')
+@query_ratelimit
 def sample(request):
     pq = parse_query(request)
     provider = pq_provider(pq)
@@ -349,7 +362,7 @@ def sample(request):
 @authentication_classes([TokenAuthentication, SessionAuthentication])
 @permission_classes([IsAuthenticated])
 @handle_429
-@ratelimit(key="user", rate='util.ratelimit_callables.query_rate')
+@query_ratelimit
 def story_detail(request):
     pq, params = parse_query_params(request, is_search=False) # unlikely to handle POST!
     QuotaHistory.check_quota(request.user.id, request.user.is_staff, pq.provider_name)
@@ -368,14 +381,14 @@ def story_detail(request):
 @authentication_classes([TokenAuthentication, SessionAuthentication])
 @permission_classes([IsAuthenticated])
 @handle_429
-@ratelimit(key="user", rate='util.ratelimit_callables.query_rate')
+@query_ratelimit
 def sources(request):
     pq = parse_query(request)
     provider = pq_provider(pq)
     QuotaHistory.check_quota(request.user.id, request.user.is_staff, pq.provider_name)
     response = provider.sources(_qs(pq), pq.start_date, pq.end_date, 10, **pq.provider_props)
     QuotaHistory.increment(request.user.id, request.user.is_staff, pq.provider_name, 4)
-    return json_response({"sources": response})
+    return json_stream.streaming_json_response({}, "sources", response)
 
 @require_http_methods(["GET"])
 @action(detail=False)
@@ -409,7 +422,7 @@ def download_sources_csv(request):
 @authentication_classes([TokenAuthentication, SessionAuthentication])
 @permission_classes([IsAuthenticated])
 @handle_429
-@ratelimit(key="user", rate='util.ratelimit_callables.query_rate')
+@query_ratelimit
 def languages(request):
     pq = parse_query(request)
     provider = pq_provider(pq)
@@ -446,7 +459,7 @@ def download_languages_csv(request):
 @authentication_classes([TokenAuthentication])  # API-only method for now
 @permission_classes([IsAuthenticated])
 @handle_429
-@ratelimit(key="user", rate='util.ratelimit_callables.query_rate')
+@query_ratelimit
 def story_list(request):
     pq = parse_query(request)
     provider = pq_provider(pq)
@@ -471,7 +484,7 @@ def story_list(request):
     # some untested value(s) of sort_field might cause pathological behavior!
     page, pagination_token = provider.paged_items(_qs(pq), pq.start_date, pq.end_date, **pq.provider_props, sort_field="indexed_date")
     QuotaHistory.increment(request.user.id, request.user.is_staff, pq.provider_name, 1)
-    return json_response({"stories": page, "pagination_token": pagination_token})
+    return json_stream.streaming_json_response({"pagination_token": pagination_token}, "stories", page)
 
 
 @api_stats  # PLEASE KEEP FIRST!
@@ -480,14 +493,14 @@ def story_list(request):
 @authentication_classes([TokenAuthentication, SessionAuthentication])
 @permission_classes([IsAuthenticated])
 @handle_429
-@ratelimit(key="user", rate='util.ratelimit_callables.query_rate')
+@query_ratelimit
 def words(request):
     pq = parse_query(request)
     provider = pq_provider(pq)
     QuotaHistory.check_quota(request.user.id, request.user.is_staff, pq.provider_name)
     response = provider.words(_qs(pq), pq.start_date, pq.end_date, **pq.provider_props)
     QuotaHistory.increment(request.user.id, request.user.is_staff, pq.provider_name, 4)
-    return json_response({"words": response})
+    return json_stream.streaming_json_response({}, "words", response)
                         
 
 
@@ -519,11 +532,10 @@ def download_counts_over_time_csv(request):
     provider = pq_provider(pq)
     QuotaHistory.check_quota(request.user.id, request.user.is_staff, pq.provider_name)
     try:
-        data = provider.normalized_count_over_time(
-            _qs(pq), pq.start_date, pq.end_date, **pq.provider_props)
+        data = counts.normalized_count_over_time(provider, pq)
         normalized = True
-    except UnsupportedOperationException:
-        data = provider.count_over_time(pq.query_str, pq.start_date, pq.end_date, **pq.provider_props)
+    except (UnsupportedOperationException, QueryingEverythingUnsupportedQuery):
+        data = counts.count_over_time(provider, pq)
         normalized = False
     QuotaHistory.increment(request.user.id, request.user.is_staff, pq.provider_name, 2)
     filename = "mc-{}-{}-counts".format(
@@ -544,9 +556,21 @@ def download_counts_over_time_csv(request):
 @action(detail=False)
 def download_all_content_csv(request):
     parsed_queries = parsed_query_state(request) # handles POST!
-    data_generator = all_content_csv_generator(parsed_queries, request.user.id, request.user.is_staff)
     filename = all_content_csv_basename(parsed_queries)
-    return csv_stream.streaming_csv_response(data_generator, filename)
+    fmt = request.GET.get("format", "csv") # see formats.py
+    if fmt == "csv":
+        data_generator = all_content_csv_generator(parsed_queries, request.user.id, request.user.is_staff)
+        return csv_stream.streaming_csv_response(data_generator, filename)
+
+    try:
+        encoder = get_encoder(fmt)
+    except ValueError as e:
+        return error_response(str(e))
+    pages_generator = all_content_pages_generator(parsed_queries, request.user.id, request.user.is_staff)
+    response = StreamingHttpResponse(encoded_chunks(encoder, pages_generator()),
+                                     content_type=encoder.content_type)
+    response['Content-Disposition'] = f"attachment; filename={filename}.{encoder.extension}"
+    return response
 
 
 # called by frontend sendTotalAttentionDataEmail
@@ -578,12 +602,35 @@ def send_email_large_download_csv(request):
     # was sending empty response regardless
     if total >= ALL_URLS_CSV_EMAIL_MIN and total <= ALL_URLS_CSV_EMAIL_MAX:
         # task arguments must be JSONifiable, so must pass queryState instead of pqs
-        response = download_all_large_content_csv(queryState, request.user.id, request.user.is_staff, email)
+        def url_func(job_id: int) -> str:
+            return request.build_absolute_uri(reverse("export-download", args=[job_id]))
+        # "split": file per query in zip, "format": see formats.py
+        try:
+            response = download_all_large_content_csv(queryState, request.user.id, request.user.is_staff, email,
+                                                      url_func, bool(payload.get("split")),
+                                                      payload.get("format", "csv"))
+        except ValueError as e:
+            return error_response(str(e))
         return json_response(response)
     else:
         return error_response("Total {} not between {} and {}".format(
             total, ALL_URLS_CSV_EMAIL_MIN, ALL_URLS_CSV_EMAIL_MAX))
 
+# link emailed when an export job is done
+@api_stats  # PLEASE KEEP FIRST!
+@login_required(redirect_field_name='/auth/login')
+@require_http_methods(["GET"])
+def export_download(request, job_id: int):
+    job = ExportJob.objects.filter(id=job_id, state=ExportJob.States.DONE).first()
+    if not job or (job.user_id != request.user.id and not request.user.is_staff):
+        return error_response("Export not found", response_type=HttpResponseNotFound)
+    store = exports.get_store()
+    if not store:
+        return error_response("Exports not configured", response_type=HttpResponseNotFound)
+    response = StreamingHttpResponse(exports.read_job(job, store), content_type="application/gzip")
+    response['Content-Disposition'] = f"attachment; filename={job.basename}.csv.gz"
+    return response
+
 @login_required(redirect_field_name='/auth/login')
 @require_http_methods(["POST"])
 @action(detail=False)
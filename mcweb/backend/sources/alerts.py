@@ -14,7 +14,6 @@ import logging
 # PyPI:
 import numpy as np
 from django.db.models import QuerySet
-from django.core.paginator import Paginator
 
 # mcweb/util
 from util.send_emails import send_alert_email
@@ -77,8 +76,9 @@ class AlertSystem(MetadataUpdater):
 
         # need ALL of this (prefix and LONG for EACH source???)
         long = f"Source {source.id}: {name} {LONG[level]}"
-        self.alert_dict[level].append(long) # depend on template for newlines
-        self.reports += 1
+        with self.lock:         # may be called from worker threads
+            self.alert_dict[level].append(long) # depend on template for newlines
+            self.reports += 1
         logger.info("%s", long)
 
     def process_sources(self, *,
@@ -177,8 +177,9 @@ class AlertSystem(MetadataUpdater):
             f"(change={pct_text}, median {change['prev_median']:.1f}->{change['curr_median']:.1f}, "
             f"mode {change['prev_mode']}->{change['curr_mode']})"
         )
-        self.alert_dict.setdefault("pelt", []).append(msg)
-        self.reports += 1
+        with self.lock:         # may be called from worker threads
+            self.alert_dict.setdefault("pelt", []).append(msg)
+            self.reports += 1
         logger.info("%s", msg)
 
     def _process_sources_pelt(self, *,
@@ -0,0 +1,64 @@
+"""
+Count ES queries needed to process child sources (sources with
+url_search_string) using one child per domain per query vs. packing
+siblings into each query (MetadataUpdater.CHILD_FILTERS), for
+synthetic domains with a skewed number of children (a few news sites
+split into many sections, and a long tail with one or two).
+"""
+
+import collections
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...models import Source
+from ...task_utils import ChildSourceDict, pop_child_batch
+
+# MetadataUpdater defaults
+MAX_CLAUSE_COUNT = 42100
+CHILD_BATCH_SIZE = MAX_CLAUSE_COUNT // 4
+
+def synthetic_children(domains: int, max_children: int) -> ChildSourceDict:
+    """
+    domain i has max_children/(i+1) children (at least one)
+    """
+    children: ChildSourceDict = collections.defaultdict(list)
+    source_id = 0
+    for i in range(domains):
+        name = f"site{i}.example.com"
+        for j in range(max(1, max_children // (i + 1))):
+            source_id += 1
+            children[name].append(Source(id=source_id, name=name,
+                                         url_search_string=f"{name}/section{j}/*"))
+    return children
+
+class Command(BaseCommand):
+    help = 'Count ES queries for child sources: one per domain per query vs. siblings batched'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--domains", type=int, default=1000,
+                            help="number of parent domains with child sources")
+        parser.add_argument("--max-children", type=int, default=500,
+                            help="children of largest domain")
+        parser.add_argument("--batch-size", type=int, default=CHILD_BATCH_SIZE,
+                            help=f"child_batch_size (default {CHILD_BATCH_SIZE})")
+        parser.add_argument("--rate", type=int, default=100,
+                            help="ES queries per minute (for estimated run time)")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        fmt = "%-10s %8s %10s %8s %10s %10s"
+        print(fmt % ("batching", "children", "batch size", "queries", "max batch", "minutes"))
+        for siblings, size in ((False, batch_size), (True, batch_size // 2)):
+            children = synthetic_children(options["domains"], options["max_children"])
+            total = sum(len(srcs) for srcs in children.values())
+            queries = biggest = 0
+            t0 = time.monotonic()
+            while children:
+                batch = pop_child_batch(children, size, siblings)
+                queries += 1
+                biggest = max(biggest, len(batch))
+            elapsed = time.monotonic() - t0
+            print(fmt % ("siblings" if siblings else "per-domain", total, size,
+                         queries, biggest, f"{queries / options['rate']:.1f}"))
+            self.stderr.write(f"  (batching took {elapsed:.3f} sec)")
@@ -0,0 +1,52 @@
+"""
+Compare search setup for the largest collections using the
+Source/collections/AlternativeDomain UNION vs. the materialized
+CollectionDomain table (see search/utils.py _media_cloud_union)
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from backend.search.utils import _media_cloud_union
+from ...models import Collection
+
+class Command(BaseCommand):
+    help = 'Benchmark collection domain lookup (UNION vs materialized table)'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--collections", type=int, default=10,
+                            help="number of (largest) collections to test")
+        parser.add_argument("--repeat", type=int, default=3,
+                            help="times to run each query (best time reported)")
+
+    def handle(self, *args, **options):
+        repeat = options["repeat"]
+        colls = (Collection.objects
+                 .filter(platform=Collection.CollectionPlatforms.ONLINE_NEWS)
+                 .annotate(nsrcs=Count("source"))
+                 .order_by("-nsrcs")
+                 .values_list("id", "name", "nsrcs")[:options["collections"]])
+
+        def best(materialized: bool, coll_id: int) -> tuple[float, set]:
+            """
+            return best time and rows returned
+            """
+            times = []
+            for i in range(repeat):
+                t0 = time.monotonic()
+                rows = set((row["name"], row["uss"])
+                           for row in _media_cloud_union([coll_id], [], materialized))
+                times.append(time.monotonic() - t0)
+            return min(times), rows
+
+        fmt = "%8s %-40s %8s %8s %10s %10s %6s %s"
+        print(fmt % ("id", "name", "sources", "rows", "union", "table", "ratio", "same"))
+        for coll_id, name, nsrcs in colls:
+            union_sec, union_rows = best(False, coll_id)
+            table_sec, table_rows = best(True, coll_id)
+            ratio = union_sec / table_sec if table_sec else 0
+            print(fmt % (coll_id, name[:40], nsrcs, len(table_rows),
+                         f"{union_sec:.6f}", f"{table_sec:.6f}", f"{ratio:.1f}",
+                         union_rows == table_rows))
@@ -1,5 +1,5 @@
 # mcweb/backend/sources/
-from ...metadata_update import UPDATERS
+from ...metadata_update import UPDATERS, UpdateCombined
 from ...tasks import sources_metadata_update
 from ...task_utils import MetadataUpdaterCommand
 
@@ -16,6 +16,13 @@ class Command(MetadataUpdaterCommand):
             required=True,
             help="Task(s) to perform",
         )
+        parser.add_argument(
+            "--metric", "-M",
+            action="append",
+            choices=UpdateCombined.METRICS.keys(),
+            default=[],
+            help=f"Metric(s) for {UpdateCombined.TASK_NAME} task to compute (default: all)",
+        )
         super().add_arguments(parser)
 
     def long_task_name(self, options: dict):
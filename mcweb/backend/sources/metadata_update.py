@@ -10,7 +10,7 @@ should be imported directly ONLY by tasks.py!
 # standard:
 import datetime as dt
 import logging
-from typing import NamedTuple
+from typing import Any, Callable, NamedTuple
 
 # PyPI
 import mcmetadata
@@ -19,6 +19,7 @@ from django.db.models import QuerySet
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.aggs import A, Filters
 from elasticsearch_dsl.query import Bool, Exists, Range
+from elasticsearch_dsl.utils import AttrDict
 
 import settings
 
@@ -27,7 +28,7 @@ from ..util.tasks import TaskLogContext
 
 # local dir mcweb/backend/sources
 from .action_history import log_action # see NOTE in UpdateSourceLanguage
-from .models import ActionHistory, Source, User
+from .models import ActionHistory, MetadataUpdateTask, Source, User
 from .task_utils import MetadataUpdater, yesterday
 
 logger = logging.getLogger(__name__)
@@ -75,21 +76,28 @@ class UpdateStoriesPerWeek(UpdateTask):
         date_buckets = agg["buckets"]
         for domains in date_buckets.values(): # should loop at most once!
             for source in sources:    # loop over PG query results again
-                # don't overwrite NULL with zero
-                # (keep as signal nothing has ever been seen)
-                weekly_count = domains.get(source.name, None)
-                if weekly_count is None and source.stories_per_week is None:
-                    self.verbose_source(2, "%s: keeping as NULL", source)
-                else:
-                    self.verbose_source(2, "%s: old %r new %d",
-                                        source, source.stories_per_week, weekly_count)
-                    if weekly_count != source.stories_per_week:
-                        # NOTE! no longer using Source.update_stories_per_week!
-                        source.stories_per_week = weekly_count
-                        self.needs_update(source)
-                    else:
-                        self.verbose_source(3, "%s: no change: %d",
-                                            source, weekly_count)
+                if self.set_stories_per_week(source, domains.get(source.name, None)):
+                    self.needs_update(source)
+
+    def set_stories_per_week(self, source: Source, weekly_count: int | None) -> bool:
+        """
+        returns True if source changed
+        """
+        # don't overwrite NULL with zero
+        # (keep as signal nothing has ever been seen)
+        if weekly_count is None and source.stories_per_week is None:
+            self.verbose_source(2, "%s: keeping as NULL", source)
+        else:
+            self.verbose_source(2, "%s: old %r new %s",
+                                source, source.stories_per_week, weekly_count)
+            if weekly_count != source.stories_per_week:
+                # NOTE! no longer using Source.update_stories_per_week!
+                source.stories_per_week = weekly_count
+                return True
+            else:
+                self.verbose_source(3, "%s: no change: %s",
+                                    source, weekly_count)
+        return False
 
 LANG_COUNT_DAYS = 180  # number of days back to examine
 LANG_COUNT_MIN = 10    # min count for top lang within LANG_COUNT_DAYS
@@ -135,46 +143,54 @@ class UpdateSourceLanguage(UpdateTask):
         # of ordered dict indexed by language,
         # of counts (highest count first)
         domains = agg["buckets"]
-        sources_to_update = []
 
+        for source in sources:
+            self.set_language(source, domains.get(source.name, {}))
+
+    def set_language(self, source: Source, langs: dict[str, int]) -> bool:
+        """
+        langs is ordered dict indexed by language of counts
+        (highest count first); saves source if top language
+        has enough stories, and returns True.
+        """
         if self.update:
             counter = self.UPDATED_COUNTER
         else:
             counter = self.FOUND_COUNTER
 
-        for source in sources:
-            langs = domains.get(source.name, {})
-            # should have at most one inner bucket!
-            for lang, count in langs.items():
-                self.verbose_source(3, "%s: %s %d", source, lang, count)
-                # NOTE! looking only at count for top language, NOT percentage of total
-                # (would require another inner bucket, and a custom DSL query)
-                if count >= LANG_COUNT_MIN:
-                    logger.info("%s (%d) %s language %s (count %d)",
-                                self.source_name(source), source.id,
-                                counter, lang, count)
-
-                    # NOTE WELL!!!!  Before you copy this code!!!  This task
-                    # does MANY orders of magnitude less updating than
-                    # stories_per_week or last_story (likely to change live
-                    # sources every week) AND only ever changes a source once,
-                    # so it's reasonable to do updates on a per-source basis,
-                    # since ActionHistory log entries are desired (and probably
-                    # only tenable given the rarity of actions taken), so calling
-                    # Source.save() directly rather than add log_entry creation
-                    # to the batch update process.  Anyone NULLing out the language
-                    # column may get a rude surprise!
-
-                    if self.update:
-                        with transaction.atomic():
-                            source.primary_language = lang
-                            source.save()
-                            log_action(self.user_object, "update-language", ActionHistory.ModelType.SOURCE,
-                                       source.id, source.name, # changes??
-                                       notes=f"Set primary_language to {lang}")
-                    self.counters[counter] += 1
-
-                break           # quit after one (only) inner bucket!
+        # should have at most one inner bucket!
+        for lang, count in langs.items():
+            self.verbose_source(3, "%s: %s %d", source, lang, count)
+            # NOTE! looking only at count for top language, NOT percentage of total
+            # (would require another inner bucket, and a custom DSL query)
+            if count >= LANG_COUNT_MIN:
+                logger.info("%s (%d) %s language %s (count %d)",
+                            self.source_name(source), source.id,
+                            counter, lang, count)
+
+                # NOTE WELL!!!!  Before you copy this code!!!  This task
+                # does MANY orders of magnitude less updating than
+                # stories_per_week or last_story (likely to change live
+                # sources every week) AND only ever changes a source once,
+                # so it's reasonable to do updates on a per-source basis,
+                # since ActionHistory log entries are desired (and probably
+                # only tenable given the rarity of actions taken), so calling
+                # Source.save() directly rather than add log_entry creation
+                # to the batch update process.  Anyone NULLing out the language
+                # column may get a rude surprise!
+
+                if self.update:
+                    with transaction.atomic():
+                        source.primary_language = lang
+                        source.save()
+                        log_action(self.user_object, "update-language", ActionHistory.ModelType.SOURCE,
+                                   source.id, source.name, # changes??
+                                   notes=f"Set primary_language to {lang}")
+                self.counters[counter] += 1
+                return True
+
+            break           # quit after one (only) inner bucket!
+        return False
 
 # call only from tasks.py (via MetadataUpdaterCommand.run_task)
 def sources_metadata_update(*,
@@ -206,10 +222,46 @@ def es_end(allow_future: bool = False):
     else:
         return yesterday()
 
+SITE_AGG = "outer"              # site_agg aggregation name
+
+def site_agg(p, search: Search, sources: list[Source], domains: list[str],
+             url_search_strings: dict[str,list[str]]) -> tuple[Any, Callable[[Source], str]]:
+    """
+    add bucket aggregation with a bucket per source to search:
+    terms by canonical_domain for parent sources, or for child
+    sources (which may share a domain: see MetadataUpdater.CHILD_FILTERS)
+    filters, keyed by source id, using the provider's site filtering.
+
+    returns (aggregation, function returning source's key in site_buckets)
+    """
+    if domains:
+        agg = search.aggs.bucket(SITE_AGG, A("terms", field="canonical_domain",
+                                             size=len(domains)))
+        return agg, lambda source: source.name
+
+    filters = {
+        str(source.id): p._selector_filter_tuple({
+            "domains": [],
+            "url_search_strings": {source.name: [source.url_search_string]}
+        }).query
+        for source in sources
+    }
+    return search.aggs.bucket(SITE_AGG, Filters(filters=filters)), lambda source: str(source.id)
+
+def site_buckets(res) -> dict[str, AttrDict]:
+    """
+    return site_agg buckets from search results, by key
+    """
+    buckets = res.aggregations[SITE_AGG]["buckets"]
+    if isinstance(buckets, AttrDict): # keyed filters
+        return {key: buckets[key] for key in buckets}
+    return {bucket["key"]: bucket for bucket in buckets}
+
 @updater
 class FindLastStory(UpdateTask):
     TASK_NAME = "last_story"
     UPDATE_FIELDS = ["last_story"]
+    CHILD_FILTERS = True
 
     def process_sources(self, *,
                         sources: list[Source],
@@ -217,14 +269,13 @@ class FindLastStory(UpdateTask):
                         url_search_strings: dict[str,list[str]]) -> None:
         """
         called with either a list of domains, and empty url_search strings,
-        or url_search_string with a single dict entry, with value
-        of a list of search strings for a single source.
+        or url_search_strings for a batch of child sources
+        (possibly several per domain).
         """
 
         p = self.p              # mc_provider
 
-        # aggregation names:
-        OUTER = "outer"
+        # aggregation name:
         INNER = "inner"
 
         # XXX nastiness: direct to elasticsearch_dsl using provider method:
@@ -236,38 +287,47 @@ class FindLastStory(UpdateTask):
                                  url_search_strings=url_search_strings)\
                   .extra(size=0) # just aggs
 
-        s = len(domains or url_search_strings)
-        search.aggs.bucket(OUTER, A("terms", field="canonical_domain", size=s))\
-                   .bucket(INNER, "max", field="publication_date")
+        outer, site_key = site_agg(p, search, sources, domains, url_search_strings)
+        outer.bucket(INNER, "max", field="publication_date")
 
         res = p._search(search, "pub-date-max") # name for grafana counter
 
-        # dict by domain of max pub date
-        max_date_by_domain = {
-            outer["key"]: outer[INNER]["value_as_string"]
-            for outer in res.aggregations[OUTER] # list of dicts
+        # dict by site key of max pub date
+        max_date_by_site = {
+            key: outer[INNER]["value_as_string"]
+            for key, outer in site_buckets(res).items()
+            if outer["doc_count"]
         }
 
         for source in sources:
             # NULL out domains with no stories found
-            last_date = last_date_short = max_date_by_domain.get(source.name, None)
-
-            # compare just the date part
-            # (minimizes updates, helpful in debug)
-            if last_date_short:
-                last_date_short = last_date_short[:10] # YYYY-MM-DD
-
-            curr = source.last_story
-            if curr:
-                curr = curr.strftime("%Y-%m-%d")
-
-            if (last_date_short != curr or
-                last_date is None and source.last_story is not None):
-                source.last_story = last_date
+            if self.set_last_story(source, max_date_by_site.get(site_key(source), None)):
                 self.needs_update(source)
-                self.verbose_source(2, "%s: was %s now %s", source, curr, last_date_short)
-            else:
-                self.verbose_source(3, "%s: was %s now %s (no update)", source, curr, last_date_short)
+
+    def set_last_story(self, source: Source, last_date: str | None) -> bool:
+        """
+        last_date is ES publication_date max value_as_string;
+        returns True if source changed
+        """
+        last_date_short = last_date
+
+        # compare just the date part
+        # (minimizes updates, helpful in debug)
+        if last_date_short:
+            last_date_short = last_date_short[:10] # YYYY-MM-DD
+
+        curr = source.last_story
+        if curr:
+            curr = curr.strftime("%Y-%m-%d")
+
+        if (last_date_short != curr or
+            last_date is None and source.last_story is not None):
+            source.last_story = last_date
+            self.verbose_source(2, "%s: was %s now %s", source, curr, last_date_short)
+            return True
+        else:
+            self.verbose_source(3, "%s: was %s now %s (no update)", source, curr, last_date_short)
+            return False
 
 class DateCounts(NamedTuple):
     total: int
@@ -275,6 +335,54 @@ class DateCounts(NamedTuple):
     past_date: int
     future_date: int
 
+ZERO_COUNTS = DateCounts(total=0, no_date=0, past_date=0, future_date=0)
+
+# date_quality_filters bucket names
+# Increment BUCKETS_PER_SOURCE if adding a new filter/bucket!!!
+NO_DATE_BUCKET = "no_date"
+PAST_DATE_BUCKET = "past_date" # too far in past
+FUTURE_DATE_BUCKET = "future_date" # too far in future
+
+def all_dates_search(p, domains: list[str], url_search_strings: dict[str,list[str]]) -> Search:
+    """
+    return aggregation only Search for stories from sites, with no date range
+    """
+    # XXX nastiness: direct to elasticsearch_dsl using provider methods:
+    # even nastier, create search from scratch with no date range,
+    search = Search(using=p._es, index=[p.INDEX_PREFIX + "*"])\
+        .extra(size=0) # just aggs, no hits
+
+    if p._session_id:
+        search = search.params(preference=p._session_id)
+
+    # get DSL for site filtering:
+    t = p._selector_filter_tuple({"domains": domains, "url_search_strings": url_search_strings})
+    return search.filter(t.query)
+
+def date_quality_filters() -> Filters:
+    return Filters(
+        filters={
+            # ES doesn't store fields with null values
+            # (maybe get "has date" count and subtract?)
+            NO_DATE_BUCKET: Bool(must_not=[
+                Exists(field="publication_date")]),
+            PAST_DATE_BUCKET: Range(publication_date={'lt': es_start()}),
+            # NOTE: future dates accepted by mcmetadata/story-indexer are "good"
+            FUTURE_DATE_BUCKET: Range(publication_date={'gt': es_end(True)}),
+        }
+    )
+
+def date_counts(outer: dict, inner: str) -> DateCounts:
+    """
+    outer is a domain bucket, inner the name of its date_quality_filters agg
+    """
+    buckets = outer[inner]["buckets"]
+    return DateCounts(
+        total=outer["doc_count"],
+        no_date=buckets[NO_DATE_BUCKET]["doc_count"],
+        past_date=buckets[PAST_DATE_BUCKET]["doc_count"],
+        future_date=buckets[FUTURE_DATE_BUCKET]["doc_count"])
+
 @updater
 class UpdateTotals(UpdateTask):
     """
@@ -286,6 +394,7 @@ class UpdateTotals(UpdateTask):
         "stories_date_future", "stories_date_empty"
     ]
     BUCKETS_PER_SOURCE = 4      # inner, plus 3 counts?
+    CHILD_FILTERS = True
 
     def process_sources(self, *,
                         sources: list[Source],
@@ -293,74 +402,47 @@ class UpdateTotals(UpdateTask):
                         url_search_strings: dict[str,list[str]]) -> None:
         """
         called with either a list of domains, and empty url_search strings,
-        or url_search_string with a single dict entry, with value
-        of a list of search strings for a single source.
+        or url_search_strings for a batch of child sources
+        (possibly several per domain).
         """
 
-        # XXX nastiness: direct to elasticsearch_dsl using provider methods:
-        # even nastier, create search from scratch with no date range,
         p = self.p              # mc_provider
-        search = Search(using=p._es, index=[p.INDEX_PREFIX + "*"])\
-            .extra(size=0) # just aggs, no hits
+        search = all_dates_search(p, domains, url_search_strings)
 
-        if p._session_id:
-            search = search.params(preference=p._session_id)
-
-        # get DSL for site filtering:
-        t = p._selector_filter_tuple({"domains": domains, "url_search_strings": url_search_strings})
-        search = search.filter(t.query)
-
-        # aggregation bucket names:
-        OUTER = "outer"
+        # aggregation bucket name:
         INNER = "inner"
-        # Increment BUCKETS_PER_SOURCE if adding a new filter/bucket!!!
-        NO_DATE_BUCKET = "no_date"
-        PAST_DATE_BUCKET = "past_date" # too far in past
-        FUTURE_DATE_BUCKET = "future_date" # too far in future
-
-        s = len(domains or url_search_strings)
-        search.aggs.bucket(OUTER, A("terms", field="canonical_domain", size=s))\
-                   .bucket(INNER,
-                           Filters(
-                               filters={
-                                   # ES doesn't store fields with null values
-                                   # (maybe get "has date" count and subtract?)
-                                   NO_DATE_BUCKET: Bool(must_not=[
-                                       Exists(field="publication_date")]),
-                                   PAST_DATE_BUCKET: Range(publication_date={'lt': es_start()}),
-                                   # NOTE: future dates accepted by mcmetadata/story-indexer are "good"
-                                   FUTURE_DATE_BUCKET: Range(publication_date={'gt': es_end(True)}),
-                               }
-                           ))
+
+        outer, site_key = site_agg(p, search, sources, domains, url_search_strings)
+        outer.bucket(INNER, date_quality_filters())
         res = p._search(search, "update_totals") # name for grafana counter
-        counts_by_domain: dict[str, DateCounts] = {
-            outer["key"]: DateCounts(
-                total=outer["doc_count"],
-                no_date=outer[INNER]["buckets"][NO_DATE_BUCKET]["doc_count"],
-                past_date=outer[INNER]["buckets"][PAST_DATE_BUCKET]["doc_count"],
-                future_date=outer[INNER]["buckets"][FUTURE_DATE_BUCKET]["doc_count"])
-            for outer in res.aggregations[OUTER]["buckets"]
+        counts_by_site: dict[str, DateCounts] = {
+            key: date_counts(outer, INNER)
+            for key, outer in site_buckets(res).items()
         }
 
-        zeroes = DateCounts(total=0, no_date=0, past_date=0, future_date=0)
-
         for source in sources:
             # default to zeroes: it means the source has been checked!!
-            counts = counts_by_domain.get(source.name, zeroes)
-
-            if (source.stories_total != counts.total or
-                source.stories_date_past != counts.past_date or
-                source.stories_date_future != counts.future_date or
-                source.stories_date_empty != counts.no_date):
-                self.log_counts("updated", counts, source) # before updating fields!!
-                # something changed; update database:
-                source.stories_total = counts.total
-                source.stories_date_past = counts.past_date
-                source.stories_date_future = counts.future_date
-                source.stories_date_empty = counts.no_date
+            if self.set_totals(source, counts_by_site.get(site_key(source), ZERO_COUNTS)):
                 self.needs_update(source)
-            else:
-                self.log_counts("same", counts, source)
+
+    def set_totals(self, source: Source, counts: DateCounts) -> bool:
+        """
+        returns True if source changed
+        """
+        if (source.stories_total != counts.total or
+            source.stories_date_past != counts.past_date or
+            source.stories_date_future != counts.future_date or
+            source.stories_date_empty != counts.no_date):
+            self.log_counts("updated", counts, source) # before updating fields!!
+            # something changed; update database:
+            source.stories_total = counts.total
+            source.stories_date_past = counts.past_date
+            source.stories_date_future = counts.future_date
+            source.stories_date_empty = counts.no_date
+            return True
+        else:
+            self.log_counts("same", counts, source)
+            return False
 
     def log_counts(self, status, counts, source):
         # NOTE: %s for current, since may be None
@@ -370,3 +452,108 @@ class UpdateTotals(UpdateTask):
                             "past", counts.past_date, source.stories_date_past,
                             "future", counts.future_date, source.stories_date_future,
                             "no_date", counts.no_date, source.stories_date_empty)
+
+@updater
+class UpdateCombined(UpdateStoriesPerWeek, FindLastStory, UpdateTotals, UpdateSourceLanguage):
+    """
+    Computes the metrics of the updaters above (selected with
+    sources-meta-update --metric, default all) in a single pass:
+    one ES aggregation per batch, and one bulk_update of all the
+    selected UPDATE_FIELDS (languages are saved as found, see
+    UpdateSourceLanguage).
+
+    NOTE! stories_per_week counts the seven days ending yesterday.
+    """
+    TASK_NAME = "combined"
+    METRICS: dict[str, type[UpdateTask]] = {
+        cls.TASK_NAME: cls
+        for cls in (UpdateStoriesPerWeek, FindLastStory, UpdateTotals, UpdateSourceLanguage)
+    }
+    UPDATE_FIELDS = [field for cls in METRICS.values() for field in cls.UPDATE_FIELDS]
+    # outer, date filters (3), week, last, language filter and top term
+    BUCKETS_PER_SOURCE = 8
+    CHILD_FILTERS = True
+
+    def __init__(self, *, task_args: dict, options: dict):
+        super().__init__(task_args=task_args, options=options)
+        self.metrics = options.get("metric") or list(self.METRICS)
+        self.UPDATE_FIELDS = [field for metric in self.metrics
+                              for field in self.METRICS[metric].UPDATE_FIELDS]
+        logger.info("metrics: %s", ", ".join(self.metrics))
+
+    def sources_query(self) -> QuerySet:
+        # all sources (not just those UpdateSourceLanguage wants)
+        return MetadataUpdater.sources_query(self)
+
+    def process_sources(self, *,
+                        sources: list[Source],
+                        domains: list[str],
+                        url_search_strings: dict[str,list[str]]) -> None:
+        # aggregation names:
+        DATES = "dates"
+        WEEK = "week"
+        LAST = "last"
+        MAX = "max"
+        LANG = "lang"
+        TOP = "top"
+
+        metrics = self.metrics
+        p = self.p              # mc_provider
+        search = all_dates_search(p, domains, url_search_strings)
+
+        outer, site_key = site_agg(p, search, sources, domains, url_search_strings)
+        if UpdateTotals.TASK_NAME in metrics:
+            outer.bucket(DATES, date_quality_filters())
+        if UpdateStoriesPerWeek.TASK_NAME in metrics:
+            outer.bucket(WEEK, "filter",
+                         Range(publication_date={"gte": yesterday(7), "lte": yesterday()}))
+        if FindLastStory.TASK_NAME in metrics:
+            outer.bucket(LAST, "filter",
+                         Range(publication_date={"gte": es_start(), "lte": es_end()}))\
+                 .metric(MAX, "max", field="publication_date")
+        if UpdateSourceLanguage.TASK_NAME in metrics:
+            outer.bucket(LANG, "filter",
+                         Range(publication_date={"gte": yesterday(LANG_COUNT_DAYS),
+                                                 "lte": yesterday()}))\
+                 .bucket(TOP, "terms", field="language", size=1)
+
+        res = p._search(search, "combined") # name for grafana counter
+        buckets_by_site = site_buckets(res)
+
+        for source in sources:
+            b = buckets_by_site.get(site_key(source))
+            changed = {}
+            if UpdateTotals.TASK_NAME in metrics:
+                # default to zeroes: it means the source has been checked!!
+                counts = date_counts(b, DATES) if b else ZERO_COUNTS
+                changed[UpdateTotals.TASK_NAME] = self.set_totals(source, counts)
+            if UpdateStoriesPerWeek.TASK_NAME in metrics:
+                # no stories in week is None (like two_d_aggregation)
+                weekly_count = b[WEEK]["doc_count"] if b else 0
+                changed[UpdateStoriesPerWeek.TASK_NAME] = \
+                    self.set_stories_per_week(source, weekly_count or None)
+            if FindLastStory.TASK_NAME in metrics:
+                # NULL out domains with no stories found
+                last_date = b[LAST][MAX]["value_as_string"] if b and b[LAST]["doc_count"] else None
+                changed[FindLastStory.TASK_NAME] = self.set_last_story(source, last_date)
+            if UpdateSourceLanguage.TASK_NAME in metrics and source.primary_language is None:
+                langs = {top["key"]: top["doc_count"] for top in b[LANG][TOP]["buckets"]} if b else {}
+                # saved (if updating), not in bulk_update
+                if self.set_language(source, langs):
+                    self.counters[f"{UpdateSourceLanguage.TASK_NAME}_changed"] += 1
+
+            for metric, metric_changed in changed.items():
+                if metric_changed:
+                    self.counters[f"{metric}_changed"] += 1
+            if any(changed.values()):
+                self.needs_update(source)
+
+    def record_run(self) -> None:
+        """
+        record run for each selected metric's updater class
+        (so last_metadata_updates shows when each field was updated)
+        """
+        for metric in self.metrics:
+            MetadataUpdateTask.run(MetadataUpdateTask.UpdaterClass.METADATA_UPDATER,
+                                   self.METRICS[metric].__name__,
+                                   self.counters[f"{metric}_changed"])
@@ -0,0 +1,42 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+# initial population of CollectionDomain (kept up to date by signal
+# handlers in models.py after this): ONLINE_NEWS sources in each
+# collection, and their alternative domains.
+POPULATE = """
+INSERT INTO sources_collectiondomain (collection_id, source_id, domain, url_search_string)
+SELECT sc.collection_id, s.id, s.name, s.url_search_string
+FROM sources_source_collections sc
+JOIN sources_source s ON s.id = sc.source_id
+WHERE s.platform = 'online_news'
+UNION ALL
+SELECT sc.collection_id, s.id, a.domain, a.url_search_string
+FROM sources_source_collections sc
+JOIN sources_source s ON s.id = sc.source_id
+JOIN sources_alternativedomain a ON a.source_id = s.id
+WHERE s.platform = 'online_news'
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sources', '0043_alternative_domain_add_url_search_string'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CollectionDomain',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('domain', models.CharField(max_length=1000, null=True)),
+                ('url_search_string', models.CharField(max_length=1000, null=True)),
+                ('collection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='sources.collection')),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='sources.source')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['collection', 'domain', 'url_search_string'], name='collection_domain_lookup')],
+            },
+        ),
+        migrations.RunSQL(POPULATE, reverse_sql=migrations.RunSQL.noop),
+    ]
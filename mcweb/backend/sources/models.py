@@ -1,3 +1,4 @@
+import collections
 import logging
 from typing import Dict
 from datetime import datetime, timezone
@@ -7,9 +8,12 @@ import mcmetadata.urls as urls
 from django.contrib.auth.models import User
 from django.contrib.postgres.indexes import GinIndex
 from django.contrib.postgres.search import SearchVectorField
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
 
-from util.cache import cache_by_kwargs
+from util.cache import bump_generation, cache_by_kwargs
 
 logger = logging.getLogger(__name__)
 
@@ -311,6 +315,64 @@ class AlternativeDomain(models.Model):
         ]
 
 
+class CollectionDomain(models.Model):
+    """
+    Materialized (denormalized) domains and url_search_strings for
+    ONLINE_NEWS sources in each collection, including sources'
+    AlternativeDomains, so search setup (search/utils.py
+    _for_media_cloud) can fetch all domains for a collection from a
+    single table, rather than with Source/collections/AlternativeDomain
+    joins.
+
+    Kept up to date by signal handlers at the end of this file.
+    """
+    collection = models.ForeignKey(Collection, on_delete=models.CASCADE)
+    source = models.ForeignKey(Source, on_delete=models.CASCADE)
+    domain = models.CharField(max_length=1000, null=True) # Source.name (may be NULL)
+    url_search_string = models.CharField(max_length=1000, null=True)
+
+    class Meta:
+        indexes = [
+            # covering index for _for_media_cloud:
+            models.Index(fields=['collection', 'domain', 'url_search_string'],
+                         name='collection_domain_lookup'),
+        ]
+
+    @classmethod
+    def refresh(cls, *, source_ids: list[int] = [], collection_ids: list[int] = []) -> None:
+        """
+        rebuild rows for the given sources and/or collections
+        """
+        if not source_ids and not collection_ids:
+            return
+        selected = Q(source_id__in=source_ids) | Q(collection_id__in=collection_ids)
+        links = (Source.collections.through.objects
+                 .filter(selected, source__platform=Source.SourcePlatforms.ONLINE_NEWS)
+                 .values_list("collection_id", "source_id",
+                              "source__name", "source__url_search_string"))
+        rows = []
+        link_srcs = collections.defaultdict(list) # source_id -> collection_ids
+        for coll_id, src_id, name, uss in links:
+            rows.append(cls(collection_id=coll_id, source_id=src_id,
+                            domain=name, url_search_string=uss))
+            link_srcs[src_id].append(coll_id)
+
+        if link_srcs:
+            alts = (AlternativeDomain.objects
+                    .filter(source_id__in=link_srcs.keys())
+                    .values_list("source_id", "domain", "url_search_string"))
+            for src_id, domain, uss in alts:
+                for coll_id in link_srcs[src_id]:
+                    rows.append(cls(collection_id=coll_id, source_id=src_id,
+                                    domain=domain, url_search_string=uss))
+
+        with transaction.atomic():
+            cls.objects.filter(selected).delete()
+            cls.objects.bulk_create(rows, batch_size=5000)
+        logger.debug("CollectionDomain.refresh srcs %s colls %s: %d rows",
+                     source_ids, collection_ids, len(rows))
+
+
 class ActionHistory(models.Model):
     """
     Simple event model for actions taken on Sources models above
@@ -445,3 +507,81 @@ class MetadataUpdateTask(models.Model):
         called by manage.py last-metadata-updates for test
         """
         return cls._last_metadata_updates()
+
+
+# search/utils.py caches the resolution of collection/source ids
+# to domains/url_search_strings under this generation counter.
+SEARCH_DOMAINS_GENERATION = "search-domains"
+
+# fields that (if explicitly listed in save(update_fields=...)) can
+# change search domains.  Saves without update_fields always count.
+_SEARCH_DOMAINS_FIELDS = {
+    Source: {"name", "url_search_string", "platform"},
+    Collection: {"platform"},
+    AlternativeDomain: {"domain", "url_search_string", "source"},
+}
+
+# Signal handlers to keep CollectionDomain up to date, and invalidate
+# cached search domains.  Deleting a Source or Collection removes
+# CollectionDomain rows by CASCADE.  NOTE! handlers for deletes and
+# removals only ever delete CollectionDomain rows: re-querying in the
+# middle of a cascading delete could resurrect rows for a dying Source!
+
+@receiver(pre_save, sender=AlternativeDomain)
+def _alternative_domain_saving(sender, instance, update_fields=None, **kwargs):
+    # remember current source, so rows for it are refreshed
+    # if the AlternativeDomain is moved to a different Source
+    instance._old_source_id = None
+    if instance.pk and (update_fields is None or "source" in update_fields):
+        instance._old_source_id = (sender.objects.filter(pk=instance.pk)
+                                   .values_list("source_id", flat=True).first())
+
+@receiver(post_save, sender=Source)
+@receiver(post_save, sender=Collection)
+@receiver(post_save, sender=AlternativeDomain)
+def _search_domains_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or not _SEARCH_DOMAINS_FIELDS[sender].isdisjoint(update_fields):
+        if sender is Source:
+            CollectionDomain.refresh(source_ids=[instance.pk])
+        elif sender is AlternativeDomain:
+            source_ids = [instance.source_id]
+            old_source_id = getattr(instance, "_old_source_id", None)
+            if old_source_id is not None and old_source_id != instance.source_id:
+                source_ids.append(old_source_id)
+            CollectionDomain.refresh(source_ids=source_ids)
+        bump_generation(SEARCH_DOMAINS_GENERATION)
+
+@receiver(post_delete, sender=Source)
+@receiver(post_delete, sender=Collection)
+@receiver(post_delete, sender=AlternativeDomain)
+def _search_domains_deleted(sender, instance, **kwargs):
+    if sender is AlternativeDomain:
+        CollectionDomain.objects.filter(source_id=instance.source_id,
+                                        domain=instance.domain,
+                                        url_search_string=instance.url_search_string)\
+                                .delete()
+    bump_generation(SEARCH_DOMAINS_GENERATION)
+
+@receiver(m2m_changed, sender=Source.collections.through)
+def _search_domains_collections_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+
+    # reverse means instance is a Collection, and pk_set has Source ids
+    if action == "post_add":
+        if reverse:
+            CollectionDomain.refresh(source_ids=list(pk_set))
+        else:
+            CollectionDomain.refresh(source_ids=[instance.pk])
+    else:
+        # post_remove (pk_set has ids removed) or post_clear (pk_set is None)
+        if reverse:
+            selected = Q(collection_id=instance.pk)
+            if pk_set is not None:
+                selected &= Q(source_id__in=pk_set)
+        else:
+            selected = Q(source_id=instance.pk)
+            if pk_set is not None:
+                selected &= Q(collection_id__in=pk_set)
+        CollectionDomain.objects.filter(selected).delete()
+    bump_generation(SEARCH_DOMAINS_GENERATION)
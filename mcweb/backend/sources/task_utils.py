@@ -4,13 +4,17 @@ Utilities for source management tasks
 
 import collections
 import datetime as dt
+import io
 import logging
+import threading
 import time                     # sleep
-from typing import TypeAlias
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Iterator, TypeAlias
 
 # PyPI:
 from background_task.tasks import TaskProxy
 from django.core.paginator import Paginator
+from django.db import connection, models, transaction
 from django.db.models import QuerySet, Q
 
 # mcweb/backend/util/
@@ -33,6 +37,9 @@ class ChildSources:
 
 CHILD_SOURCES_DEFAULT = ChildSources.ALSO
 
+# process_sources keyword arguments for one ES query
+SourceBatch: TypeAlias = dict[str, Any]
+
 def yesterday(days=0):
     """
     returns a naive datetime for use in ES search ranges; mc_provider
@@ -47,6 +54,112 @@ def yesterday_aware(days=0):
     """
     return yesterday(days).replace(tzinfo=dt.timezone.utc)
 
+def _copy_text(value: Any) -> str:
+    """
+    format database value for COPY (text format)
+    """
+    if value is None:
+        return r"\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t")\
+                     .replace("\n", "\\n").replace("\r", "\\r")
+
+def copy_update(model: type[models.Model], objs: list[models.Model], fields: list[str]) -> int:
+    """
+    Postgres replacement for model.objects.bulk_update(objs, fields):
+    COPY (id, fields) rows into a temporary table, then a single
+    UPDATE ... FROM join (skipping rows with no change),
+    instead of bulk_update's (huge) CASE WHEN id = ... expressions.
+    Like bulk_update, does not call save() or send signals.
+
+    returns number of rows changed.
+    """
+    meta = model._meta
+    pk = meta.pk
+    model_fields = [meta.get_field(name) for name in fields]
+    qn = connection.ops.quote_name
+    table = qn(meta.db_table)
+    staging = qn(f"{meta.db_table}_staging")
+    columns = [qn(pk.column)] + [qn(field.column) for field in model_fields]
+
+    buf = io.StringIO()
+    for obj in objs:
+        values = [pk.get_db_prep_save(obj.pk, connection)]
+        values.extend(field.get_db_prep_save(getattr(obj, field.attname), connection)
+                      for field in model_fields)
+        buf.write("\t".join(_copy_text(value) for value in values))
+        buf.write("\n")
+    buf.seek(0)
+
+    id_col = columns[0]
+    all_cols = ", ".join(columns)
+    assignments = ", ".join(f"{col} = s.{col}" for col in columns[1:])
+    old = ", ".join(f"t.{col}" for col in columns[1:])
+    new = ", ".join(f"s.{col}" for col in columns[1:])
+    with transaction.atomic(), connection.cursor() as cursor:
+        # only ever a temp table (ON COMMIT DROP, but may be left
+        # from an earlier call inside an outer transaction)
+        cursor.execute(f"DROP TABLE IF EXISTS pg_temp.{staging}")
+        cursor.execute(f"""
+            CREATE TEMPORARY TABLE {staging} ON COMMIT DROP AS
+            SELECT {all_cols} FROM {table} WITH NO DATA""")
+        cursor.copy_expert(f"COPY {staging} ({all_cols}) FROM STDIN", buf)
+        cursor.execute(f"""
+            UPDATE {table} t
+            SET {assignments}
+            FROM {staging} s
+            WHERE t.{id_col} = s.{id_col}
+              AND ROW({old}) IS DISTINCT FROM ROW({new})""")
+        return cursor.rowcount
+
+class RateLimiter:
+    """
+    thread-safe limiter: spaces calls to wait()
+    at least 60/per_minute seconds apart.
+    """
+    def __init__(self, per_minute: float):
+        self.interval = 60 / per_minute
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def wait(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next)
+            self.next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+def pop_child_batch(sources: ChildSourceDict, batch_size: int,
+                    siblings: bool) -> list[Source]:
+    """
+    remove and return up to batch_size child sources from `sources`.
+
+    If not siblings, takes at most one child source per parent domain
+    (for aggregations that bucket by domain).  If siblings, takes as
+    many as fit, for process_sources that bucket children by source
+    (see MetadataUpdater.CHILD_FILTERS).
+    """
+    batch: list[Source] = []
+    to_delete: set[str] = set()
+    for name, srcs in sources.items():
+        if siblings:
+            take = min(len(srcs), batch_size - len(batch))
+        else:
+            take = 1
+        batch.extend(srcs[:take])
+        del srcs[:take]
+        if len(srcs) == 0:
+            to_delete.add(name) # mark for deletion
+        if len(batch) == batch_size:
+            break
+
+    # delete empty sources from ChildSourceDict
+    for name in to_delete:
+        sources.pop(name)
+    return batch
+
 class MetadataUpdater(metaclass=MetadataUpdaterMetaclass):
     """
     Class for metadata updater tasks, invoked by MetadataUpdaterCommand
@@ -57,6 +170,10 @@ class MetadataUpdater(metaclass=MetadataUpdaterMetaclass):
     # required:
     UPDATE_FIELDS: list[str]    # Source fields to update
     BUCKETS_PER_SOURCE = 1
+    # True if process_sources buckets child sources individually
+    # (ie; a filters aggregation with a filter for each child source),
+    # so siblings (child sources with the same domain) can be batched
+    CHILD_FILTERS = False
     SOURCE_PAGE_SIZE = 5000     # PG query page: make a command line option?
 
     UPDATED_COUNTER = "updated"
@@ -73,8 +190,15 @@ class MetadataUpdater(metaclass=MetadataUpdaterMetaclass):
                                    task_name=self.__class__.__name__)
         self.p.set_trace(options["provider_trace"])
         self.sources_to_update = []
-        self.sleep_time = 60 / options["rate"]
-        self.counters = collections.Counter()
+        self.rate = options["rate"]
+        self.sleep_time = 60 / self.rate
+        self._counters = collections.Counter()
+        self.concurrency = options.get("concurrency", 1)
+        self.offset_pagination = options.get("offset_pagination", False)
+        self.bulk_update = options.get("bulk_update", False)
+        # with concurrency > 1, process_sources runs in worker threads:
+        self._thread = threading.local() # per-batch results in workers
+        self.lock = threading.Lock()     # for subclass shared state
         self.update = options["update"]
         self.process_child_sources = options["process_child_sources"]
         self.source_ids = [int(x) for x in options["source_id"]]
@@ -105,6 +229,8 @@ class MetadataUpdater(metaclass=MetadataUpdaterMetaclass):
 
         # four clauses per child source (Bool, Match domain, two wildcards)??
         self.child_batch_size = min(bucket_limit, max_clause_count // 4)
+        # each child also appears in the filters aggregation
+        self.child_filters_batch_size = self.child_batch_size // 2
         logger.info("child_batch_size %d, parent_batch_size %d",
                     self.child_batch_size, self.parent_batch_size)
 
@@ -125,8 +251,16 @@ class MetadataUpdater(metaclass=MetadataUpdaterMetaclass):
             sstr = "source %s (%d)" % (self.source_name(source), source.id)
             logger.debug(format, sstr, *args)
 
+    @property
+    def counters(self) -> collections.Counter:
+        """
+        in a worker thread, counts for the current batch
+        (added to totals by _apply_batch)
+        """
+        return getattr(self._thread, "counters", self._counters)
+
     def needs_update(self, source: Source):
-        self.sources_to_update.append(source)
+        getattr(self._thread, "sources", self.sources_to_update).append(source)
 
     def source_name(self, source):
         """
@@ -152,17 +286,46 @@ class MetadataUpdater(metaclass=MetadataUpdaterMetaclass):
             # no filtering!
         return q
 
-    def run(self) -> None:
-        full_query = self.sources_query()
+    def source_fields(self) -> list[str]:
+        """
+        Source fields loaded for process_sources (override to add
+        fields: accessing any other field costs a query per source!)
+        """
+        return ["id", "name", "url_search_string", *self.UPDATE_FIELDS]
+
+    def _source_pages(self, query: QuerySet) -> Iterator[list[Source]]:
+        """
+        return pages of sources from query (ordered by id).
+
+        Default is keyset pagination (WHERE id > last id seen) so late
+        pages are as fast as the first one; Django Paginator (COUNT(*),
+        then OFFSET/LIMIT, slower with each page) with --offset-pagination.
+        """
+        if self.offset_pagination:
+            paginator = Paginator(query, self.parent_batch_size)
+            for page_number in paginator.page_range:
+                self.verbose(2, "sources query page %d", page_number)
+                yield list(paginator.page(page_number).object_list)
+            return
+
+        last_id = 0
+        page_number = 0
+        while sources := list(query.filter(id__gt=last_id)[:self.parent_batch_size]):
+            page_number += 1
+            self.verbose(2, "sources query page %d (id > %d)", page_number, last_id)
+            yield sources
+            last_id = sources[-1].id
+
+    def _batches(self) -> Iterator[SourceBatch | None]:
+        """
+        page through sources_query, returning process_sources
+        arguments for each batch, and None after each page.
+        """
+        full_query = self.sources_query().only(*self.source_fields())
         parent_sources: list[Source] = []
         child_sources: ChildSourceDict = collections.defaultdict(list)
 
-        paginator = Paginator(full_query, self.parent_batch_size)
-        for page_number in paginator.page_range:
-            self.verbose(2, "sources query page %d", page_number)
-            page = paginator.page(page_number)
-
-            sources = page.object_list
+        for sources in self._source_pages(full_query):
             for source in sources:
                 self.counters["scanned"] += 1
                 if source.url_search_string:
@@ -178,36 +341,101 @@ class MetadataUpdater(metaclass=MetadataUpdaterMetaclass):
             # end for source in sources
 
             if parent_sources:
-                self.process_parents(parent_sources)
+                yield self._parent_batch(parent_sources)
                 parent_sources = []
 
             while len(child_sources) >= self.child_batch_size: # unlikely!!
-                self.process_children(child_sources)
+                yield self._child_batch(child_sources)
 
-            self._update()
-
-            if self.sleep_time > 0:
-                self.verbose(3, "sleep %.3f", self.sleep_time)
-                time.sleep(self.sleep_time)
-
-        # end for page_number
+            yield None
+        # end for sources (page)
 
         if child_sources:
             while child_sources:
-                self.process_children(child_sources)
-            self._update()
+                yield self._child_batch(child_sources)
+            yield None
+
+    def run(self) -> None:
+        if self.concurrency > 1:
+            self._run_pipelined()
+        else:
+            for batch in self._batches():
+                if batch:
+                    self.process_sources(**batch)
+                    continue
+
+                # end of page
+                self._update()
+                if self.sleep_time > 0:
+                    self.verbose(3, "sleep %.3f", self.sleep_time)
+                    time.sleep(self.sleep_time)
 
         # final log message
         counters = ", ".join(f"{name}: {value}"
                             for name, value in self.counters.items())
         if self.update:
             logger.info("totals: %s", counters)
-            MetadataUpdateTask.run(MetadataUpdateTask.UpdaterClass.METADATA_UPDATER,
-                                   type(self).__name__,
-                                   self.counters[self.UPDATED_COUNTER])
+            self.record_run()
         else:
             logger.info("totals: %s (no update)", counters)
 
+    def record_run(self) -> None:
+        """
+        record completed run in MetadataUpdateTask table
+        """
+        MetadataUpdateTask.run(MetadataUpdateTask.UpdaterClass.METADATA_UPDATER,
+                               type(self).__name__,
+                               self.counters[self.UPDATED_COUNTER])
+
+    def _run_pipelined(self) -> None:
+        """
+        Pages the source table (in this thread), while up to
+        `concurrency` ES queries run in a thread pool (started no
+        faster than `rate` per minute), and applies results (in
+        this thread) as batches complete, in order.
+        """
+        limiter = RateLimiter(self.rate)
+        pending: collections.deque[Future] = collections.deque()
+        max_pending = 2 * self.concurrency # bounds sources in memory
+        logger.info("pipelined: concurrency %d, rate %d/m", self.concurrency, self.rate)
+
+        with ThreadPoolExecutor(self.concurrency,
+                                thread_name_prefix=type(self).__name__) as pool:
+            try:
+                for batch in self._batches():
+                    if batch:
+                        pending.append(pool.submit(self._process_batch, limiter, batch))
+                        while len(pending) > max_pending:
+                            self._apply_batch(pending.popleft().result())
+                while pending:
+                    self._apply_batch(pending.popleft().result())
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+
+    def _process_batch(self, limiter: RateLimiter,
+                       batch: SourceBatch) -> tuple[list[Source], collections.Counter]:
+        """
+        run in worker thread: returns sources needing update, and counters
+        """
+        limiter.wait()
+        self._thread.sources = []
+        self._thread.counters = collections.Counter()
+        try:
+            self.process_sources(**batch)
+            return self._thread.sources, self._thread.counters
+        finally:
+            del self._thread.sources
+            del self._thread.counters
+            connection.close()  # if process_sources used the database
+
+    def _apply_batch(self, result: tuple[list[Source], collections.Counter]) -> None:
+        sources, counters = result
+        self.sources_to_update.extend(sources)
+        self._counters.update(counters)
+        self._update()
+
     def _update(self):
         """
         helper for run; sync any updated sources
@@ -215,11 +443,15 @@ class MetadataUpdater(metaclass=MetadataUpdaterMetaclass):
         nupdate = len(self.sources_to_update)
         if nupdate > 0:
             if self.update:
-                logger.info("starting bulk_update %d", nupdate)
-                # painfully slow without batch_size?
-                Source.objects.bulk_update(self.sources_to_update,
-                                           self.UPDATE_FIELDS, batch_size=100)
-                logger.info("updated %d sources", nupdate)
+                if self.bulk_update or connection.vendor != "postgresql":
+                    logger.info("starting bulk_update %d", nupdate)
+                    # painfully slow without batch_size?
+                    Source.objects.bulk_update(self.sources_to_update,
+                                               self.UPDATE_FIELDS, batch_size=100)
+                    logger.info("updated %d sources", nupdate)
+                else:
+                    changed = copy_update(Source, self.sources_to_update, self.UPDATE_FIELDS)
+                    logger.info("updated %d sources (%d changed)", nupdate, changed)
                 self.counters[self.UPDATED_COUNTER] += nupdate
             else:
                 logger.info("found %d sources to update (--update not given)", nupdate)
@@ -241,44 +473,43 @@ class MetadataUpdater(metaclass=MetadataUpdaterMetaclass):
         """
         raise NotImplementedError("process_sources not implemented")
 
-    def process_parents(self, sources: list[Source]) -> None:
+    def _parent_batch(self, sources: list[Source]) -> SourceBatch:
         self.verbose(2, "process_parents %d", len(sources))
         # NOTE! does not include alternative domain names!!!
         # (would complicate keeping batches below domain list length limit)
         self.counters["process_parents"] += 1
-        self.process_sources(sources=sources,
-                             domains=[s.name for s in sources],
-                             url_search_strings={})
+        return dict(sources=sources,
+                    domains=[s.name for s in sources],
+                    url_search_strings={})
 
-    def process_children(self, sources: ChildSourceDict) -> None:
-        # child sources must not appear in a query with parent or siblings.
+    def process_parents(self, sources: list[Source]) -> None:
+        self.process_sources(**self._parent_batch(sources))
+
+    def _child_batch(self, sources: ChildSourceDict) -> SourceBatch:
+        """
+        removes next batch of child sources from `sources`
+        """
         self.verbose(2, "process_children %s", len(sources))
-        sources_to_process: list[Source] = []
-        url_search_strings: dict[str, list[str]] = {}
-        to_delete: set[str] = set()
-
-        # pick one child source off of list for each parent domain
-        n = 0
-        for name, srcs in sources.items():
-            url_search_strings[name] = [srcs[0].url_search_string]
-            src = srcs.pop(0)
-            if len(srcs) == 0:
-                to_delete.add(name) # mark for deletion
-            sources_to_process.append(src)
-            n += 1
-            if n == self.child_batch_size:
-                break
-
-        # delete empty sources from ChildSourceDict
-        for name in to_delete:
-            self.verbose(3, "popping %s", name)
-            sources.pop(name)
+        if self.CHILD_FILTERS:
+            sources_to_process = pop_child_batch(sources, self.child_filters_batch_size,
+                                                 siblings=True)
+        else:
+            sources_to_process = pop_child_batch(sources, self.child_batch_size,
+                                                 siblings=False)
+
+        url_search_strings: dict[str, list[str]] = collections.defaultdict(list)
+        for src in sources_to_process:
+            url_search_strings[src.name].append(src.url_search_string)
+        url_search_strings = dict(url_search_strings)
 
         self.verbose(3, "url_search_strings %s", url_search_strings)
         self.counters["process_children"] += 1
-        self.process_sources(sources=sources_to_process,
-                             domains=[],
-                             url_search_strings=url_search_strings)
+        return dict(sources=sources_to_process,
+                    domains=[],
+                    url_search_strings=url_search_strings)
+
+    def process_children(self, sources: ChildSourceDict) -> None:
+        self.process_sources(**self._child_batch(sources))
 
 
 class MetadataUpdaterCommand(TaskCommand):
@@ -320,6 +551,12 @@ class MetadataUpdaterCommand(TaskCommand):
             "--provider-trace", type=int, default=0, help="Provider trace level.")
         parser.add_argument("--rate", type=int, default=100,
                             help="Max ES queries per minute.")
+        parser.add_argument("--offset-pagination", action="store_true",
+                            help="Page sources with COUNT and OFFSET (for comparison; default is keyset on id).")
+        parser.add_argument("--bulk-update", action="store_true",
+                            help="Update sources with Django bulk_update (for comparison; default is COPY and UPDATE ... FROM).")
+        parser.add_argument("--concurrency", type=int, default=1,
+                            help="Concurrent ES queries (default 1: sequential, sleeping between pages).")
 
         parser.add_argument("--source-id", action="append", default=[],
             help="Specific source ids (for testing).")
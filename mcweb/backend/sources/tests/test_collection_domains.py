@@ -0,0 +1,33 @@
+from django.test import TestCase
+
+from ..models import AlternativeDomain, Collection, CollectionDomain, Source
+
+class CollectionDomainTest(TestCase):
+
+    def setUp(self):
+        self.coll1 = Collection.objects.create(name="coll1")
+        self.coll2 = Collection.objects.create(name="coll2")
+        self.src1 = Source.objects.create(name="one.example.com")
+        self.src2 = Source.objects.create(name="two.example.com")
+        self.src1.collections.add(self.coll1)
+        self.src2.collections.add(self.coll2)
+
+    def _domains(self, collection: Collection) -> set[str]:
+        return set(CollectionDomain.objects.filter(collection=collection)
+                   .values_list("domain", flat=True))
+
+    def test_move_alternative_domain(self):
+        alt = AlternativeDomain.objects.create(source=self.src1, domain="alt.example.com")
+        self.assertEqual(self._domains(self.coll1), {"one.example.com", "alt.example.com"})
+        self.assertEqual(self._domains(self.coll2), {"two.example.com"})
+
+        alt.source = self.src2
+        alt.save()
+        self.assertEqual(self._domains(self.coll1), {"one.example.com"})
+        self.assertEqual(self._domains(self.coll2), {"two.example.com", "alt.example.com"})
+
+        # with update_fields
+        alt.source = self.src1
+        alt.save(update_fields=["source"])
+        self.assertEqual(self._domains(self.coll1), {"one.example.com", "alt.example.com"})
+        self.assertEqual(self._domains(self.coll2), {"two.example.com"})
@@ -0,0 +1,73 @@
+import sys
+import time
+
+from django.db import connection
+from django.test import TestCase
+from unittest import skipUnless
+
+from ..models import Source
+from ..task_utils import copy_update
+
+N = 10000
+
+FIELDS = ["stories_per_week", "last_story", "stories_total", "primary_language", "alerted"]
+
+@skipUnless(connection.vendor == "postgresql", "COPY requires PostgreSQL")
+class CopyUpdateTest(TestCase):
+
+    def setUp(self):
+        Source.objects.bulk_create(
+            Source(name=f"site{i}.example.com", homepage=f"https://site{i}.example.com",
+                   stories_per_week=i % 7 or None)
+            for i in range(N))
+
+    def _changed_sources(self) -> list[Source]:
+        """
+        return all sources, with new values (for most)
+        """
+        sources = list(Source.objects.order_by("id").only("id", *FIELDS))
+        for i, source in enumerate(sources):
+            if i % 10 == 0:
+                continue        # unchanged
+            source.stories_per_week = i % 5 or None
+            # as set by FindLastStory (ES value_as_string)
+            source.last_story = f"2024-01-{i % 28 + 1:02d}T12:34:56.000Z" if i % 3 else None
+            source.stories_total = i * 3
+            source.primary_language = ["en", "es", None, "tab\there"][i % 4]
+            source.alerted = bool(i % 2)
+        return sources
+
+    def _values(self) -> list[tuple]:
+        return list(Source.objects.order_by("id").values_list(*FIELDS))
+
+    def _reset(self, values: list[tuple]) -> None:
+        sources = list(Source.objects.order_by("id"))
+        for source, row in zip(sources, values):
+            for field, value in zip(FIELDS, row):
+                setattr(source, field, value)
+        Source.objects.bulk_update(sources, FIELDS, batch_size=1000)
+
+    def test_same_as_bulk_update(self):
+        before = self._values()
+
+        sources = self._changed_sources()
+        t0 = time.monotonic()
+        Source.objects.bulk_update(sources, FIELDS, batch_size=100)
+        bulk_sec = time.monotonic() - t0
+        expected = self._values()
+
+        self._reset(before)
+        self.assertEqual(self._values(), before)
+
+        sources = self._changed_sources()
+        t0 = time.monotonic()
+        changed = copy_update(Source, sources, FIELDS)
+        copy_sec = time.monotonic() - t0
+        self.assertEqual(self._values(), expected)
+        self.assertEqual(changed, N - N // 10)
+
+        # nothing left to change
+        self.assertEqual(copy_update(Source, sources, FIELDS), 0)
+
+        sys.stderr.write(f"\nper {N} sources: bulk_update {bulk_sec:.3f} sec, "
+                         f"copy_update {copy_sec:.3f} sec\n")
@@ -0,0 +1,24 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from ...models import QuotaHistory
+from ...tasks import QUOTA_SYNC_SECONDS, sync_quota_counters
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Copy Redis quota counters to QuotaHistory table'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--queue", action="store_true",
+                            help="Queue repeating background task (replacing any existing one).")
+        parser.add_argument("--repeat", type=int, default=QUOTA_SYNC_SECONDS,
+                            help=f"Seconds between runs of queued task (default {QUOTA_SYNC_SECONDS}).")
+
+    def handle(self, *args, **options):
+        if options["queue"]:
+            sync_quota_counters(options["repeat"])
+        else:
+            n = QuotaHistory.sync_counters()
+            logger.info("synced %d quota counters", n)
@@ -1,9 +1,15 @@
+import collections
+import logging
+import time
+
 from django import db
-from django.db import models
-from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection, models
+from django.contrib.auth.models import Group, User
+from django.utils import timezone
 import datetime as dt
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_save, pre_delete
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 
@@ -12,8 +18,26 @@ from mc_providers import provider_name, PLATFORM_ONLINE_NEWS, \
     PLATFORM_SOURCE_WAYBACK_MACHINE, PLATFORM_SOURCE_MEDIA_CLOUD
 from mc_providers import UnknownProviderException
 
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import RedisError
+
+# mcweb
+from settings import QUOTA_REDIS
+
+# mcweb/util
+import util.stats as stats
+from util.ratelimit_callables import forget_rate_tier
+
+from . import quota_counters
 from .exceptions import OverQuotaException
 
+logger = logging.getLogger(__name__)
+
+# django_redis wraps Redis connection errors
+CACHE_ERRORS = (ConnectionInterrupted, RedisError)
+
+PROFILE_CACHE_SECONDS = 5*60
+
 
 # this is how Django recommends adding custom information to the User object - adding in second model with custom info
 class Profile(models.Model):
@@ -36,12 +60,55 @@ class Profile(models.Model):
             return self.quota_mediacloud
         raise UnknownProviderException(provider, "")
 
+    @classmethod
+    def _cache_key(cls, user_id: int) -> str:
+        return f"user-profile:{user_id}"
+
     @classmethod
     def user_provider_quota(cls, user_id: int, provider: str) -> int:
-        # as a backup catchall - create the profile in case it isn't there already (maybe for pre-existing user? 🤷🏽‍)
-        profile, _ = Profile.objects.get_or_create(user_id=user_id)
+        # Profile is cached (invalidated by post_save signal below),
+        # since quota is checked for every query.
+        key = cls._cache_key(user_id)
+        try:
+            profile = cache.get(key)
+        except CACHE_ERRORS as e:
+            logger.warning("user_provider_quota: %r; using database", e)
+            stats.count(["quota", "fallback"], labels=[("op", "profile")])
+            profile = None
+            key = None          # don't try to set
+        if profile is None:
+            # as a backup catchall - create the profile in case it isn't there already (maybe for pre-existing user? 🤷🏽‍)
+            profile, _ = Profile.objects.get_or_create(user_id=user_id)
+            if key:
+                cache.set(key, profile, PROFILE_CACHE_SECONDS)
         return profile.quota_for(provider)
 
+@receiver(post_save, sender=Profile)
+def profile_saved(sender, instance: Profile, **kwargs):
+    try:
+        cache.delete(Profile._cache_key(instance.user_id))
+    except CACHE_ERRORS as e:
+        logger.warning("profile_saved: %r", e)
+
+# invalidate cached rate tiers (util/ratelimit_callables.py)
+
+@receiver(m2m_changed, sender=User.groups.through)
+def user_groups_changed(sender, instance, action: str, reverse: bool, pk_set, **kwargs):
+    if not reverse:             # instance is a User
+        if action in ("post_add", "post_remove", "post_clear"):
+            forget_rate_tier(instance.pk)
+    elif action in ("post_add", "post_remove"): # pk_set is user ids
+        for user_id in pk_set:
+            forget_rate_tier(user_id)
+    elif action == "pre_clear": # members of Group (still) available
+        for user_id in instance.user_set.values_list("id", flat=True):
+            forget_rate_tier(user_id)
+
+@receiver(pre_delete, sender=Group)
+def group_deleted(sender, instance: Group, **kwargs):
+    for user_id in instance.user_set.values_list("id", flat=True):
+        forget_rate_tier(user_id)
+
 
 # track weekly hits against each provider so we can threshold against system abuse, and also give ourselves some
 # potentially useful measure of system load/usage (beyond basic web analystics)
@@ -79,25 +146,157 @@ class QuotaHistory(models.Model):
         return matching
 
 
+    @classmethod
+    def _db_hits(cls, user_id: int, provider: str, week: dt.date) -> int:
+        hits = cls.objects.filter(user_id=user_id, provider=provider, week=week)\
+                          .values_list("hits", flat=True).first()
+        return hits or 0
+
+    @classmethod
+    def _db_upsert(cls, user_id: int, provider: str, week: dt.date, hits: int,
+                   update: str) -> int:
+        """
+        insert row with hits, or update existing row with `update`
+        SQL expression (in terms of table and EXCLUDED), returns hits.
+        """
+        table = cls._meta.db_table
+        now = timezone.now()
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                INSERT INTO {table} (user_id, provider, week, hits, created_at, modified_at)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (user_id, provider, week)
+                DO UPDATE SET hits = {update.format(table=table)}, modified_at = EXCLUDED.modified_at
+                RETURNING hits""",
+                           [user_id, provider, week, hits, now, now])
+            return cursor.fetchone()[0]
+
+    @classmethod
+    def current_hits(cls, user_id: int, provider: str) -> int:
+        """
+        hits for this week (from Redis counter, or database)
+        """
+        week = cls._this_week()
+        if QUOTA_REDIS:
+            try:
+                return quota_counters.get(user_id, provider, week,
+                                          lambda: cls._db_hits(user_id, provider, week))
+            except RedisError as e:
+                logger.warning("current_hits: %r; using database", e)
+                stats.count(["quota", "fallback"], labels=[("op", "get")])
+        return cls._db_hits(user_id, provider, week)
+
     @classmethod
     def check_quota(cls, user_id: int, is_staff:bool, provider:str):
-        matching = cls.current_for(user_id, provider)
+        hits = cls.current_hits(user_id, provider)
         quota = Profile.user_provider_quota(user_id, provider)
-        if (quota <= matching.hits) and not is_staff:
+        if (quota <= hits) and not is_staff:
             raise OverQuotaException(provider, quota)
-        return matching.hits
+        return hits
+
+    @classmethod
+    def add_hits(cls, user_id: int, provider: str, amount: int) -> int:
+        """
+        atomically add amount to this week's hits, returns new hits.
+        Uses Redis counter (INCRBY) if enabled and available,
+        else a single database upsert.
+        """
+        week = cls._this_week()
+        if QUOTA_REDIS:
+            try:
+                return quota_counters.add(user_id, provider, week, amount,
+                                          lambda: cls._db_hits(user_id, provider, week))
+            except RedisError as e:
+                logger.warning("add_hits: %r; using database", e)
+                stats.count(["quota", "fallback"], labels=[("op", "add")])
+        return cls._db_upsert(user_id, provider, week, amount, "{table}.hits + EXCLUDED.hits")
+
+    @classmethod
+    def sync_counters(cls) -> int:
+        """
+        copy changed Redis counters to database (run periodically by
+        quota-sync task), returns number of counters synced.
+
+        Database hits are never lowered: if the database has more hits
+        (charged while Redis was unavailable), the counter is raised.
+
+        Each counter is marked synced only after its (autocommitted)
+        upsert, so if this raises, unsynced counters stay dirty.
+        """
+        n = 0
+        for batch in quota_counters.dirty_counters():
+            for key, hits in batch:
+                user_id, provider, week = quota_counters.parse_key(key)
+                if not User.objects.filter(id=user_id).exists():
+                    quota_counters.forget(key) # user deleted
+                    continue
+                db_hits = cls._db_upsert(user_id, provider, week, hits,
+                                         "GREATEST({table}.hits, EXCLUDED.hits)")
+                quota_counters.raise_to(key, db_hits, hits)
+                quota_counters.synced(key, max(db_hits, hits))
+                n += 1
+        return n
 
     @classmethod
     def increment(cls, user_id: int, is_staff: bool, provider: str, amount: int = 1) -> int:
-        matching = cls.current_for(user_id, provider)
-        matching.hits += amount
-        matching.save()
+        hits = cls.add_hits(user_id, provider, amount)
         # raise an error if they are at quota
         quota = Profile.user_provider_quota(user_id, provider)
-        if (quota <= matching.hits) and not is_staff:
+        if (quota <= hits) and not is_staff:
             raise OverQuotaException(provider, quota)
-        return matching.hits
-    
+        return hits
+
+
+class QuotaAccumulator:
+    """
+    Accumulate hits for a user (ie; one per page of a download) and
+    write them with one QuotaHistory.add_hits per provider when
+    flushed: at the end of a request/task (use as a context manager),
+    or every FLUSH_SECONDS for long ones.
+
+    The quota is enforced as hits are added (flushing first), using
+    the hits seen at the last flush plus those pending.
+
+    With auto_flush=False hits are only written by explicit flush calls
+    (ie; when work is checkpointed, so work redone after a failure
+    isn't charged twice).
+    """
+    FLUSH_SECONDS = 30
+
+    def __init__(self, user_id: int, is_staff: bool, auto_flush: bool = True):
+        self.user_id = user_id
+        self.is_staff = is_staff
+        self.auto_flush = auto_flush
+        self.pending: collections.Counter[str] = collections.Counter()
+        self.hits: dict[str, int] = {}  # by provider, as of last flush
+        self.last_flush = time.monotonic()
+
+    def __enter__(self) -> "QuotaAccumulator":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.flush()
+
+    def add(self, provider: str, amount: int = 1) -> None:
+        self.pending[provider] += amount
+        if not self.is_staff:
+            if provider not in self.hits:
+                self.hits[provider] = QuotaHistory.current_hits(self.user_id, provider)
+            quota = Profile.user_provider_quota(self.user_id, provider)
+            if quota <= self.hits[provider] + self.pending[provider]:
+                if self.auto_flush:
+                    self.flush()
+                raise OverQuotaException(provider, quota)
+        if self.auto_flush and time.monotonic() - self.last_flush >= self.FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self) -> None:
+        for provider, amount in self.pending.items():
+            if amount:
+                self.hits[provider] = QuotaHistory.add_hits(self.user_id, provider, amount)
+        self.pending.clear()
+        self.last_flush = time.monotonic()
+
 
 class ResetCodes(models.Model):
     email = models.EmailField()
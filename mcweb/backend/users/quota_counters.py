@@ -0,0 +1,140 @@
+"""
+Redis quota counters: the authoritative (hot path) count of hits
+per (user, provider, week), updated with INCRBY, so checking and
+charging quota doesn't touch Postgres.
+
+A counter missing from Redis (new week, or Redis restarted) is
+seeded from QuotaHistory (by the caller supplied `seed` function).
+
+Counters changed since the last sync are kept in a Redis set, and
+copied to the QuotaHistory table (for reporting and seeding) by the
+periodic quota-sync task (see QuotaHistory.sync_counters).  A key
+is only removed from the set after its value has been written to
+the database, so a failed sync loses nothing.
+
+Callers fall back to the database if Redis raises RedisError.
+"""
+
+# Python
+import datetime as dt
+import logging
+from typing import Callable, Iterator
+
+# PyPI
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "quota"
+DIRTY_KEY = f"{KEY_PREFIX}:dirty"   # set of counter keys to sync
+COUNTER_SECONDS = 15*24*60*60       # counters outlive their week
+
+# returns nil if counter doesn't exist and no seed value passed
+_ADD = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    if ARGV[2] == '' then
+        return nil
+    end
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+end
+local hits = redis.call('INCRBY', KEYS[1], ARGV[1])
+redis.call('SADD', KEYS[2], KEYS[1])
+return hits
+"""
+
+# remove counter from dirty set if not incremented since synced
+_SYNCED = """
+local hits = redis.call('GET', KEYS[2])
+if hits == false or tonumber(hits) <= tonumber(ARGV[1]) then
+    return redis.call('SREM', KEYS[1], KEYS[2])
+end
+return 0
+"""
+
+def _redis():
+    return get_redis_connection("default")
+
+def counter_key(user_id: int, provider: str, week: dt.date) -> str:
+    return f"{KEY_PREFIX}:{user_id}:{provider}:{week:%Y%m%d}"
+
+def parse_key(key: str) -> tuple[int, str, dt.date]:
+    """
+    inverse of counter_key
+    """
+    _, user_id, rest = key.split(":", 2)
+    provider, week = rest.rsplit(":", 1)
+    return int(user_id), provider, dt.datetime.strptime(week, "%Y%m%d").date()
+
+def add(user_id: int, provider: str, week: dt.date, amount: int,
+        seed: Callable[[], int]) -> int:
+    """
+    add amount to counter, returns new hits.
+    seed() (database hits) is only called if the counter doesn't exist.
+    """
+    r = _redis()
+    script = r.register_script(_ADD)
+    keys = [counter_key(user_id, provider, week), DIRTY_KEY]
+    hits = script(keys=keys, args=[amount, "", COUNTER_SECONDS])
+    if hits is None:
+        hits = script(keys=keys, args=[amount, seed(), COUNTER_SECONDS])
+    return int(hits)
+
+def get(user_id: int, provider: str, week: dt.date, seed: Callable[[], int]) -> int:
+    """
+    return current hits (seeding counter if needed)
+    """
+    r = _redis()
+    key = counter_key(user_id, provider, week)
+    hits = r.get(key)
+    if hits is None:
+        hits = seed()
+        if not r.set(key, hits, ex=COUNTER_SECONDS, nx=True):
+            hits = r.get(key) or hits # lost race with another seed/add
+    return int(hits)
+
+def dirty_counters(batch: int = 1000) -> Iterator[list[tuple[str, int]]]:
+    """
+    return batches of (key, hits) for counters changed since last synced.
+    Keys stay in the dirty set until passed to synced (or forget).
+    """
+    r = _redis()
+
+    def values(keys: list[str]) -> list[tuple[str, int]]:
+        ret = []
+        for key, value in zip(keys, r.mget(keys)):
+            if value is None:   # expired: nothing to sync
+                r.srem(DIRTY_KEY, key)
+            else:
+                ret.append((key, int(value)))
+        return ret
+
+    keys = []
+    for key in r.sscan_iter(DIRTY_KEY, count=batch):
+        keys.append(key.decode())
+        if len(keys) >= batch:
+            yield values(keys)
+            keys = []
+    if keys:
+        yield values(keys)
+
+def synced(key: str, hits: int) -> None:
+    """
+    call after hits for key written to database: removes key from
+    dirty set, unless counter incremented since it was read.
+    """
+    r = _redis()
+    r.register_script(_SYNCED)(keys=[DIRTY_KEY, key], args=[hits])
+
+def forget(key: str) -> None:
+    """
+    remove key from dirty set without syncing (ie; user deleted)
+    """
+    _redis().srem(DIRTY_KEY, key)
+
+def raise_to(key: str, hits: int, current: int) -> None:
+    """
+    add difference to counter if database has more hits than counter
+    had (ie; hits charged to database when Redis was unavailable).
+    """
+    if hits > current:
+        _redis().incrby(key, hits - current)
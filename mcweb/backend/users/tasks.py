@@ -3,7 +3,7 @@ from django.core.management.base import BaseCommand
 from django.utils import timezone
 from datetime import timedelta
 from django.db import transaction
-from .models import ResetCodes, User
+from .models import QuotaHistory, ResetCodes, User
 import datetime as dt
 from settings import SYSTEM_TASK_USERNAME
 from backend.util.tasks import (
@@ -54,3 +54,21 @@ def _cleanup_reset_codes(days=1):
         print(error_message)
         return_error(error_message)
         raise
+
+
+QUOTA_SYNC_SECONDS = 10*60
+
+def sync_quota_counters(repeat: int = QUOTA_SYNC_SECONDS):
+    """
+    queue (repeating) task to copy Redis quota counters to QuotaHistory
+    """
+    user = User.objects.get(username=SYSTEM_TASK_USERNAME)
+    task = _sync_quota_counters(creator=user,
+                                verbose_name="sync quota counters",
+                                repeat=repeat)
+    return return_task(task)
+
+@background(queue=SYSTEM_FAST)
+def _sync_quota_counters():
+    n = QuotaHistory.sync_counters()
+    logger.info("synced %d quota counters", n)
@@ -1,3 +1,205 @@
-from django.test import TestCase
+import threading
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth.models import Group, User
+from django.db import connection
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from util import ratelimit_callables, token_bucket
+
+from . import quota_counters
+from .exceptions import OverQuotaException
+from .models import Profile, QuotaAccumulator, QuotaHistory
+
+try:
+    import fakeredis             # not in requirements.txt
+    import lupa                  # for Lua scripts (fakeredis[lua])
+except ImportError:
+    fakeredis = None
+
+PROVIDER = "onlinenews-mediacloud"
+
+# never run against the configured Redis: quota counters
+# (and rate limit buckets) there are live data!
+needs_fakeredis = skipUnless(fakeredis, "fakeredis[lua] not installed")
+
+def test_redis():
+    """
+    return client for a new (empty) fakeredis server
+    """
+    return fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+
+class RedisTestMixin:
+    """
+    use an empty fakeredis for quota counters
+    """
+    def setUp(self):
+        super().setUp()
+        self.redis = test_redis()
+        patcher = mock.patch("backend.users.quota_counters._redis", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+@needs_fakeredis
+class QuotaHistoryConcurrencyTest(RedisTestMixin, TransactionTestCase):
+
+    def test_concurrent_increments_exact(self):
+        user = User.objects.create(username="quota-threads")
+        threads = 8
+        per_thread = 50
+
+        def work():
+            try:
+                for i in range(per_thread):
+                    QuotaHistory.add_hits(user.id, PROVIDER, 1)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=work) for i in range(threads)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        self.assertEqual(QuotaHistory.current_hits(user.id, PROVIDER), threads * per_thread)
+
+@needs_fakeredis
+class QuotaAccumulatorTest(RedisTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username="quota-acc")
+        Profile.objects.update_or_create(user=self.user, defaults={"quota_mediacloud": 10})
+
+    def test_flush_on_exit(self):
+        with QuotaAccumulator(self.user.id, False) as quota:
+            for i in range(5):
+                quota.add(PROVIDER)
+            self.assertEqual(QuotaHistory.current_hits(self.user.id, PROVIDER), 0)
+        self.assertEqual(QuotaHistory.current_hits(self.user.id, PROVIDER), 5)
+
+    def test_over_quota(self):
+        QuotaHistory.add_hits(self.user.id, PROVIDER, 8)
+        with self.assertRaises(OverQuotaException):
+            with QuotaAccumulator(self.user.id, False) as quota:
+                quota.add(PROVIDER)
+                quota.add(PROVIDER)
+        self.assertEqual(QuotaHistory.current_hits(self.user.id, PROVIDER), 10)
+
+@needs_fakeredis
+class QuotaCountersTest(RedisTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username="quota-redis")
+
+    def _db_hits(self):
+        return QuotaHistory._db_hits(self.user.id, PROVIDER, QuotaHistory._this_week())
+
+    def test_seed_from_database(self):
+        QuotaHistory._db_upsert(self.user.id, PROVIDER, QuotaHistory._this_week(), 7,
+                                "EXCLUDED.hits")
+        self.assertEqual(QuotaHistory.add_hits(self.user.id, PROVIDER, 2), 9)
+        self.assertEqual(self._db_hits(), 7) # not synced yet
+        self.assertEqual(QuotaHistory.sync_counters(), 1)
+        self.assertEqual(self._db_hits(), 9)
+        self.assertEqual(QuotaHistory.sync_counters(), 0) # nothing changed
+
+    def test_sync_failure(self):
+        other = User.objects.create(username="quota-redis-2")
+        QuotaHistory.add_hits(self.user.id, PROVIDER, 2)
+        QuotaHistory.add_hits(other.id, PROVIDER, 3)
+        upsert = QuotaHistory._db_upsert
+        calls = []
+
+        def fail_second(*args):
+            calls.append(args)
+            if len(calls) > 1:
+                raise RuntimeError("database down")
+            return upsert(*args)
+
+        with mock.patch.object(QuotaHistory, "_db_upsert", side_effect=fail_second):
+            with self.assertRaises(RuntimeError):
+                QuotaHistory.sync_counters()
+        # counter not written is still dirty
+        self.assertEqual(QuotaHistory.sync_counters(), 1)
+        week = QuotaHistory._this_week()
+        self.assertEqual(QuotaHistory._db_hits(self.user.id, PROVIDER, week), 2)
+        self.assertEqual(QuotaHistory._db_hits(other.id, PROVIDER, week), 3)
+        self.assertEqual(QuotaHistory.sync_counters(), 0)
+
+    def test_fallback(self):
+        QuotaHistory.add_hits(self.user.id, PROVIDER, 3)
+        QuotaHistory.sync_counters()
+        with mock.patch("backend.users.quota_counters._redis",
+                        side_effect=RedisConnectionError("down")):
+            self.assertEqual(QuotaHistory.add_hits(self.user.id, PROVIDER, 5), 8)
+            self.assertEqual(QuotaHistory.current_hits(self.user.id, PROVIDER), 8)
+
+        # Redis back: counter (3+1) raised to database hits (8) by sync
+        QuotaHistory.add_hits(self.user.id, PROVIDER, 1)
+        QuotaHistory.sync_counters()
+        self.assertEqual(self._db_hits(), 8)
+        self.assertEqual(QuotaHistory.current_hits(self.user.id, PROVIDER), 8)
+
+    def test_redis_unavailable(self):
+        Profile.objects.update_or_create(user=self.user, defaults={"quota_mediacloud": 10})
+        down = ConnectionInterrupted(connection=None)
+        with mock.patch("backend.users.quota_counters._redis",
+                        side_effect=RedisConnectionError("down")), \
+             mock.patch("backend.users.models.cache.get", side_effect=down), \
+             mock.patch("backend.users.models.cache.set", side_effect=down):
+            self.assertEqual(QuotaHistory.check_quota(self.user.id, False, PROVIDER), 0)
+            self.assertEqual(QuotaHistory.increment(self.user.id, False, PROVIDER, 9), 9)
+            with self.assertRaises(OverQuotaException):
+                QuotaHistory.increment(self.user.id, False, PROVIDER)
+        self.assertEqual(self._db_hits(), 10)
+
+class RateTierTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="rate-tier")
+        self.group, _ = Group.objects.get_or_create(name=settings.GROUPS.HIGH_RATE_LIMIT)
+        ratelimit_callables.forget_rate_tier(self.user.id)
+
+    def test_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(ratelimit_callables.rate_tier(self.user), ratelimit_callables.DEFAULT)
+            self.assertEqual(ratelimit_callables.rate_tier(self.user), ratelimit_callables.DEFAULT)
+
+    def test_invalidated(self):
+        ratelimit_callables.rate_tier(self.user)
+        self.user.groups.add(self.group)
+        self.assertEqual(ratelimit_callables.rate_tier(self.user), ratelimit_callables.HIGH)
+        self.group.user_set.remove(self.user)
+        self.assertEqual(ratelimit_callables.rate_tier(self.user), ratelimit_callables.DEFAULT)
+        self.group.user_set.add(self.user)
+        ratelimit_callables.rate_tier(self.user)
+        self.group.user_set.clear()
+        self.assertEqual(ratelimit_callables.rate_tier(self.user), ratelimit_callables.DEFAULT)
+
+@needs_fakeredis
+class TokenBucketTest(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch("util.token_bucket._redis", return_value=test_redis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_parse_rate(self):
+        self.assertEqual(token_bucket.parse_rate("2/m"), 2/60)
+        self.assertEqual(token_bucket.parse_rate("10/5s"), 2)
+        with self.assertRaises(ValueError):
+            token_bucket.parse_rate("fast")
+
+    def test_burst(self):
+        rate = token_bucket.parse_rate("1/h")
+        for i in range(3):
+            self.assertEqual(token_bucket.take("test", rate, 3), (True, 0))
+        allowed, wait = token_bucket.take("test", rate, 3)
+        self.assertFalse(allowed)
+        self.assertTrue(0 < wait <= 60*60)
+        # other buckets unaffected
+        self.assertTrue(token_bucket.take("other", rate, 3)[0])
@@ -1,17 +1,37 @@
 import csv
 import io
-from typing import Callable, Iterable
+from typing import Callable, Iterable, Iterator
 
 from django.http import StreamingHttpResponse
 
 
+def csv_chunks(rows: Iterable, chunk_bytes: int = 64*1024) -> Iterator[bytes]:
+    """
+    returns CSV encoded rows as UTF-8 bytes, in chunks of
+    (at least) chunk_bytes, to fill packets and ammortize overhead.
+
+    csv.writer writes to a TextIOWrapper with write_through set, so
+    each row is encoded once, straight into the BytesIO buffer, and
+    buf.tell() is the chunk size in bytes (not characters).
+    """
+    buf = io.BytesIO()
+    text = io.TextIOWrapper(buf, encoding="utf-8", newline="", write_through=True)
+    writer = csv.writer(text)
+    for row in rows:
+        writer.writerow(row)
+        if buf.tell() >= chunk_bytes:
+            yield buf.getvalue()
+            buf.seek(0)         # rewind
+            buf.truncate(0)     # clear buffer
+    if buf.tell():
+        yield buf.getvalue()
+
 # https://stackoverflow.com/questions/46694898/using-streaminghttpresponse-with-django-rest-framework-csv
 def streaming_csv_response(iterator_func: Callable[[], Iterable[tuple]],
-                           filename: str | None = None, chunk_rows: int = 1000):
+                           filename: str | None = None, chunk_bytes: int = 64*1024):
     """
     returns StreamingHttpResponse with containing CSV encoded rows,
-    with chunk_rows per HTTP chunk to fill packets and ammortize
-    overhead.
+    in chunks of (at least) chunk_bytes bytes.
 
     `iterator_func` is a function that returns an iterable that
     returns row tuples (expects header if any to be the first tuple),
@@ -20,42 +40,12 @@ def streaming_csv_response(iterator_func: Callable[[], Iterable[tuple]],
     The "all-sources" manage command:
     mcweb/backend/sources/management/commands/all-sources.py
     tests this routine!
-
-    Tried taking min chunk size (checking buf.tell() after each writerow)
-    but buf is in unicode characters, not bytes...
+    (and "csv-benchmark" measures rows/second)
     """
-    buf = io.StringIO(newline='')
-    writer = csv.writer(buf)
-
-    # make a single use iterator from iterable (generator)
-    # so that each "for row ..." doesn't restart from top
-    iterator = iter(iterator_func())
-    def _chunk():
-        """
-        returns string chunks with chunk_rows each
-        """
-        done = False
-        while True:
-            rows = []
-            for row in iterator:
-                rows.append(row)
-                if len(rows) >= chunk_rows:
-                    break
-            else:
-                done = True
-            writer.writerows(rows)
-            chunk = buf.getvalue()
-            #print(len(rows), rows[0], rows[-1], len(chunk))
-            yield chunk
-            if done:
-                return
-            buf.seek(0)         # rewind
-            buf.truncate(0)     # clear buffer
-
-    # 2. Create the StreamingHttpResponse using _chunk generator for chunks
-    response = StreamingHttpResponse(_chunk(), content_type="text/csv")
+    # 1. Create the StreamingHttpResponse using csv_chunks generator for chunks
+    response = StreamingHttpResponse(csv_chunks(iterator_func(), chunk_bytes), content_type="text/csv")
     if filename:
-        # 3. Add additional headers to the response
+        # 2. Add additional headers to the response
         response['Content-Disposition'] = f"attachment; filename={filename}.csv"
-    # 4. Return the response
+    # 3. Return the response
     return response
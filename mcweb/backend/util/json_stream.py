@@ -0,0 +1,67 @@
+"""
+JSON encoding for API responses:
+
+dumps: orjson fast path, with the same output conventions as
+    json.dumps(value, default=str) (ie; datetimes as str(datetime)),
+    falling back to json.dumps for anything orjson rejects.
+
+streaming_json_response: a StreamingHttpResponse for an object with
+    one large array, sent in chunks as array items are encoded.
+"""
+
+import json
+from typing import Any, Iterable, Iterator
+
+import orjson
+from django.http import StreamingHttpResponse
+
+# PASSTHROUGH_DATETIME: call default (str) for datetimes, like json.dumps(default=str)
+# NON_STR_KEYS: allow int keys (as json.dumps does)
+_ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+def dumps(value: Any) -> bytes:
+    """
+    return JSON encoding of value as bytes
+    """
+    try:
+        return orjson.dumps(value, default=str, option=_ORJSON_OPTIONS)
+    except (TypeError, orjson.JSONEncodeError):
+        # ie; ints larger than 64 bits
+        return json.dumps(value, default=str).encode("utf-8")
+
+def json_chunks(head: dict, key: str, items: Iterable[Any],
+                chunk_bytes: int = 64*1024) -> Iterator[bytes]:
+    """
+    return JSON for object `head` with `key` added, whose value is
+    an array of `items`, as chunks of (at least) chunk_bytes.
+    """
+    assert key not in head
+    if head:
+        prefix = dumps(head)[:-1] + b',' # remove closing brace
+    else:
+        prefix = b'{'
+    parts = [prefix, dumps(key), b':[']
+    size = 0
+    sep = b''
+    for item in items:
+        data = dumps(item)
+        parts.append(sep)
+        parts.append(data)
+        sep = b','
+        size += len(data) + 1
+        if size >= chunk_bytes:
+            yield b''.join(parts)
+            parts = []
+            size = 0
+    parts.append(b']}')
+    yield b''.join(parts)
+
+def streaming_json_response(head: dict, key: str, items: Iterable[Any],
+                            chunk_bytes: int = 64*1024) -> StreamingHttpResponse:
+    """
+    returns StreamingHttpResponse with JSON object
+    (`head` plus `key`: [`items`...]), so the first bytes are sent
+    before all items have been encoded.
+    """
+    return StreamingHttpResponse(json_chunks(head, key, items, chunk_bytes),
+                                 content_type="application/json")
@@ -104,9 +104,21 @@ env = environ.Env(      # @@CONFIGURATION@@ definitions (datatype, default value
     ALLOWED_HOSTS=(list, _DEFAULT_ALLOWED_HOSTS),
     ANALYTICS_MATOMO_DOMAIN=(str, "null"),
     ANALYTICS_MATOMO_SITE_ID=(str, "null"),
+    CACHE_COMPRESS_MIN_BYTES=(int, 2048), # smaller values stored uncompressed
+    CACHE_COMPRESSOR=(str, "zstd"), # util/cache_codec.py NAME
+    CACHE_LOCAL_ENTRIES=(int, 1000), # per-process LRU tier (0 to disable)
+    CACHE_LOCAL_MAX_BYTES=(int, 1024*1024), # largest value kept in LRU tier
+    CACHE_LOCAL_MAX_TOTAL_BYTES=(int, 64*1024*1024), # per-process LRU tier size
+    CACHE_LOCAL_SECONDS=(int, 5*60),
+    CACHE_LOCK_SECONDS=(int, 2*60), # single-flight lock lifetime
+    CACHE_LOCK_WAIT_SECONDS=(float, 30.0), # max wait for another process to fill cache
+    CACHE_REFRESH_THREADS=(int, 2), # per-process stale entry refresh threads
     CACHE_SECONDS=(int, 24*60*60),
+    CACHE_STALE_SECONDS=(int, 6*60*60), # serve stale while refreshing (0 to disable)
     CSRF_TRUSTED_ORIGINS=(list, _DEFAULT_CSRF_TRUSTED_ORIGINS),
+    CSV_PREFETCH_PAGES=(int, 2), # story pages read ahead for content CSV (0 to disable)
     DEBUG=(bool, False),
+    DOWNLOAD_USER_QUERIES=(int, 2), # queries fetched at once for a user's download (1 for sequential)
     EMAIL_BACKEND=(str, 'django.core.mail.backends.smtp.EmailBackend'),
     EMAIL_HOST=(str, ""),
     EMAIL_HOST_PASSWORD=(str, ""),
@@ -115,13 +127,20 @@ env = environ.Env(      # @@CONFIGURATION@@ definitions (datatype, default value
     EMAIL_HOST_USE_SSL=(bool, True),
     EMAIL_NOREPLY=(str, 'noreply@mediacloud.org'),
     EMAIL_ORGANIZATION=(str, "Media Cloud Development"),
+    EXPORT_CHUNK_ROWS=(int, 50000), # stories per export chunk (checkpoint)
+    EXPORT_KEEP_DAYS=(int, 7), # days to keep export jobs (and chunks) after last update
+    EXPORT_S3_ENDPOINT_URL=(str, ""), # for S3 compatible stores (ie; MinIO)
+    EXPORT_STORE=(str, ""), # file:/DIR or s3://BUCKET/PREFIX (empty to email attachments)
     GIT_REV=(str, ""),
     LOG_LEVEL=(str, "DEBUG"),
     MONITOR_API_URL=(str, ""), # manage.py monitor-api command
     MONITOR_API_USER=(str, "monitor-api@mediacloud.org"), # manage.py monitor-api command
     PROVIDERS_TIMEOUT=(int, 60*10),
+    QUOTA_REDIS=(bool, True), # Redis quota counters (synced to QuotaHistory by quota-sync)
+    RATELIMIT_TOKEN_BUCKET=(bool, False), # API query views: token bucket (with burst) ratelimit
     SCRAPE_ERROR_RECIPIENTS=(list, []),
     SCRAPE_TIMEOUT_SECONDS=(float, 10.0), # http connect/read
+    SEARCH_THREADS=(int, 8), # per-process threads for concurrent provider calls
     SENTRY_DSN=(str, ""),
     SENTRY_ENV=(str, ""),
     SENTRY_JS_REPLAY_RATE=(float, 0.1), # fraction 0 to 1.0
@@ -152,10 +171,22 @@ ANALYTICS_MATOMO_DOMAIN = env('ANALYTICS_MATOMO_DOMAIN')
 ANALYTICS_MATOMO_SITE_ID = env('ANALYTICS_MATOMO_SITE_ID')
 
 AVAILABLE_PROVIDERS = ["onlinenews-mediacloud", "onlinenews-waybackmachine"]
+CACHE_COMPRESS_MIN_BYTES = env("CACHE_COMPRESS_MIN_BYTES")
+CACHE_COMPRESSOR = env("CACHE_COMPRESSOR")
+CACHE_LOCAL_ENTRIES = env("CACHE_LOCAL_ENTRIES")
+CACHE_LOCAL_MAX_BYTES = env("CACHE_LOCAL_MAX_BYTES")
+CACHE_LOCAL_MAX_TOTAL_BYTES = env("CACHE_LOCAL_MAX_TOTAL_BYTES")
+CACHE_LOCAL_SECONDS = env("CACHE_LOCAL_SECONDS")
+CACHE_LOCK_SECONDS = env("CACHE_LOCK_SECONDS")
+CACHE_LOCK_WAIT_SECONDS = env("CACHE_LOCK_WAIT_SECONDS")
+CACHE_REFRESH_THREADS = env("CACHE_REFRESH_THREADS")
 CACHE_SECONDS = env("CACHE_SECONDS")
+CACHE_STALE_SECONDS = env("CACHE_STALE_SECONDS")
 CSRF_TRUSTED_ORIGINS = env("CSRF_TRUSTED_ORIGINS") # defined as list
+CSV_PREFETCH_PAGES = env("CSV_PREFETCH_PAGES")
 
 DEBUG = env("DEBUG")
+DOWNLOAD_USER_QUERIES = env("DOWNLOAD_USER_QUERIES")
 
 EARLIEST_AVAILABLE_DATE = env('EARLIEST_AVAILABLE_DATE') # earliest available date for elastic search
 
@@ -171,11 +202,19 @@ EMAIL_HOST_USE_SSL = env('EMAIL_HOST_USE_SSL')
 EMAIL_NOREPLY = env('EMAIL_NOREPLY') # email sender address
 EMAIL_ORGANIZATION = env('EMAIL_ORGANIZATION') # used in subject line
 
+# large content download export jobs (backend/search/exports.py)
+EXPORT_CHUNK_ROWS = env('EXPORT_CHUNK_ROWS')
+EXPORT_KEEP_DAYS = env('EXPORT_KEEP_DAYS')
+EXPORT_S3_ENDPOINT_URL = env('EXPORT_S3_ENDPOINT_URL')
+EXPORT_STORE = env('EXPORT_STORE')
+
 GIT_REV = env("GIT_REV")      # supplied by Dokku, returned by /api/version
 LOG_LEVEL = env('LOG_LEVEL').upper()
 MONITOR_API_URL = env('MONITOR_API_URL')
 MONITOR_API_USER = env('MONITOR_API_USER')
 PROVIDERS_TIMEOUT = env('PROVIDERS_TIMEOUT')
+QUOTA_REDIS = env('QUOTA_REDIS')
+RATELIMIT_TOKEN_BUCKET = env('RATELIMIT_TOKEN_BUCKET')
 
 RSS_FETCHER_URL = env('RSS_FETCHER_URL')
 RSS_FETCHER_USER = env('RSS_FETCHER_USER')
@@ -183,6 +222,7 @@ RSS_FETCHER_PASS = env('RSS_FETCHER_PASS')
 
 SCRAPE_ERROR_RECIPIENTS = env('SCRAPE_ERROR_RECIPIENTS') # list
 SCRAPE_TIMEOUT_SECONDS = env('SCRAPE_TIMEOUT_SECONDS') # HTTP connect/read timeout
+SEARCH_THREADS = env('SEARCH_THREADS')
 SECRET_KEY = env('SECRET_KEY')
 SENTRY_DSN = env('SENTRY_DSN')
 SENTRY_ENV = env('SENTRY_ENV')
@@ -436,7 +476,9 @@ CACHES = {
         # REDIS_URL supplied by Dokku:
         'LOCATION': env('REDIS_URL'),
         "OPTIONS": {
-            "CLIENT_CLASS": "django_redis.client.DefaultClient"
+            "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            # pickle + compression w/ codec id byte:
+            "SERIALIZER": "util.cache_codec.CodecSerializer"
         },
         "KEY_PREFIX": "cache"
     }
@@ -3,18 +3,44 @@ provide wrappers around Django's caching
 super useful (we keep results of api)
 
 adapted from https://james.lin.net.nz/2011/09/08/python-decorator-caching-your-functions/
+
+Two tiers:
+1. "local": a small, per-process LRU (so repeat hits in a gunicorn
+   worker don't leave the process)
+2. "redis": the Django cache (django_redis), shared by all processes
+
+Misses are "single-flight": the first process to miss takes a short
+Redis lock on the key and calls the function, others wait (for a
+bounded time) for the value to appear, or use a stale local copy.
+
+Redis entries carry a "soft" expiration (seconds after being set) and
+a "hard" one (CACHE_STALE_SECONDS later, when Redis drops them).
+Between the two, the stale value is returned immediately, and the
+function is called again on a background thread to refresh the entry.
 """
 
 # Python
+import collections
+import functools
 import hashlib
 import logging
-from typing import Callable, Any
+import pickle
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Any, NamedTuple
 
 # PyPI
 from django.core.cache import cache
+from django.db import connection
+from redis.exceptions import LockError
 
 # mcweb
-from settings import CACHE_SECONDS
+from settings import CACHE_LOCAL_ENTRIES, CACHE_LOCAL_MAX_BYTES, CACHE_LOCAL_MAX_TOTAL_BYTES, \
+    CACHE_LOCAL_SECONDS, \
+    CACHE_LOCK_SECONDS, CACHE_LOCK_WAIT_SECONDS, CACHE_REFRESH_THREADS, CACHE_SECONDS, \
+    CACHE_STALE_SECONDS
 
 # mcweb.util (local dir)
 import util.stats as stats
@@ -23,6 +49,15 @@ logger = logging.getLogger(__name__)
 
 TRACE_CACHE = False
 
+# tier names (for stats labels and mc_providers_cacher)
+TIER_LOCAL = "local"
+TIER_REDIS = "redis"
+TIER_STALE = "stale"            # expired entry (while being refreshed)
+
+# polling interval bounds while waiting for another process to fill cache
+LOCK_POLL_MIN = 0.05
+LOCK_POLL_MAX = 0.5
+
 def trace(format, *args):
     if TRACE_CACHE:
         logger.debug(format, *args)
@@ -30,50 +65,345 @@ def trace(format, *args):
 def count_total(which: str) -> None:
     stats.count(["cache", "total"], labels=[("status", which)])
 
-def cached_function_call(fn: Callable, cache_prefix: str, seconds: int | None = None, *args, **kwargs) -> tuple[Any, bool]:
+def count_tier(tier: str, which: str) -> None:
+    stats.count(["cache", "tier"], labels=[("tier", tier), ("status", which)])
+
+def count_coalesced(outcome: str) -> None:
+    stats.count(["cache", "coalesced"], labels=[("outcome", outcome)])
+
+def count_refresh(outcome: str) -> None:
+    stats.count(["cache", "refresh"], labels=[("outcome", outcome)])
+
+class CacheEntry(NamedTuple):
     """
-    mother of all caching functions
+    what's stored in Redis
+    """
+    value: Any
+    soft_expires: float         # time.time() after which value is stale
+
+    def is_stale(self) -> bool:
+        return time.time() >= self.soft_expires
+
+class LocalCache:
+    """
+    Bounded (by entries, and total pickled bytes) per-process
+    LRU cache with per-entry expiration.
+
+    Values are kept pickled: results are handed to view code that is
+    free to modify them (story_detail deletes "text"), and callers
+    must never see each other's changes.  Pickled size is also
+    what's used to skip caching overly large values.
+    """
+    def __init__(self, max_entries: int, max_bytes: int, max_total_bytes: int, seconds: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_total_bytes = max_total_bytes
+        self.seconds = seconds
+        self._total_bytes = 0
+        # key -> (expiration time, pickled value), oldest use first
+        self._entries: collections.OrderedDict[str, tuple[float, bytes]] = collections.OrderedDict()
+        self._lock = threading.Lock() # in case of threaded workers
+        self.counters: collections.Counter[str] = collections.Counter()
+
+    def get(self, key: str, stale_ok: bool = False) -> Any:
+        """
+        returns None if not found (or expired, unless stale_ok).
+        expired entries are left in place (until pushed out)
+        for use as stale values.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.counters["miss"] += 1
+                return None
+            expires, data = entry
+            if expires < time.monotonic():
+                if not stale_ok:
+                    self.counters["expired"] += 1
+                    self.counters["miss"] += 1
+                    return None
+                self.counters["stale"] += 1
+            else:
+                self.counters["hit"] += 1
+            self._entries.move_to_end(key)
+        return pickle.loads(data)
+
+    def set(self, key: str, value: Any, seconds: int) -> None:
+        if self.max_entries <= 0:
+            return
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            self.counters["too_big"] += 1
+            return
+        expires = time.monotonic() + min(seconds, self.seconds)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._total_bytes -= len(old[1])
+            self._entries[key] = (expires, data)
+            self._total_bytes += len(data)
+            while (len(self._entries) > self.max_entries or
+                   self._total_bytes > self.max_total_bytes):
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._total_bytes -= len(evicted)
+                self.counters["evicted"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries), bytes=self._total_bytes)
+
+local_cache = LocalCache(CACHE_LOCAL_ENTRIES, CACHE_LOCAL_MAX_BYTES,
+                         CACHE_LOCAL_MAX_TOTAL_BYTES, CACHE_LOCAL_SECONDS)
+
+def _key_prefix(cache_prefix: str) -> str:
+    """
+    readable part of (hashed) cache key, so values can be
+    grouped by prefix (see cache-sizes command)
+    """
+    return re.sub(r"[^\w.-]", "_", cache_prefix)[:64]
+
+# number of set digests to remember
+SET_DIGESTS = 256
+
+@functools.lru_cache(maxsize=SET_DIGESTS)
+def set_digest(values: frozenset) -> str:
+    """
+    return digest of a (possibly very large) set of strings
+    (ie; domains from a big collection), hashed incrementally
+    in sorted order, without making one giant string.
+
+    frozensets cache their own hash, and lru_cache lookups
+    check identity before equality, so passing the same
+    frozenset (ie; from ParsedQuery.provider_props) for all the
+    calls in a request computes the digest only once.
+    """
+    h = hashlib.md5()
+    for value in sorted(values):
+        h.update(str(value).encode("UTF8"))
+        h.update(b"\x03")
+    return h.hexdigest()
+
+def _key_element(val: Any) -> str:
+    """
+    canonical string for an argument used in a cache key
+    """
+    if isinstance(val, (set, frozenset)):
+        # domains (should be frozenset, see search/utils.py _for_media_cloud)
+        if isinstance(val, set):
+            val = frozenset(val)
+        return f"set\x03{set_digest(val)}"
+    if isinstance(val, dict):
+        # url_search_strings is dict of (frozen)sets
+        items = [f"{k}\x04{_key_element(v)}" for k, v in sorted(val.items())]
+        return "{" + "\x05".join(items) + "}"
+    return str(val)
+
+def _cache_key(cache_prefix: str, args: tuple, kwargs: dict) -> tuple[str, str]:
+    """
+    returns (hashed key, readable key)
     """
-    # inlined to avoid expanding args/kwargs again.
     # tweaked key generation to delimit concatenated strings with non-printing
     # characters unlikely to appear in argument strings to avoid ambiguity
-    # (everything was one continuous string)
+    # (everything was one continuous string).  Large sets are reduced
+    # to digests, so readable key stays short.
     elements = [cache_prefix]
     for arg in args:
-        elements.append(str(arg))
+        elements.append(_key_element(arg))
     for key, val in kwargs.items():
-        # turn set kwargs (domains/url_search_strings) into sorted lists
-        if isinstance(val, set):
-            val = sorted(val)
-        elif isinstance(val, dict):
-            # url_search_strings is (default)dict of sets
-            nval = {}
-            for k2, v2 in sorted(val.items()):
-                if isinstance(v2, set):
-                    nval[k2] = sorted(v2)
-                else:
-                    nval[k2] = v2
-            val = nval
-        elements.append(f"{key}\x02{val}")
+        elements.append(f"{key}\x02{_key_element(val)}")
     readable_key = "\x01".join(elements)
-    key = hashlib.md5(readable_key.encode("UTF8")).hexdigest()
+    digest = hashlib.md5(readable_key.encode("UTF8")).hexdigest()
+    return f"{_key_prefix(cache_prefix)}:{digest}", readable_key
+
+def _redis_get(key: str) -> CacheEntry | None:
+    """
+    returns None if key not in Redis
+    (cached values may be falsy: zero counts, empty lists)
+    """
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    if not isinstance(entry, CacheEntry):
+        # bare value written before soft expiration existed;
+        # treat as fresh (Redis will expire it)
+        entry = CacheEntry(entry, float("inf"))
+    return entry
 
-    results = cache.get(key)
-    if results:
-        trace("found %r", readable_key)
+def _local_seconds(entry: CacheEntry, seconds: int) -> int:
+    """
+    seconds to keep Redis entry in local tier: no longer than
+    until its soft expiration (legacy bare values have none)
+    """
+    remaining = entry.soft_expires - time.time()
+    if remaining == float("inf"):
+        return seconds
+    return int(min(seconds, remaining))
+
+def _set(key: str, results: Any, seconds: int) -> None:
+    """
+    set both tiers; Redis keeps entry CACHE_STALE_SECONDS past soft expiration
+    """
+    cache.set(key, CacheEntry(results, time.time() + seconds),
+              seconds + CACHE_STALE_SECONDS)
+    local_cache.set(key, results, seconds)
+
+def _lock_key(key: str) -> str:
+    return f"{key}:lock"
+
+def _lock(key: str):
+    """
+    try to take single-flight lock for key: returns redis Lock or None
+    (not thread local, so can be released by a refresh thread)
+    """
+    lock = cache.lock(_lock_key(key), timeout=CACHE_LOCK_SECONDS, thread_local=False)
+    if lock.acquire(blocking=False):
+        return lock
+    return None
+
+def _unlock(lock, readable_key: str) -> None:
+    try:
+        lock.release()
+    except LockError:
+        # lock expired (and possibly taken by someone else)
+        logger.info("cache lock for %r expired", readable_key)
+
+def _wait_for(key: str, timeout: float) -> CacheEntry | None:
+    """
+    wait for another process to fill the cache for key.
+    returns None on timeout, or if the lock was released
+    without the cache being filled (function raised).
+    """
+    deadline = time.monotonic() + timeout
+    poll = LOCK_POLL_MIN
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(poll, remaining))
+        # check lock first, so value set just before release is seen
+        locked = cache.has_key(_lock_key(key))
+        entry = _redis_get(key)
+        if entry is not None and not entry.is_stale():
+            return entry
+        if not locked:
+            return None
+        poll = min(poll * 2, LOCK_POLL_MAX)
+
+_refresh_executor: ThreadPoolExecutor | None = None
+
+def _refresh(fn: Callable, key: str, readable_key: str, seconds: int,
+             args: tuple, kwargs: dict, lock) -> None:
+    """
+    runs in _refresh_executor thread to replace a stale entry
+    """
+    try:
+        _set(key, fn(*args, **kwargs), seconds)
+        trace("refreshed %r", readable_key)
+        count_refresh("ok")
+    except Exception:
+        # caller already has (stale) results, so nobody to tell
+        logger.exception("error refreshing %r", readable_key)
+        count_refresh("error")
+    finally:
+        _unlock(lock, readable_key)
+        # fn may have used the database: don't leak this thread's connection
+        connection.close()
+
+def _schedule_refresh(fn: Callable, key: str, readable_key: str, seconds: int,
+                      args: tuple, kwargs: dict) -> None:
+    global _refresh_executor
+
+    lock = _lock(key)
+    if not lock:
+        count_refresh("busy")   # someone else is on it
+        return
+
+    if _refresh_executor is None:
+        _refresh_executor = ThreadPoolExecutor(max_workers=CACHE_REFRESH_THREADS,
+                                               thread_name_prefix="cache-refresh")
+    _refresh_executor.submit(_refresh, fn, key, readable_key, seconds, args, kwargs, lock)
+
+def _cached_call(fn: Callable, cache_prefix: str, seconds: int | None,
+                 args: tuple, kwargs: dict) -> tuple[Any, str | None]:
+    """
+    returns (results, tier); tier is None if fn was called.
+    """
+    key, readable_key = _cache_key(cache_prefix, args, kwargs)
+
+    results = local_cache.get(key)
+    if results is not None:
+        trace("found %r in %s", readable_key, TIER_LOCAL)
         count_total("hit")
-        return results, True
+        count_tier(TIER_LOCAL, "hit")
+        return results, TIER_LOCAL
+    count_tier(TIER_LOCAL, "miss")
 
-    trace("not found %r", readable_key)
-    count_total("miss")
-    results = fn(*args, **kwargs)
     if seconds is None:
         # this is the one place where the default value is used.
         # NOTE! used here to allow wacking CACHE_SECONDS in debugger!
         seconds = CACHE_SECONDS
-    cache.set(key, results, seconds)
-    trace("set %r", readable_key)
-    return results, False
+
+    entry = _redis_get(key)
+    if entry is not None:
+        count_total("hit")
+        if entry.is_stale():
+            # return stale value now, refresh in background
+            trace("found stale %r in %s", readable_key, TIER_REDIS)
+            count_tier(TIER_STALE, "hit")
+            _schedule_refresh(fn, key, readable_key, seconds, args, kwargs)
+            return entry.value, TIER_STALE
+        trace("found %r in %s", readable_key, TIER_REDIS)
+        count_tier(TIER_REDIS, "hit")
+        local_cache.set(key, entry.value, _local_seconds(entry, seconds))
+        return entry.value, TIER_REDIS
+    count_tier(TIER_REDIS, "miss")
+
+    trace("not found %r", readable_key)
+    count_total("miss")
+
+    # single-flight: only one process calls fn for a given key.
+    lock = _lock(key)
+    if lock:
+        try:
+            results = fn(*args, **kwargs)
+            _set(key, results, seconds)
+        finally:
+            _unlock(lock, readable_key)
+        trace("set %r", readable_key)
+        return results, None
+
+    # another process is calling fn: use stale local copy if available
+    results = local_cache.get(key, stale_ok=True)
+    if results is not None:
+        trace("using stale %r", readable_key)
+        count_coalesced(TIER_STALE)
+        return results, TIER_STALE
+
+    entry = _wait_for(key, CACHE_LOCK_WAIT_SECONDS)
+    if entry is not None:
+        trace("waited for %r", readable_key)
+        count_coalesced("waited")
+        local_cache.set(key, entry.value, _local_seconds(entry, seconds))
+        return entry.value, TIER_REDIS
+
+    # took too long (or other process failed): do it ourselves
+    logger.info("gave up waiting for %r", readable_key)
+    count_coalesced("timeout")
+    results = fn(*args, **kwargs)
+    _set(key, results, seconds)
+    return results, None
+
+def cached_function_call(fn: Callable, cache_prefix: str, seconds: int | None = None, *args, **kwargs) -> tuple[Any, bool]:
+    """
+    mother of all caching functions
+    """
+    results, tier = _cached_call(fn, cache_prefix, seconds, args, kwargs)
+    return results, tier is not None
 
 def mc_providers_cacher(fn: Callable, cache_prefix: str, *args, **kwargs) -> tuple[Any, bool]:
     """
@@ -81,7 +411,31 @@ def mc_providers_cacher(fn: Callable, cache_prefix: str, *args, **kwargs) -> tup
     this is the one place that needs to return the was_cached bool.
     """
     seconds = kwargs.pop("_cache_seconds", None)
-    return cached_function_call(fn, cache_prefix, seconds, *args, **kwargs)
+    results, tier = _cached_call(fn, cache_prefix, seconds, args, kwargs)
+    stats.count(["cache", "providers"], labels=[("tier", tier or "none")])
+    return results, tier is not None
+
+# generation counters: include get_generation(name) in a cache key
+# (or cached function args) and call bump_generation(name) when the
+# underlying data changes to make all existing entries unreachable.
+def _generation_key(name: str) -> str:
+    return f"generation:{name}"
+
+def _initial_generation() -> int:
+    # if counter is ever lost (Redis flushed), must not restart
+    # at a value used before, so start from current time.
+    return int(time.time())
+
+def get_generation(name: str) -> int:
+    # never expires (ints stored unpickled by django_redis)
+    return cache.get_or_set(_generation_key(name), _initial_generation, None)
+
+def bump_generation(name: str) -> None:
+    key = _generation_key(name)
+    try:
+        cache.incr(key)
+    except ValueError:          # not set
+        cache.add(key, _initial_generation(), None)
 
 # decorator for caching functions in backend code.  NOTE!  **ALL**
 # arguments used for cache key, so does NOT work for instance methods
@@ -0,0 +1,143 @@
+"""
+Compact encoding for values stored in the Django (Redis) cache.
+
+Installed as the django_redis SERIALIZER (see CACHES in settings.py),
+so everything written through django.core.cache passes through here
+(django_redis stores plain ints as-is, for INCR).
+
+Values are pickled and, when big enough to be worth it, compressed.
+The first byte of each encoded value identifies the codec used to
+write it, so the compressor (and threshold) can be changed without
+flushing the cache.
+
+msgpack and orjson were considered, but can't round-trip the date and
+datetime objects in provider results (count_over_time, all_items),
+so pickle is still used for serialization.
+"""
+
+# Python
+import pickle
+import zlib
+from typing import Any
+
+# PyPI
+import zstandard
+from django_redis.serializers.base import BaseSerializer
+
+# mcweb
+from settings import CACHE_COMPRESS_MIN_BYTES, CACHE_COMPRESSOR
+
+# values written by django_redis PickleSerializer (before this module)
+# start with the pickle PROTO opcode, never used as a codec id.
+_PICKLE_PROTO = pickle.PROTO[0]
+
+class Codec:
+    """
+    base class for (de)compressors of pickled data
+    """
+    ID: int                     # first byte of encoded data
+    NAME: str                   # for CACHE_COMPRESSOR
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError("compress not implemented")
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError("decompress not implemented")
+
+CODECS: dict[int, Codec] = {}
+CODECS_BY_NAME: dict[str, Codec] = {}
+
+def codec(cls: type[Codec]) -> type[Codec]:
+    """
+    decorator to register a Codec class
+    NOTE! never reuse or renumber an ID: values written with it may still be cached!
+    """
+    assert cls.ID not in CODECS and cls.ID != _PICKLE_PROTO
+    CODECS[cls.ID] = CODECS_BY_NAME[cls.NAME] = cls()
+    return cls
+
+@codec
+class Raw(Codec):
+    """
+    uncompressed (small values)
+    """
+    ID = 1
+    NAME = "raw"
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+@codec
+class Zlib(Codec):
+    ID = 2
+    NAME = "zlib"
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, 6)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+@codec
+class Zstd(Codec):
+    ID = 3
+    NAME = "zstd"
+    LEVEL = 3                   # zstd default: fast, and much better than zlib
+
+    def compress(self, data: bytes) -> bytes:
+        # module function writes content size into frame header
+        # (needed by zstandard.decompress)
+        return zstandard.compress(data, self.LEVEL)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zstandard.decompress(data)
+
+_raw = CODECS_BY_NAME[Raw.NAME]
+_compressor = CODECS_BY_NAME[CACHE_COMPRESSOR]
+
+def encode(value: Any, min_bytes: int = CACHE_COMPRESS_MIN_BYTES) -> bytes:
+    """
+    return encoded value: codec id byte followed by data
+    """
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    c = _raw
+    if len(data) >= min_bytes:
+        compressed = _compressor.compress(data)
+        if len(compressed) < len(data):
+            c = _compressor
+            data = compressed
+    return bytes((c.ID,)) + data
+
+def _pickled(data: bytes) -> tuple[str, bytes]:
+    """
+    returns (codec name, pickled bytes) for encoded data
+    """
+    first = data[0]
+    if first == _PICKLE_PROTO:
+        return "pickle", data
+    c = CODECS[first]           # KeyError for unknown codec
+    return c.NAME, c.decompress(memoryview(data)[1:])
+
+def decode(data: bytes) -> Any:
+    name, pickled = _pickled(data)
+    return pickle.loads(pickled)
+
+def sizes(data: bytes) -> tuple[str, int]:
+    """
+    for reporting: returns (codec name, uncompressed pickle size)
+    """
+    name, pickled = _pickled(data)
+    return name, len(pickled)
+
+class CodecSerializer(BaseSerializer):
+    """
+    django_redis serializer (see CACHES in settings.py)
+    """
+    def dumps(self, value: Any) -> bytes:
+        return encode(value)
+
+    def loads(self, value: bytes) -> Any:
+        return decode(value)
@@ -1,8 +1,56 @@
 #import logging; logger = logging.getLogger(__name__) # for debug
 
 from django.conf import settings
+from django.core.cache import cache
+from django_ratelimit.decorators import ratelimit
 from rest_framework.authentication import SessionAuthentication
 
+from util import token_bucket
+
+# rate tiers (from group membership), cached per user
+HIGH = "high"
+DEFAULT = "default"
+
+# average rate, for django_ratelimit (fixed window)
+RATES = {
+    HIGH: "100/m",
+    DEFAULT: "2/m",
+}
+
+# (average rate, burst) for token bucket
+BUCKETS = {
+    HIGH: ("100/m", 100),
+    DEFAULT: ("2/m", 10),
+}
+
+# entries deleted on group membership changes (see backend/users/models.py)
+# so this only bounds the lifetime of unused entries.
+RATE_TIER_CACHE_SECONDS = 60*60
+
+def _rate_tier_key(user_id: int) -> str:
+    return f"rate-tier:{user_id}"
+
+def forget_rate_tier(user_id: int) -> None:
+    cache.delete(_rate_tier_key(user_id))
+
+def rate_tier(user) -> str:
+    """
+    return rate tier for user, without a database query
+    for each API call.
+    """
+    # check staff first to sidestep possible database access!
+    if user.is_staff:
+        return HIGH
+    key = _rate_tier_key(user.pk)
+    tier = cache.get(key)
+    if tier is None:
+        if user.groups.filter(name=settings.GROUPS.HIGH_RATE_LIMIT).exists():
+            tier = HIGH
+        else:
+            tier = DEFAULT
+        cache.set(key, tier, RATE_TIER_CACHE_SECONDS)
+    return tier
+
 def query_rate(group, request):
     """
     A ratelimit callable which sets a higher ratelimit if the user is staff,
@@ -14,11 +62,23 @@ def query_rate(group, request):
     if isinstance(request.successful_authenticator, SessionAuthentication):
         return None             # no limit
 
-    # check staff first to sidestep possible database access!
-    if request.user.is_staff or request.user.groups.filter(name=settings.GROUPS.HIGH_RATE_LIMIT).exists():
-        return "100/m"
-    else:
-        return "2/m"
+    return RATES[rate_tier(request.user)]
 
+def query_bucket(group, request):
+    """
+    token_bucket.ratelimit callable: like query_rate,
+    but returns (rate, burst)
+    """
+    if isinstance(request.successful_authenticator, SessionAuthentication):
+        return None             # no limit
 
+    return BUCKETS[rate_tier(request.user)]
 
+def query_ratelimit(func):
+    """
+    decorator for API query views: token bucket if
+    settings.RATELIMIT_TOKEN_BUCKET, else django_ratelimit
+    """
+    if settings.RATELIMIT_TOKEN_BUCKET:
+        return token_bucket.ratelimit(query_bucket)(func)
+    return ratelimit(key="user", rate='util.ratelimit_callables.query_rate')(func)
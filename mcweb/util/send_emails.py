@@ -81,6 +81,19 @@ def send_zipped_large_download_email(zipped_filename, zipped_data, to: str):
     except Exception as e:
         logger.exception("send_zipped_large_download_email for %s", to)
 
+# sent by backend/search/exports.py when an export job completes
+def send_export_ready_email(filename: str, url: str, rows: int, to: str):
+    if not EMAIL_HOST:
+        logger.debug("send_export_ready_email: EMAIL_HOST not set for %s", to)
+        return
+    email = EmailMessage(subject=f"[{EMAIL_ORGANIZATION}] Downloaded Total Attention's Data",
+                         body=f"Your download of {rows} stories ({filename}) is ready at:\n{url}\n",
+                         from_email=EMAIL_NOREPLY, to=[to])
+    try:
+        EmailThread(email).start()
+    except Exception as e:
+        logger.exception("send_export_ready_email for %s", to)
+
 
 def send_alert_email(alert_dict: dict):
     logger.info("send_alert_email %r", alert_dict)
@@ -0,0 +1,115 @@
+"""
+Token bucket rate limiter in Redis (an alternative to the fixed
+window counters of django_ratelimit):
+
+A bucket holds up to `burst` tokens, and refills at `rate` tokens per
+second.  Each call takes a token, so a client can make `burst` calls
+back to back, but the long term average is still limited to `rate`.
+
+The refill and take are done by a Lua script (atomic, one round trip),
+using the Redis server clock (so web servers' clocks don't matter).
+"""
+
+# Python
+import functools
+import logging
+import re
+from typing import Callable
+
+# PyPI
+from django_ratelimit.exceptions import Ratelimited
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+# mcweb/util
+import util.stats as stats
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "ratelimit:bucket"
+
+# ARGV: rate (tokens/second), burst (capacity), cost
+# returns {allowed (0/1), milliseconds until cost tokens available}
+_TAKE = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+
+local tokens = burst
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ms')
+if bucket[1] then
+    local elapsed = math.max(0, now - tonumber(bucket[2]))
+    tokens = math.min(burst, tonumber(bucket[1]) + elapsed * rate / 1000)
+end
+
+local allowed = 0
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    wait = math.ceil((cost - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ms', now)
+-- gone once full again
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return {allowed, wait}
+"""
+
+_UNITS = {"s": 1, "m": 60, "h": 60*60, "d": 24*60*60}
+_RATE_RE = re.compile(r"^(\d+)/(\d*)([smhd])$")
+
+def parse_rate(rate: str) -> float:
+    """
+    convert django_ratelimit style rate ("100/m", "10/5s")
+    to tokens per second
+    """
+    m = _RATE_RE.match(rate)
+    if not m:
+        raise ValueError(f"bad rate {rate!r}")
+    count, multiplier, unit = m.groups()
+    return int(count) / (int(multiplier or 1) * _UNITS[unit])
+
+def _redis():
+    return get_redis_connection("default")
+
+def take(key: str, rate: float, burst: int, cost: int = 1) -> tuple[bool, float]:
+    """
+    try to take `cost` tokens from bucket `key`;
+    returns (allowed, seconds until allowed)
+    """
+    r = _redis()
+    script = r.register_script(_TAKE)
+    allowed, wait = script(keys=[f"{KEY_PREFIX}:{key}"], args=[rate, burst, cost])
+    return bool(allowed), wait / 1000
+
+# returns (rate, burst) or None for no limit
+BucketCallable = Callable[[str, object], tuple[str, int] | None]
+
+def ratelimit(bucket: BucketCallable, group: str | None = None):
+    """
+    view decorator (like django_ratelimit.decorators.ratelimit
+    with key="user" and block=True): raises Ratelimited if the
+    user's bucket is empty.  Fails open if Redis is unavailable.
+    """
+    def decorator(func):
+        grp = group or f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def _wrapped(request, *args, **kwargs):
+            limit = bucket(grp, request)
+            if limit:
+                rate, burst = limit
+                try:
+                    allowed, wait = take(f"{grp}:{request.user.pk}", parse_rate(rate), burst)
+                except RedisError as e:
+                    logger.warning("token bucket: %r", e)
+                    stats.count(["ratelimit", "bucket", "error"])
+                    allowed = True
+                if not allowed:
+                    raise Ratelimited()
+            return func(request, *args, **kwargs)
+        return _wrapped
+    return decorator